@@ -1,7 +1,25 @@
 import numpy as np
-import pandas as pd
 import xml.etree.ElementTree as ET
 import re
+import os
+import math
+import io
+import zipfile
+import concurrent.futures
+import collections
+import contextlib
+import gzip
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+# brotli is optional: without it responses are offered in gzip and identity only
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
 
 # 1. Función point-in-polygon (ray casting)
 def point_in_polygon(x, y, poly):
@@ -21,87 +39,520 @@ def point_in_polygon(x, y, poly):
         p1x, p1y = p2x, p2y
     return inside
 
-# 2. Parsear el KML (coordenadas del polígono de interés)
-def parse_kml_polygon(kml_content):
-    """Parse KML content and extract polygon coordinates. Handles namespaces and multiple possible structures."""
+# 1b. Versión vectorizada: prueba arrays completos de puntos contra todas las aristas
+_PIP_BLOCK_ELEMENTS = 1_000_000
+
+def points_in_polygon(xs, ys, poly):
+    """
+    Vectorized ray casting: test arrays of points (xs, ys) against a polygon.
+    Returns a boolean mask with the same semantics as point_in_polygon.
+    poly may also be a Rings instance: holes follow the even-odd rule within
+    their part and a point is inside if any part contains it.
+    """
+    if isinstance(poly, Rings):
+        inside = np.zeros(np.size(xs), dtype=bool)
+        in_part = np.zeros(np.size(xs), dtype=bool)
+        for ring, hole in zip(poly.rings, poly.is_hole):
+            if not hole:
+                inside |= in_part
+                in_part = np.zeros(np.size(xs), dtype=bool)
+            in_part ^= _points_in_ring(xs, ys, ring)
+        return inside | in_part
+    return _points_in_ring(xs, ys, poly)
+
+def _points_in_ring(xs, ys, poly):
+    """Ray casting of many points against one ring; edges are processed in bounded blocks"""
+    xs = np.asarray(xs, dtype=float).ravel()
+    ys = np.asarray(ys, dtype=float).ravel()
+    inside = np.zeros(xs.shape[0], dtype=bool)
+    if xs.shape[0] == 0:
+        return inside
+
+    poly = np.asarray(poly, dtype=float)
+    p1 = poly
+    p2 = np.roll(poly, -1, axis=0)
+
+    # Horizontal edges never toggle the ray (y > min and y <= max cannot both hold)
+    keep = p1[:, 1] != p2[:, 1]
+    p1x, p1y = p1[keep, 0], p1[keep, 1]
+    p2x, p2y = p2[keep, 0], p2[keep, 1]
+    if p1x.shape[0] == 0:
+        return inside
+
+    e_min_y = np.minimum(p1y, p2y)
+    e_max_y = np.maximum(p1y, p2y)
+    e_max_x = np.maximum(p1x, p2x)
+    e_vertical = p1x == p2x
+    e_slope = (p2x - p1x) / (p2y - p1y)
+
+    px = xs[:, None]
+    py = ys[:, None]
+    block = max(1, _PIP_BLOCK_ELEMENTS // xs.shape[0])
+    for start in range(0, p1x.shape[0], block):
+        sl = slice(start, start + block)
+        xinters = (py - p1y[sl]) * e_slope[sl] + p1x[sl]
+        crosses = (
+            (py > e_min_y[sl]) & (py <= e_max_y[sl]) & (px <= e_max_x[sl]) &
+            (e_vertical[sl] | (px <= xinters))
+        )
+        inside ^= (np.count_nonzero(crosses, axis=1) & 1).astype(bool)
+    return inside
+
+# 1c. Polígonos con agujeros o varias partes
+class Rings:
+    """
+    Polygon with holes, or several polygons, as an ordered list of closed rings.
+    Each outer ring is followed by its holes. Point tests take the union of the
+    parts; areas add outer rings and subtract holes. overlaps holds signed
+    convex (ring, sign) terms that only areas see: they take out the area
+    counted twice where parts overlap (see merge_overlapping_parts).
+    """
+
+    def __init__(self, rings, is_hole=None, overlaps=None):
+        self.rings = [np.asarray(ring, dtype=float) for ring in rings]
+        if is_hole is None:
+            is_hole = [False] * len(self.rings)
+        self.is_hole = [bool(hole) for hole in is_hole]
+        self.overlaps = [(np.asarray(ring, dtype=float), float(sign)) for ring, sign in overlaps or ()]
+
+    @classmethod
+    def from_parts(cls, parts, overlaps=None):
+        """Build from an iterable of (outer, holes) pairs"""
+        rings, is_hole = [], []
+        for outer, holes in parts:
+            rings.append(outer)
+            is_hole.append(False)
+            for hole in holes:
+                rings.append(hole)
+                is_hole.append(True)
+        return cls(rings, is_hole, overlaps)
+
+    def __len__(self):
+        return len(self.rings)
+
+    def parts(self):
+        """List of (outer, [holes]) pairs"""
+        parts = []
+        for ring, hole in zip(self.rings, self.is_hole):
+            if hole and parts:
+                parts[-1][1].append(ring)
+            else:
+                parts.append((ring, []))
+        return parts
+
+    def signed_rings(self):
+        """(ring, +1) for outer rings, (ring, -1) for holes, then the overlap terms"""
+        return [(ring, -1.0 if hole else 1.0) for ring, hole in zip(self.rings, self.is_hole)] + self.overlaps
+
+def _as_rings(poly):
+    return poly if isinstance(poly, Rings) else Rings([poly])
+
+def polygon_bounds(poly):
+    """(min_lon, min_lat, max_lon, max_lat) of a ring array or Rings"""
+    coords = np.concatenate(_as_rings(poly).rings)
+    min_lon, min_lat = coords.min(axis=0)
+    max_lon, max_lat = coords.max(axis=0)
+    return min_lon, min_lat, max_lon, max_lat
+
+def polygon_to_geojson_geometry(poly):
+    """GeoJSON geometry (Polygon or MultiPolygon) for a ring array or Rings"""
+    if not isinstance(poly, Rings):
+        return {'type': 'Polygon', 'coordinates': [np.asarray(poly, dtype=float).tolist()]}
+    parts = [[outer.tolist()] + [hole.tolist() for hole in holes] for outer, holes in poly.parts()]
+    if len(parts) == 1:
+        return {'type': 'Polygon', 'coordinates': parts[0]}
+    return {'type': 'MultiPolygon', 'coordinates': parts}
+
+# 2. Parsear el KML / KMZ en streaming (todos los Placemarks, agujeros y MultiGeometry)
+MAX_BATCH_POLYGONS = 500
+
+def _parse_coordinates_text(coords_text):
+    """Parse the text of a KML <coordinates> element into an (n, 2) lon/lat array"""
+    coords = []
+    for coord in coords_text.strip().split():
+        # Handle both lon,lat and lon,lat,alt
+        parts = coord.split(',')
+        if len(parts) >= 2:
+            lon, lat = map(float, parts[:2])
+            coords.append((lon, lat))
+    return np.array(coords)
+
+def _local_tag(elem):
+    return elem.tag.rsplit('}', 1)[-1]
+
+def _open_kml_sources(source, filename=''):
+    """
+    Yield (base_name, binary stream) for every KML document in an upload.
+    source may be str, bytes or a binary file object. ZIP and KMZ archives
+    yield each .kml member, decompressed on the fly.
+    """
+    if isinstance(source, str):
+        source = source.encode('utf-8')
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    elif not getattr(source, 'seekable', lambda: False)():
+        source = io.BytesIO(source.read())
+
+    base = os.path.splitext(os.path.basename(filename or ''))[0]
+    head = source.read(4)
+    source.seek(0)
+    if head != b'PK\x03\x04':
+        yield base, source
+        return
+
+    with zipfile.ZipFile(source) as zf:
+        members = [
+            m for m in zf.namelist()
+            if m.lower().endswith('.kml') and not m.startswith('__MACOSX/')
+        ]
+        if not members:
+            raise ValueError("El archivo ZIP/KMZ no contiene ningún archivo .kml")
+        for member in members:
+            member_base = os.path.splitext(os.path.basename(member))[0]
+            # The main document of a KMZ is doc.kml: name it after the archive
+            if member_base == 'doc' and base:
+                member_base = base
+            with zf.open(member) as stream:
+                yield member_base, stream
+
+def iter_kml_polygons(source, filename='', default_name='Polígono'):
+    """
+    Stream every Polygon of a KML or KMZ upload with ET.iterparse.
+    Yields {'name', 'outer', 'holes'} per polygon, including each member of a
+    MultiGeometry. Processed Placemarks are dropped from the tree as soon as
+    they are yielded, so memory stays flat on large GIS exports.
+    Documents without any Polygon fall back to their first closed ring
+    (e.g. a LineString), as the previous parser did.
+    """
+    for base, stream in _open_kml_sources(source, filename):
+        doc_name = base or default_name
+        path = []
+        elems = []
+        n_placemark = 0
+        placemark_name = None
+        pending = []
+        outer, holes = None, []
+        loose_ring = None
+        found = False
+        try:
+            for event, elem in ET.iterparse(stream, events=('start', 'end')):
+                tag = _local_tag(elem)
+                if event == 'start':
+                    path.append(tag)
+                    elems.append(elem)
+                    if tag == 'Placemark':
+                        n_placemark += 1
+                        placemark_name = None
+                        pending = []
+                    elif tag == 'Polygon':
+                        outer, holes = None, []
+                    continue
+
+                path.pop()
+                elems.pop()
+                if tag == 'name' and path and path[-1] == 'Placemark':
+                    placemark_name = (elem.text or '').strip() or None
+                elif tag == 'coordinates':
+                    ring = _parse_coordinates_text(elem.text or '')
+                    if 'Polygon' in path:
+                        if 'innerBoundaryIs' in path:
+                            if len(ring) >= 3:
+                                holes.append(ring)
+                        elif outer is None:
+                            outer = ring
+                    elif loose_ring is None and len(ring) >= 3:
+                        loose_ring = ring
+                    elem.clear()
+                elif tag == 'Polygon':
+                    if outer is not None and len(outer) >= 3:
+                        found = True
+                        if 'Placemark' in path:
+                            pending.append({'outer': outer, 'holes': holes})
+                        else:
+                            yield {'name': doc_name, 'outer': outer, 'holes': holes}
+                    outer, holes = None, []
+                elif tag == 'Placemark':
+                    name = placemark_name or f"{doc_name} {n_placemark}"
+                    for k, record in enumerate(pending, start=1):
+                        yield {'name': name if len(pending) == 1 else f"{name} ({k})", **record}
+                    pending = []
+                    # Free the processed subtree
+                    elem.clear()
+                    if elems:
+                        elems[-1].remove(elem)
+        except ET.ParseError as e:
+            raise ValueError(f"XML no válido: {str(e)}")
+
+        if not found and loose_ring is not None:
+            yield {'name': doc_name, 'outer': loose_ring, 'holes': []}
+
+KML_OVERLAP_TOLERANCE = 1e-6  # overlap share of the smaller polygon taken as rounding noise, not merged
+
+def _piece_bounds(pieces):
+    """(n, 4) bboxes of (ring, sign) pieces"""
+    return np.array([[*np.min(ring, axis=0), *np.max(ring, axis=0)] for ring, _ in pieces]).reshape(-1, 4)
+
+_SLAB_BLOCK_ELEMENTS = 4_000_000
+
+def _slab_trapezoids(part, ys):
+    """
+    Trapezoids of a part between consecutive ys, which must include every
+    vertex y of the part in that range. In each slab the edges crossing it,
+    ordered by x, pair up even-odd (so holes need no special case).
+    Returns arrays (slab, left_bottom, right_bottom, left_top, right_top).
+    """
+    starts, ends = _polygon_edges(part)
+    keep = starts[:, 1] != ends[:, 1]
+    starts, ends = starts[keep], ends[keep]
+    lo = np.minimum(starts[:, 1], ends[:, 1])
+    hi = np.maximum(starts[:, 1], ends[:, 1])
+    slope = (ends[:, 0] - starts[:, 0]) / (ends[:, 1] - starts[:, 1])
+
+    y0, y1 = ys[:-1], ys[1:]
+    block = max(1, _SLAB_BLOCK_ELEMENTS // max(len(starts), 1))
+    slabs, edges = [], []
+    for first in range(0, len(y0), block):
+        slab, edge = np.nonzero((lo <= y0[first:first + block, None]) & (hi >= y1[first:first + block, None]))
+        slabs.append(slab + first)
+        edges.append(edge)
+    slab = np.concatenate(slabs) if slabs else np.empty(0, dtype=np.int64)
+    edge = np.concatenate(edges) if edges else np.empty(0, dtype=np.int64)
+    x0 = starts[edge, 0] + (y0[slab] - starts[edge, 1]) * slope[edge]
+    x1 = starts[edge, 0] + (y1[slab] - starts[edge, 1]) * slope[edge]
+
+    order = np.lexsort((x0 + x1, slab))
+    slab, x0, x1 = slab[order], x0[order], x1[order]
+    # A slab crossed an odd number of times (unclosed or self-crossing ring) is dropped
+    even = (np.bincount(slab, minlength=len(y0)) % 2 == 0)[slab]
+    slab, x0, x1 = slab[even], x0[even], x1[even]
+    return slab[0::2], x0[0::2], x0[1::2], x1[0::2], x1[1::2]
+
+def _trapezoid(ys, slab, left_bottom, right_bottom, left_top, right_top):
+    """Counter-clockwise corners of one slab trapezoid"""
+    y0, y1 = ys[slab], ys[slab + 1]
+    return np.array([[left_bottom, y0], [right_bottom, y0], [right_top, y1], [left_top, y1]])
+
+def _part_ys(part):
+    return np.concatenate([np.asarray(ring, dtype=float)[:, 1] for ring in part.rings])
+
+def _slab_overlap_area(part_a, part_b):
+    """
+    Exact planar area of part_a ∩ part_b from their slab trapezoids: only
+    trapezoid pairs of the same slab whose x-ranges overlap at its bottom or
+    top are clipped, so disjoint neighbours cost no clipping at all.
+    """
+    a_lo, a_hi = polygon_bounds(part_a)[1::2]
+    b_lo, b_hi = polygon_bounds(part_b)[1::2]
+    lo, hi = max(a_lo, b_lo), min(a_hi, b_hi)
+    if hi <= lo:
+        return 0.0
+    ys = np.concatenate([_part_ys(part_a), _part_ys(part_b), [lo, hi]])
+    ys = np.unique(ys[(ys >= lo) & (ys <= hi)])
+    ta = _slab_trapezoids(part_a, ys)
+    tb = _slab_trapezoids(part_b, ys)
+
+    # Every (a, b) trapezoid pair sharing a slab
+    b_counts = np.bincount(tb[0], minlength=len(ys))
+    b_starts = np.cumsum(b_counts) - b_counts
+    i = np.repeat(np.arange(len(ta[0])), b_counts[ta[0]])
+    j = _expand_ranges(b_starts[ta[0]], b_counts[ta[0]])
+    width_bottom = np.minimum(ta[2][i], tb[2][j]) - np.maximum(ta[1][i], tb[1][j])
+    width_top = np.minimum(ta[4][i], tb[4][j]) - np.maximum(ta[3][i], tb[3][j])
+    near = (width_bottom > 0) | (width_top > 0)
+
+    area = 0.0
+    for n, m in zip(i[near], j[near]):
+        clipped = clip_polygon_convex(
+            _trapezoid(ys, *(t[n] for t in ta)), _trapezoid(ys, *(t[m] for t in tb))
+        )
+        if len(clipped) >= 3:
+            area += abs(_signed_area(clipped))
+    return area
+
+def merge_overlapping_parts(records, tolerance=KML_OVERLAP_TOLERANCE):
+    """
+    Drop repeated polygons and make overlapping ones count once. Returns
+    (records, overlaps): the distinct records and the signed convex
+    (ring, sign) terms for Rings that take the doubly counted area out of
+    exact areas (point tests already take the union). Candidate pairs come
+    from an STRTree over the polygons' bboxes. Each group of overlapping
+    polygons is cut into horizontal slabs at its vertices, where every
+    polygon is a set of trapezoids, and 1(U ∪ P) = 1(U) + 1(P) - 1(U)·1(P)
+    is expanded slab by slab.
+    """
+    distinct, seen = [], set()
+    for record in records:
+        part = Rings.from_parts([(record['outer'], record['holes'])])
+        key = b'|'.join(ring.tobytes() for ring in normalize_polygon(part)[0])
+        if key not in seen:
+            seen.add(key)
+            distinct.append((record, part))
+    records = [record for record, _ in distinct]
+    if len(distinct) < 2:
+        return records, []
+
+    # Groups of polygons linked by overlaps larger than rounding noise
+    parts = [part for _, part in distinct]
+    bounds = np.array([polygon_bounds(part) for part in parts])
+    areas = [polygon_area(part) for part in parts]
+    tree = STRTree(bounds)
+    group = list(range(len(parts)))
+
+    def root(n):
+        while group[n] != n:
+            group[n] = group[group[n]]
+            n = group[n]
+        return n
+
+    for b in range(len(parts)):
+        for a in tree.query(*bounds[b]):
+            if a < b and root(a) != root(b) and \
+                    _slab_overlap_area(parts[a], parts[b]) > tolerance * min(areas[a], areas[b]):
+                group[root(b)] = root(a)
+    members = collections.defaultdict(list)
+    for n in range(len(parts)):
+        members[root(n)].append(n)
+
+    overlaps = []
+    for group_parts in members.values():
+        if len(group_parts) < 2:
+            continue
+        ys = np.unique(np.concatenate([_part_ys(parts[n]) for n in group_parts]))
+        union = collections.defaultdict(list)  # slab -> signed convex pieces of the parts so far
+        for n in group_parts:
+            trapezoids = _slab_trapezoids(parts[n], ys)
+            products = []
+            for t in zip(*trapezoids):
+                trapezoid = _trapezoid(ys, *t)
+                x_min, x_max = min(t[1], t[3]), max(t[2], t[4])
+                for piece, sign, p_min, p_max in union[t[0]]:
+                    if p_max <= x_min or p_min >= x_max:
+                        continue
+                    clipped = clip_polygon_convex(piece, trapezoid)
+                    if len(clipped) >= 3 and _signed_area(clipped) > 0:
+                        products.append((t[0], clipped, -sign))
+            for t in zip(*trapezoids):
+                union[t[0]].append((_trapezoid(ys, *t), 1.0, min(t[1], t[3]), max(t[2], t[4])))
+            for slab, piece, sign in products:
+                union[slab].append((piece, sign, piece[:, 0].min(), piece[:, 0].max()))
+                overlaps.append((np.vstack([piece, piece[:1]]), sign))
+    return records, overlaps
+
+def kml_polygon_shape(records, overlaps=None):
+    """Query shape for parsed polygons: a plain ring array when possible, else Rings"""
+    if len(records) == 1 and not records[0]['holes']:
+        return records[0]['outer']
+    return Rings.from_parts(((r['outer'], r['holes']) for r in records), overlaps)
+
+def parse_kml_polygon(kml_content, filename=''):
+    """
+    Parse a KML or KMZ upload into one query shape covering every polygon in it,
+    holes included. Accepts str, bytes or a binary file object. Repeated
+    polygons count once and overlapping ones are merged (see
+    merge_overlapping_parts).
+    """
     try:
-        # Simple regex approach to find coordinates as ET.fromstring is strict with namespaces
-        # This is more robust against different KML versions and namespaces
-        match = re.search(r'<coordinates>(.*?)</coordinates>', kml_content, re.DOTALL)
-        if not match:
-            # Try with namespace if regex fails or if there are multiple
-            try:
-                root = ET.fromstring(kml_content)
-                # Find all coordinates tags regardless of namespace
-                coords_elements = root.findall('.//{*}coordinates')
-                if not coords_elements:
-                    raise ValueError("No se encontró la etiqueta <coordinates> en el archivo KML")
-                coords_text = coords_elements[0].text
-            except Exception:
+        with stage('kml_parse'):
+            records = list(iter_kml_polygons(kml_content, filename))
+            if not records:
                 raise ValueError("No se pudo encontrar ninguna geometría válida en el archivo KML")
-        else:
-            coords_text = match.group(1)
-
-        if not coords_text or not coords_text.strip():
-            raise ValueError("La etiqueta <coordinates> está vacía")
-
-        coords = []
-        for coord in coords_text.strip().split():
-            # Handle both lon,lat and lon,lat,alt
-            parts = coord.split(',')
-            if len(parts) >= 2:
-                lon, lat = map(float, parts[:2])
-                coords.append((lon, lat))
-        
-        if len(coords) < 3:
-            raise ValueError(f"Se encontraron solo {len(coords)} puntos. Un polígono necesita al menos 3.")
-            
-        return np.array(coords)
+            records, overlaps = merge_overlapping_parts(records)
+        return kml_polygon_shape(records, overlaps)
     except Exception as e:
         print(f"Error parsing KML: {e}")
         raise ValueError(f"Error al procesar el archivo KML: {str(e)}")
 
-# 3. Parsear WKT de geometría WGS84 (soporta POLYGON y MULTIPOLYGON)
-def parse_wkt_polygon(wkt):
-    """Parse WKT polygon string and extract coordinates (handles POLYGON and MULTIPOLYGON)"""
-    if not wkt or pd.isna(wkt):
+# 2b. Parsear un lote: KML con varios Placemarks o ZIP/KMZ con varios KML
+def parse_kml_polygons(source, filename='', default_name='Polígono'):
+    """
+    Every polygon of a KML/KMZ/ZIP upload as a list of (name, shape) pairs;
+    placemarks holding several polygons get a numbered suffix.
+    """
+    polygons = []
+    try:
+        with stage('kml_parse'):
+            for record in iter_kml_polygons(source, filename, default_name):
+                if len(polygons) >= MAX_BATCH_POLYGONS:
+                    raise ValueError(f"El lote contiene más de {MAX_BATCH_POLYGONS} polígonos")
+                polygons.append((record['name'], kml_polygon_shape([record])))
+    except ValueError as e:
+        raise ValueError(f"Error al procesar el archivo KML: {str(e)}")
+    if not polygons:
+        raise ValueError("No se pudo encontrar ninguna geometría válida en el archivo KML")
+    return polygons
+
+def parse_kml_batch(content, filename=''):
+    """Parse an uploaded batch: a KML with many Placemarks, a KMZ or a ZIP of KML files"""
+    return parse_kml_polygons(content, filename)
+
+# 3. Parsear WKT de geometría WGS84 (POLYGON y MULTIPOLYGON con todos sus anillos)
+_WKT_PART_SPLIT = re.compile(r'\)\s*\)\s*,\s*\(\s*\(')
+_WKT_RING_SPLIT = re.compile(r'\)\s*,\s*\(')
+
+def _parse_wkt_ring(text):
+    """Parse 'x y [z ...], x y [z ...], ...' into an (n, 2) array"""
+    dims = len(text.split(',', 1)[0].split())
+    try:
+        values = np.array(text.replace(',', ' ').split(), dtype=float)
+        if dims >= 2 and len(values) % dims == 0:
+            return values.reshape(-1, dims)[:, :2]
+    except ValueError:
+        pass
+
+    # Slow path: skip malformed coordinate pairs one by one
+    coords = []
+    for pair in text.split(','):
+        try:
+            vals = list(map(float, pair.strip().lstrip('(').split()))
+            if len(vals) >= 2:
+                coords.append((vals[0], vals[1]))
+        except ValueError:
+            continue
+    return np.array(coords).reshape(-1, 2)
+
+def parse_wkt_parts(wkt):
+    """
+    Parse a WKT POLYGON or MULTIPOLYGON into every part and ring.
+    Returns a list of parts, each a list of (n, 2) rings with the outer ring
+    first and its holes after it, or None if nothing valid is found.
+    """
+    if not isinstance(wkt, str) or not wkt:
         return None
-    
-    # Handle MULTIPOLYGON - extract the first polygon
-    if wkt.startswith('MULTIPOLYGON'):
-        # Extract the first polygon from MULTIPOLYGON
-        match = re.search(r'MULTIPOLYGON\s*\(\s*\(\((.*?)\)\)', wkt, re.DOTALL)
-        if not match:
-            return None
-        coords_str = match.group(1).strip()
-    # Handle POLYGON
-    elif wkt.startswith('POLYGON'):
-        match = re.search(r'POLYGON\s*\(\((.*?)\)\)', wkt, re.DOTALL)
-        if not match:
-            return None
-        coords_str = match.group(1).strip()
-    else:
+    wkt = wkt.strip()
+    head = wkt[:12].upper()
+    if not (head.startswith('MULTIPOLYGON') or head.startswith('POLYGON')) or 'EMPTY' in wkt[:24].upper():
         return None
-    
-    coords = []
-    for part in coords_str.split(','):
-        part = part.strip()
-        if part:
-            # Remove any opening parentheses at the start
-            part = part.lstrip('(').strip()
-            try:
-                # Handle 2D or 3D coordinates (x y z ...)
-                vals = list(map(float, part.split()))
-                if len(vals) >= 2:
-                    coords.append((vals[0], vals[1]))
-            except (ValueError, IndexError):
-                # Skip malformed coordinate pairs
-                continue
-    
-    if len(coords) < 3:  # Need at least 3 points for a polygon
+
+    start = wkt.find('(')
+    end = wkt.rfind(')')
+    if start < 0 or end <= start:
         return None
-    
-    return np.array(coords)
+    body = wkt[start + 1:end].strip(' \t\r\n()')
+
+    # Parts are separated by ')), ((' (MULTIPOLYGON only) and rings by '), ('
+    part_texts = _WKT_PART_SPLIT.split(body) if head.startswith('MULTIPOLYGON') else [body]
+
+    parts = []
+    for part_text in part_texts:
+        rings = [_parse_wkt_ring(ring_text) for ring_text in _WKT_RING_SPLIT.split(part_text)]
+        # Need at least 3 points for a polygon; a part without outer ring is dropped
+        if len(rings[0]) < 3:
+            continue
+        parts.append([rings[0]] + [ring for ring in rings[1:] if len(ring) >= 3])
+    return parts or None
+
+def parse_wkt_polygon(wkt):
+    """
+    Parse WKT polygon string (POLYGON or MULTIPOLYGON, holes included).
+    Returns an (n, 2) array for a single ring, Rings for anything with
+    holes or several parts, or None if the geometry is not usable.
+    """
+    parts = parse_wkt_parts(wkt)
+    if parts is None:
+        return None
+    if len(parts) == 1 and len(parts[0]) == 1:
+        return parts[0][0]
+    return Rings.from_parts((part[0], part[1:]) for part in parts)
 
 # 3b. Calculate polygon area in square kilometers (using spherical approximation)
 def calculate_polygon_area(coords):
@@ -109,6 +560,9 @@ def calculate_polygon_area(coords):
     Calculate the area of a polygon in square kilometers using spherical geometry.
     Uses a method that accounts for the Earth's curvature.
     """
+    if isinstance(coords, Rings):
+        return sum(sign * calculate_polygon_area(ring) for ring, sign in coords.signed_rings())
+
     if len(coords) < 3:
         return 0.0
     
@@ -125,323 +579,2003 @@ def calculate_polygon_area(coords):
     lons = np.radians(coords_closed[:, 0])
     lats = np.radians(coords_closed[:, 1])
     
-    n = len(coords_closed) - 1
-    area = 0.0
-    
-    for i in range(n):
-        area += (lons[i + 1] - lons[i]) * (2 + np.sin(lats[i]) + np.sin(lats[i + 1]))
+    sin_lats = np.sin(lats)
+    area = np.sum(np.diff(lons) * (2 + sin_lats[:-1] + sin_lats[1:]))
     
-    area = abs(area * R * R / 2.0)
+    area = abs(float(area) * R * R / 2.0)
     
     return area
 
-# 4. Calcular población en intersección
-def calcular_poblacion_interseccion(kml_poly, pad_df, secc_df, n_points=None, join_key_geo='seccion_key', join_key_pop='Seccio_Censal'):
+# 3c. Área exacta de intersección (Sutherland–Hodgman sobre triángulos en abanico)
+INTERSECTION_METHODS = ('montecarlo', 'exact')
+
+def _signed_area(coords):
+    """Planar shoelace signed area (positive for counter-clockwise rings)"""
+    x = coords[:, 0]
+    y = coords[:, 1]
+    return 0.5 * float(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))
+
+def _clip_halfplane(pts, a, b):
+    """Keep the part of polygon pts on the left of the directed line a -> b"""
+    d = (b[0] - a[0]) * (pts[:, 1] - a[1]) - (b[1] - a[1]) * (pts[:, 0] - a[0])
+    inside = d >= 0
+    nxt = np.roll(pts, -1, axis=0)
+    d_next = np.roll(d, -1)
+    in_next = np.roll(inside, -1)
+    crossing = inside != in_next
+
+    t = np.zeros_like(d)
+    t[crossing] = d[crossing] / (d[crossing] - d_next[crossing])
+    inter = pts + t[:, None] * (nxt - pts)
+
+    # Per edge i -> i+1 emit [intersection if it crosses] + [next vertex if inside]
+    candidates = np.stack([inter, nxt], axis=1).reshape(-1, 2)
+    valid = np.stack([crossing, in_next], axis=1).ravel()
+    return candidates[valid]
+
+def clip_polygon_convex(subject, clip):
     """
-    Calculate population in the intersection of KML polygon with census zones
-    using dynamic Monte Carlo sampling based on the number of affected zones.
-    Note: join_key_geo can be a dict (the full city_config) for better flexibility.
+    Sutherland–Hodgman: clip any simple polygon against a convex polygon.
+    The clip polygon must be counter-clockwise. Returns the clipped vertices
+    (possibly empty); degenerate bridge edges do not affect the area.
     """
-    # Get bbox of KML polygon for filtering
-    min_lon, min_lat = kml_poly.min(axis=0)
-    max_lon, max_lat = kml_poly.max(axis=0)
-    
-    # Pass 1: Find truly intersecting zones and collect their data
-    intersecting_data = []
-    
-    # Get column name from config if available
-    col_geo = 'geometria_wgs84'
-    if isinstance(join_key_geo, dict): # Check if config was passed instead
-        config = join_key_geo
-        col_geo = config.get('col_geometry', 'geometria_wgs84')
-        join_key_geo = config['join_key_geo']
-        join_key_pop = config['join_key_pop']
-    
-    for _, row in secc_df.iterrows():
-        wkt = row[col_geo]
-        secc_poly = parse_wkt_polygon(wkt)
-        if secc_poly is None:
-            continue
-        
-        # Bbox of the census section
-        s_min_lon, s_min_lat = secc_poly.min(axis=0)
-        s_max_lon, s_max_lat = secc_poly.max(axis=0)
-        
-        # Check bbox overlap (fast filter)
-        if (s_max_lon < min_lon or s_min_lon > max_lon or
-            s_max_lat < min_lat or s_min_lat > max_lat):
-            continue
-        
-        # Quick check if truly intersects (using 100 points for reliability)
-        n_quick = 100
-        x_rand = np.random.uniform(max(s_min_lon, min_lon), min(s_max_lon, max_lon), n_quick)
-        y_rand = np.random.uniform(max(s_min_lat, min_lat), min(s_max_lat, max_lat), n_quick)
-        
-        # Check if any point is in both polygons
-        in_seccion = [point_in_polygon(x, y, secc_poly) for x, y in zip(x_rand, y_rand)]
-        
-        # Calculate intersection ratio for the quick check
-        n_in_secc = sum(in_seccion)
-        if n_in_secc == 0:
-            continue
-        
-        in_kml_count = sum(1 for i, in_s in enumerate(in_seccion) if in_s and point_in_polygon(x_rand[i], y_rand[i], kml_poly))
-        ratio = in_kml_count / n_in_secc
-        
-        # Only consider zones with at least 10% intersection in the quick check
-        if ratio >= 0.10:
-            seccion_key_val = row[join_key_geo]
-            pop_row = pad_df[pad_df[join_key_pop] == seccion_key_val]
-            if not pop_row.empty:
-                intersecting_data.append({
-                    'secc_poly': secc_poly,
-                    'population': pop_row['Valor'].values[0],
-                    'bbox': (s_min_lon, s_min_lat, s_max_lon, s_max_lat)
-                })
-    
-    num_zones = len(intersecting_data)
-    if num_zones == 0:
-        return 0
-    
-    # Determine n_points dynamically if not explicitly provided
-    if n_points is None:
-        if num_zones <= 10:
-            target_n_points = 10000
-        elif num_zones <= 50:
-            target_n_points = 5000
+    out = np.asarray(subject, dtype=float)
+    n = len(clip)
+    for i in range(n):
+        if len(out) == 0:
+            break
+        out = _clip_halfplane(out, clip[i], clip[(i + 1) % n])
+    return out
+
+def polygon_area(poly):
+    """Planar area of a ring array or Rings (outer rings minus holes)"""
+    return sum(sign * abs(_signed_area(ring)) for ring, sign in _as_rings(poly).signed_rings())
+
+def polygon_intersection_area(subject, clip_poly):
+    """
+    Exact planar area of subject ∩ clip_poly. Either side may be Rings: the
+    result is the signed sum over ring pairs (holes count negative).
+    """
+    if not isinstance(subject, Rings) and not isinstance(clip_poly, Rings):
+        return _ring_intersection_area(subject, clip_poly)
+    total = 0.0
+    clip_rings = _as_rings(clip_poly).signed_rings()
+    clip_bounds = _piece_bounds(clip_rings)
+    for s_ring, s_sign in _as_rings(subject).signed_rings():
+        s_ring = np.asarray(s_ring, dtype=float)
+        near = _boxes_overlap(clip_bounds, *s_ring.min(axis=0), *s_ring.max(axis=0))
+        for n in np.flatnonzero(near):
+            c_ring, c_sign = clip_rings[n]
+            total += s_sign * c_sign * _ring_intersection_area(s_ring, c_ring)
+    return max(total, 0.0)
+
+def _ring_intersection_area(subject, clip_poly):
+    """
+    Exact planar area of subject ∩ clip_poly for simple (possibly concave) polygons.
+    clip_poly is decomposed into a fan of signed triangles anchored at its first
+    vertex; their signed indicators add up to the polygon's, so clipping the
+    subject against each (convex) triangle and summing with signs is exact.
+    """
+    subject = np.asarray(subject, dtype=float)
+    clip_poly = np.asarray(clip_poly, dtype=float)
+    if len(subject) < 3 or len(clip_poly) < 3:
+        return 0.0
+
+    s_min = subject.min(axis=0)
+    s_max = subject.max(axis=0)
+
+    q0 = clip_poly[0]
+    qa = clip_poly[1:-1]
+    qb = clip_poly[2:]
+    signed = 0.5 * ((qa[:, 0] - q0[0]) * (qb[:, 1] - q0[1]) - (qa[:, 1] - q0[1]) * (qb[:, 0] - q0[0]))
+
+    # Skip degenerate triangles and those whose bbox misses the subject
+    t_min_x = np.minimum(np.minimum(qa[:, 0], qb[:, 0]), q0[0])
+    t_max_x = np.maximum(np.maximum(qa[:, 0], qb[:, 0]), q0[0])
+    t_min_y = np.minimum(np.minimum(qa[:, 1], qb[:, 1]), q0[1])
+    t_max_y = np.maximum(np.maximum(qa[:, 1], qb[:, 1]), q0[1])
+    candidates = np.nonzero(
+        (signed != 0) &
+        (t_max_x >= s_min[0]) & (t_min_x <= s_max[0]) &
+        (t_max_y >= s_min[1]) & (t_min_y <= s_max[1])
+    )[0]
+
+    total = 0.0
+    for i in candidates:
+        if signed[i] > 0:
+            tri = np.array([q0, qa[i], qb[i]])
         else:
-            target_n_points = 1000
-    else:
-        target_n_points = n_points
+            tri = np.array([q0, qb[i], qa[i]])
+        clipped = clip_polygon_convex(subject, tri)
+        if len(clipped) >= 3:
+            part = abs(_signed_area(clipped))
+            total += part if signed[i] > 0 else -part
+    # A clockwise clip polygon yields a negative sum of the same magnitude
+    return abs(total)
 
-    print(f"Intersects with {num_zones} zones. Using {target_n_points} Monte Carlo points.")
-    
-    # Pass 2: Precise Monte Carlo calculation for identified zones
-    total_pop = 0.0
-    for data in intersecting_data:
-        secc_poly = data['secc_poly']
-        poblacion = data['population']
-        s_min_lon, s_min_lat, s_max_lon, s_max_lat = data['bbox']
-        
-        # Generate random points in the sector's bbox
-        x_rand = np.random.uniform(s_min_lon, s_max_lon, target_n_points)
-        y_rand = np.random.uniform(s_min_lat, s_max_lat, target_n_points)
-        
-        # Count points in section
-        in_seccion_mask = np.array([point_in_polygon(x, y, secc_poly) for x, y in zip(x_rand, y_rand)])
-        n_in_seccion = np.sum(in_seccion_mask)
-        
-        if n_in_seccion == 0:
-            continue
-            
-        # Count points from those that are also in KML polygon
-        x_in_secc = x_rand[in_seccion_mask]
-        y_in_secc = y_rand[in_seccion_mask]
-        
-        in_kml_count = sum(1 for x, y in zip(x_in_secc, y_in_secc) if point_in_polygon(x, y, kml_poly))
-        
-        ratio = in_kml_count / n_in_seccion
-        
-        # Only add population if intersection is at least 10%
-        if ratio >= 0.10:
-            total_pop += poblacion * ratio
-    
-    return round(total_pop)
+def intersection_ratio(secc_poly, kml_poly):
+    """Exact fraction of the census polygon area that lies inside the KML polygon"""
+    secc_area = polygon_area(secc_poly)
+    if secc_area == 0:
+        return 0.0
+    ratio = polygon_intersection_area(secc_poly, kml_poly) / secc_area
+    return min(max(ratio, 0.0), 1.0)
 
-# 5. Convert census zones to GeoJSON for map display
-def get_census_zones_geojson(secc_df, pad_df, sample_size=None, city_config=None):
-    """Convert census zones to GeoJSON format for map visualization"""
-    features = []
-    
-    # Default Barcelona config if none provided
-    if city_config is None:
-        city_config = {
-            'join_key_geo': 'seccion_key',
-            'join_key_pop': 'Seccio_Censal',
-            'col_district': 'nom_districte',
-            'col_neighborhood': 'nom_barri',
-            'col_district_code': 'codi_districte',
-            'col_section_code': 'codi_seccio_censal',
-            'col_geometry': 'geometria_wgs84'
+# 3d. Almacén de geometría precompilado (se construye una vez al cargar cada ciudad)
+DEFAULT_CITY_CONFIG = {
+    'join_key_geo': 'seccion_key',
+    'join_key_pop': 'Seccio_Censal',
+    'col_district': 'nom_districte',
+    'col_neighborhood': 'nom_barri',
+    'col_district_code': 'codi_districte',
+    'col_section_code': 'codi_seccio_censal',
+    'col_geometry': 'geometria_wgs84'
+}
+
+def _boxes_overlap(boxes, min_x, min_y, max_x, max_y):
+    """Boolean mask of boxes (min_x, min_y, max_x, max_y) that overlap the query box"""
+    return (
+        (boxes[:, 2] >= min_x) & (boxes[:, 0] <= max_x) &
+        (boxes[:, 3] >= min_y) & (boxes[:, 1] <= max_y)
+    )
+
+def _expand_ranges(starts, counts):
+    """Concatenate arange(start, start + count) for every (start, count) pair"""
+    total = int(counts.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + (np.arange(total) - offsets)
+
+def _str_order(boxes, node_capacity):
+    """Sort-Tile-Recursive ordering: vertical slices by x centre, then y centre inside each slice"""
+    n = len(boxes)
+    cx = (boxes[:, 0] + boxes[:, 2]) / 2
+    cy = (boxes[:, 1] + boxes[:, 3]) / 2
+    n_nodes = -(-n // node_capacity)
+    slice_size = int(np.ceil(np.sqrt(n_nodes))) * node_capacity
+    slice_id = np.empty(n, dtype=np.int64)
+    slice_id[np.argsort(cx, kind='stable')] = np.arange(n) // slice_size
+    return np.lexsort((cy, slice_id))
+
+class STRTree:
+    """
+    Packed Sort-Tile-Recursive R-tree over axis-aligned boxes.
+    Built bottom-up once; every level is a flat array of node boxes plus the
+    contiguous range of children each node covers in the level below.
+    query() walks the levels top-down with vectorized overlap tests.
+    """
+
+    def __init__(self, boxes, node_capacity=32):
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        self.node_capacity = node_capacity
+        self.size = len(boxes)
+        self.levels = []
+        if self.size == 0:
+            self.items = np.empty(0, dtype=np.int64)
+            self.leaf_boxes = boxes
+            return
+
+        self.items = _str_order(boxes, node_capacity)
+        self.leaf_boxes = boxes[self.items]
+
+        entries = self.leaf_boxes
+        while True:
+            starts = np.arange(0, len(entries), node_capacity)
+            counts = np.minimum(node_capacity, len(entries) - starts)
+            node_boxes = np.column_stack([
+                np.minimum.reduceat(entries[:, 0], starts),
+                np.minimum.reduceat(entries[:, 1], starts),
+                np.maximum.reduceat(entries[:, 2], starts),
+                np.maximum.reduceat(entries[:, 3], starts),
+            ])
+            if len(node_boxes) > 1:
+                perm = _str_order(node_boxes, node_capacity)
+                node_boxes, starts, counts = node_boxes[perm], starts[perm], counts[perm]
+            self.levels.append((node_boxes, starts, counts))
+            if len(node_boxes) == 1:
+                break
+            entries = node_boxes
+
+    def __len__(self):
+        return self.size
+
+    def query(self, min_x, min_y, max_x, max_y):
+        """Indices of the boxes overlapping the query box, sorted ascending"""
+        if self.size == 0:
+            return np.empty(0, dtype=np.int64)
+
+        nodes = np.arange(len(self.levels[-1][0]))
+        for node_boxes, starts, counts in reversed(self.levels):
+            nodes = nodes[_boxes_overlap(node_boxes[nodes], min_x, min_y, max_x, max_y)]
+            nodes = _expand_ranges(starts[nodes], counts[nodes])
+
+        hits = nodes[_boxes_overlap(self.leaf_boxes[nodes], min_x, min_y, max_x, max_y)]
+        return np.sort(self.items[hits])
+
+class GeometryStore:
+    """
+    Packed census geometry for one city, aligned zone by zone.
+    Vertices of every ring live in a single (N, 2) array with three offset
+    levels: zone i owns parts geom_offsets[i]:geom_offsets[i + 1], part j owns
+    rings part_offsets[j]:part_offsets[j + 1] (outer ring first) and ring k
+    spans coords[ring_offsets[k]:ring_offsets[k + 1]]. rows holds the
+    positional row of each zone in geo_df; the display attributes are copied
+    into plain arrays so a store can be saved and loaded without pandas.
+    """
+
+    # Arrays written to / read from a columnar snapshot
+    ARRAY_FIELDS = (
+        'coords', 'ring_offsets', 'part_offsets', 'geom_offsets', 'rows', 'keys',
+        'population', 'has_population', 'bbox', 'area_km2',
+        'district', 'neighborhood', 'district_code', 'section_code', 'n_rows'
+    )
+
+    def __init__(self, coords, ring_offsets, part_offsets, geom_offsets, rows, keys, population, has_population,
+                 attributes=None, n_rows=None, bbox=None, area_km2=None):
+        self.coords = coords
+        self.ring_offsets = ring_offsets
+        self.part_offsets = part_offsets
+        self.geom_offsets = geom_offsets
+        self.rows = rows
+        self.keys = keys
+        self.population = population
+        self.has_population = has_population
+        self.n_rows = int(n_rows) if n_rows is not None else (int(rows[-1]) + 1 if len(rows) else 0)
+        self.index = None
+        self._triangles = {}
+
+        # Display attributes per zone: district, neighborhood, district_code, section_code
+        n = len(rows)
+        attributes = attributes or {}
+        self.district = attributes.get('district', np.full(n, ''))
+        self.neighborhood = attributes.get('neighborhood', np.full(n, ''))
+        self.district_code = attributes.get('district_code', np.zeros(n, dtype=np.int64))
+        self.section_code = attributes.get('section_code', np.zeros(n, dtype=np.int64))
+
+        # Ring k is a hole unless it is the first ring of its part
+        self.ring_is_hole = np.ones(len(ring_offsets) - 1, dtype=bool)
+        self.ring_is_hole[part_offsets[:-1]] = False
+        # Vertex range of each zone (its rings are contiguous)
+        self.offsets = ring_offsets[part_offsets[geom_offsets]]
+
+        # First zone per geometry key (LH maps two geometries onto barri 13)
+        self.zone_by_key = {}
+        for i, key in enumerate(keys):
+            self.zone_by_key.setdefault(key, i)
+
+        if bbox is not None and area_km2 is not None:
+            self.bbox = bbox
+            self.area_km2 = area_km2
+            return
+
+        self.bbox = np.empty((n, 4))
+        self.area_km2 = np.empty(n)
+        for i in range(n):
+            vertices = self.coords[self.offsets[i]:self.offsets[i + 1]]
+            self.bbox[i, :2] = vertices.min(axis=0)
+            self.bbox[i, 2:] = vertices.max(axis=0)
+            self.area_km2[i] = calculate_polygon_area(self.polygon(i))
+
+    def to_arrays(self):
+        """Plain NumPy arrays (no object dtype) for a columnar snapshot"""
+        arrays = {name: np.asarray(getattr(self, name)) for name in self.ARRAY_FIELDS}
+        # Keys come from CSV columns: keep them numeric when possible
+        arrays['keys'] = np.array(list(self.keys))
+        if arrays['keys'].dtype == object:
+            arrays['keys'] = arrays['keys'].astype(str)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Rebuild a store from snapshot arrays (memory-mapped arrays are used as-is)"""
+        return cls(
+            arrays['coords'], arrays['ring_offsets'], arrays['part_offsets'], arrays['geom_offsets'],
+            arrays['rows'], np.array(arrays['keys'].tolist(), dtype=object),
+            arrays['population'], arrays['has_population'],
+            attributes={name: arrays[name] for name in ('district', 'neighborhood', 'district_code', 'section_code')},
+            n_rows=arrays['n_rows'], bbox=arrays['bbox'], area_km2=arrays['area_km2']
+        )
+
+    def zone_properties(self, i):
+        """District, neighborhood and codes of zone i, as reported by the API"""
+        return {
+            'district': str(self.district[i]),
+            'neighborhood': str(self.neighborhood[i]),
+            'district_code': int(self.district_code[i]),
+            'section_code': int(self.section_code[i]),
         }
-    
+
+    def sample_zones(self, sample_size, random_state=42):
+        """
+        Zones of a reproducible random sample of geo_df rows, in sample order.
+        Same rows as geo_df.sample(sample_size, random_state=42).
+        """
+        sampled_rows = np.random.RandomState(random_state).choice(self.n_rows, min(sample_size, self.n_rows), replace=False)
+        zone_by_row = {int(row): i for i, row in enumerate(self.rows)}
+        return [zone_by_row[row] for row in sampled_rows.tolist() if row in zone_by_row]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def polygon(self, i):
+        """Zone i as an (n, 2) view when it is a single ring, else as Rings over views"""
+        r0 = self.part_offsets[self.geom_offsets[i]]
+        r1 = self.part_offsets[self.geom_offsets[i + 1]]
+        if r1 - r0 == 1:
+            return self.coords[self.ring_offsets[r0]:self.ring_offsets[r0 + 1]]
+        rings = [self.coords[self.ring_offsets[k]:self.ring_offsets[k + 1]] for k in range(r0, r1)]
+        return Rings(rings, self.ring_is_hole[r0:r1])
+
+    def triangles(self, i):
+        """
+        Triangulation of zone i's outer rings, built on first use: (triangles
+        (m, 3, 2), exact) where exact is False when holes (or a ring that could
+        not be fully ear-clipped) mean sampled points still need a section test.
+        """
+        if i not in self._triangles:
+            outers = [outer for outer, _ in _as_rings(self.polygon(i)).parts()]
+            pieces = [triangulate_ring(outer) for outer in outers]
+            triangles = np.concatenate([tri for tri, _ in pieces]) if pieces else np.empty((0, 3, 2))
+            exact = all(ok for _, ok in pieces) and not self.ring_is_hole[
+                self.part_offsets[self.geom_offsets[i]]:self.part_offsets[self.geom_offsets[i + 1]]
+            ].any()
+            self._triangles[i] = (triangles, exact)
+        return self._triangles[i]
+
+    def build_index(self, node_capacity=32):
+        """Build the STR R-tree over zone bboxes so bbox_candidates runs in sublinear time"""
+        self.index = STRTree(self.bbox, node_capacity=node_capacity)
+        return self.index
+
+    def bbox_candidates(self, min_lon, min_lat, max_lon, max_lat):
+        """Zone indices (in row order) whose bbox overlaps the given bbox"""
+        if self.index is not None:
+            return self.index.query(min_lon, min_lat, max_lon, max_lat)
+        return np.nonzero(_boxes_overlap(self.bbox, min_lon, min_lat, max_lon, max_lat))[0]
+
+
+def build_population_index(pad_df, join_key_pop='Seccio_Censal'):
+    """Hash index key -> population, keeping the first row per key as the old mask lookups did"""
+    index = {}
+    for key, value in zip(pad_df[join_key_pop].tolist(), pad_df['Valor'].tolist()):
+        index.setdefault(key, value)
+    return index
+
+def build_geometry_store(secc_df, pad_df, city_config=None, pop_index=None):
+    """Parse every WKT geometry once and pack it with its population into a GeometryStore"""
+    if city_config is None:
+        city_config = DEFAULT_CITY_CONFIG
     col_geo = city_config.get('col_geometry', 'geometria_wgs84')
 
-    # Sample if specified, otherwise use all zones
-    if sample_size and sample_size < len(secc_df):
-        df = secc_df.sample(min(sample_size, len(secc_df)), random_state=42)
-    else:
-        df = secc_df
-    
-    for idx, row in df.iterrows():
-        try:
-            wkt = row[col_geo]
-            if pd.isna(wkt) or not wkt:
-                continue
-                
-            poly = parse_wkt_polygon(wkt)
-            if poly is None or len(poly) == 0:
+    if pop_index is None:
+        pop_index = build_population_index(pad_df, city_config['join_key_pop'])
+
+    rings, rows, keys = [], [], []
+    part_offsets, geom_offsets = [0], [0]
+    with stage('wkt_parse'):
+        for pos, (wkt, key) in enumerate(zip(secc_df[col_geo], secc_df[city_config['join_key_geo']])):
+            parts = parse_wkt_parts(wkt)
+            if parts is None:
                 continue
-            
-            # Calculate area in square kilometers
-            area_km2 = calculate_polygon_area(poly)
-            
-            # Get population
-            seccion_key_val = row[city_config['join_key_geo']]
-            pop_row = pad_df[pad_df[city_config['join_key_pop']] == seccion_key_val]
-            population = int(pop_row['Valor'].values[0]) if not pop_row.empty else 0
-            
-            # Calculate density (people per square kilometer)
-            density = float(population / area_km2 if area_km2 > 0 else 0)
-            area_km2 = float(area_km2)
-            
-            coords = [[float(coord[0]), float(coord[1])] for coord in poly]
-            
-            # Handle possible missing columns in some datasets
-            dist_name = str(row.get(city_config['col_district'], ''))
-            neigh_name = str(row.get(city_config['col_neighborhood'], ''))
-            dist_code = row.get(city_config['col_district_code'], 0)
-            sect_code = row.get(city_config['col_section_code'], 0)
+            for part in parts:
+                rings.extend(part)
+                part_offsets.append(len(rings))
+            geom_offsets.append(len(part_offsets) - 1)
+            rows.append(pos)
+            keys.append(key)
 
-            # Safer conversion for codes that might be non-numeric (like 'BAR' in LH)
-            try:
-                dist_code_int = int(dist_code) if not pd.isna(dist_code) else 0
-            except (ValueError, TypeError):
-                dist_code_int = 0
-                
-            try:
-                sect_code_int = int(sect_code) if not pd.isna(sect_code) else 0
-            except (ValueError, TypeError):
-                sect_code_int = 0
+    ring_offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+    np.cumsum([len(r) for r in rings], out=ring_offsets[1:])
+    coords = np.concatenate(rings) if rings else np.empty((0, 2))
 
-            features.append({
-                'type': 'Feature',
-                'geometry': {
-                    'type': 'Polygon',
-                    'coordinates': [coords]
-                },
-                'properties': {
-                    'district': dist_name,
-                    'neighborhood': neigh_name,
-                    'district_code': dist_code_int,
-                    'section_code': sect_code_int,
-                    'population': int(population),
-                    'area_km2': round(area_km2, 4),
-                    'density': round(density, 2),
-                    'join_key': str(seccion_key_val)
-                }
-            })
-        except Exception as e:
-            # Skip problematic rows but continue processing
-            print(f"Warning: Skipping row {idx}: {e}")
-            continue
-    
-    return {
-        'type': 'FeatureCollection',
-        'features': features
+    # Display attributes, converted once (codes can be non-numeric, like 'BAR' in LH)
+    zone_rows = [secc_df.iloc[pos] for pos in rows]
+    attributes = {
+        'district': np.array([str(r.get(city_config['col_district'], '')) for r in zone_rows], dtype=str),
+        'neighborhood': np.array([str(r.get(city_config['col_neighborhood'], '')) for r in zone_rows], dtype=str),
+        'district_code': np.array([_safe_int(r.get(city_config['col_district_code'], 0)) for r in zone_rows], dtype=np.int64),
+        'section_code': np.array([_safe_int(r.get(city_config['col_section_code'], 0)) for r in zone_rows], dtype=np.int64),
     }
 
-# 6. Get zone statistics
-def get_zone_statistics(kml_poly, secc_df, pad_df, n_points=None, city_config=None):
-    """Get detailed statistics for a zone - only includes zones that actually intersect"""
-    # Default Barcelona config if none provided
-    if city_config is None:
-        city_config = {
-            'join_key_geo': 'seccion_key',
-            'join_key_pop': 'Seccio_Censal',
-            'col_district': 'nom_districte',
-            'col_neighborhood': 'nom_barri',
-            'col_district_code': 'codi_districte',
-            'col_section_code': 'codi_seccio_censal',
-            'col_geometry': 'geometria_wgs84'
-        }
+    pops = [pop_index.get(key) for key in keys]
+    has_population = np.array([p is not None for p in pops], dtype=bool)
+    population = np.array([p if p is not None else 0 for p in pops], dtype=float)
+    keys = np.array(keys, dtype=object)
 
-    col_geo = city_config.get('col_geometry', 'geometria_wgs84')
-    
-    # Get bbox of KML polygon
-    min_lon, min_lat = kml_poly.min(axis=0)
-    max_lon, max_lat = kml_poly.max(axis=0)
-    
-    intersecting_zones = []
-    
-    # Use same logic as calcular_poblacion_interseccion to find truly intersecting zones
-    for _, row in secc_df.iterrows():
-        wkt = row[col_geo]
-        secc_poly = parse_wkt_polygon(wkt)
-        if secc_poly is None:
+    return GeometryStore(
+        coords, ring_offsets, np.array(part_offsets, dtype=np.int64), np.array(geom_offsets, dtype=np.int64),
+        np.array(rows, dtype=np.int64), keys, population, has_population,
+        attributes=attributes, n_rows=len(secc_df)
+    )
+
+
+def _safe_int(value):
+    """Convert codes that might be non-numeric (like 'BAR' in LH) to int, defaulting to 0"""
+    try:
+        # NaN is the only value not equal to itself
+        return int(value) if value is not None and value == value else 0
+    except (ValueError, TypeError):
+        return 0
+
+# 3e. Estrategias de muestreo: secuencias de baja discrepancia, rejilla estratificada y triangulación
+SAMPLING_STRATEGIES = ('uniform', 'stratified', 'halton', 'sobol', 'triangulated')
+
+def _check_sampling(sampling):
+    if sampling not in SAMPLING_STRATEGIES:
+        raise ValueError(f"Estrategia de muestreo desconocida: {sampling}. Usa una de {SAMPLING_STRATEGIES}")
+
+def triangulate_ring(ring):
+    """
+    Ear-clipping triangulation of a simple ring. Returns (triangles (m, 3, 2),
+    complete); if no ear is left (self-touching ring) the rest is fanned and
+    complete is False.
+    """
+    pts = np.asarray(ring, dtype=float)
+    if len(pts) > 1 and (pts[0] == pts[-1]).all():
+        pts = pts[:-1]
+    if len(pts) < 3:
+        return np.empty((0, 3, 2)), True
+    if _signed_area(pts) < 0:
+        pts = pts[::-1]
+
+    def cross(a, b, c):
+        return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+
+    idx = list(range(len(pts)))
+    triangles = []
+    k = 0
+    misses = 0
+    while len(idx) > 3 and misses < len(idx):
+        m = len(idx)
+        a, b, c = pts[idx[(k - 1) % m]], pts[idx[k % m]], pts[idx[(k + 1) % m]]
+        turn = cross(a, b, c)
+        if turn == 0:
+            # Collinear vertex or spike: dropping it changes no area
+            del idx[k % m]
+            misses = 0
             continue
-        
-        # Bbox of the section
-        s_min_lon, s_min_lat = secc_poly.min(axis=0)
-        s_max_lon, s_max_lat = secc_poly.max(axis=0)
-        
-        # If no bbox overlap, skip
-        if (s_max_lon < min_lon or s_min_lon > max_lon or
-            s_max_lat < min_lat or s_min_lat > max_lat):
+        if turn > 0:
+            # Ear if no other vertex lies strictly inside a, b, c
+            others = pts[[j for n, j in enumerate(idx) if n not in ((k - 1) % m, k % m, (k + 1) % m)]]
+            if len(others):
+                d1 = (b[0] - a[0]) * (others[:, 1] - a[1]) - (b[1] - a[1]) * (others[:, 0] - a[0])
+                d2 = (c[0] - b[0]) * (others[:, 1] - b[1]) - (c[1] - b[1]) * (others[:, 0] - b[0])
+                d3 = (a[0] - c[0]) * (others[:, 1] - c[1]) - (a[1] - c[1]) * (others[:, 0] - c[0])
+                blocked = ((d1 > 0) & (d2 > 0) & (d3 > 0)).any()
+            else:
+                blocked = False
+            if not blocked:
+                triangles.append((a, b, c))
+                del idx[k % m]
+                misses = 0
+                continue
+        k += 1
+        misses += 1
+
+    complete = len(idx) <= 3
+    for n in range(1, len(idx) - 1):
+        tri = (pts[idx[0]], pts[idx[n]], pts[idx[n + 1]])
+        if cross(*tri) > 0:
+            triangles.append(tri)
+    return np.array(triangles, dtype=float).reshape(-1, 3, 2), complete
+
+def _radical_inverse(indices, base):
+    """Van der Corput radical inverse of integer indices in the given base"""
+    out = np.zeros(len(indices))
+    i = indices.copy()
+    f = 1.0 / base
+    while i.any():
+        out += f * (i % base)
+        i //= base
+        f /= base
+    return out
+
+# 2-D Sobol direction numbers (32 bits): van der Corput, then the primitive polynomial x + 1
+_SOBOL_BITS = 32
+_SOBOL_DIRECTIONS = np.zeros((2, _SOBOL_BITS), dtype=np.uint64)
+_m = 1
+for _k in range(_SOBOL_BITS):
+    _SOBOL_DIRECTIONS[0, _k] = 1 << (_SOBOL_BITS - 1 - _k)
+    _SOBOL_DIRECTIONS[1, _k] = _m << (_SOBOL_BITS - 1 - _k)
+    _m = (_m << 1) ^ _m
+del _m, _k
+
+def _sobol(start, n):
+    """
+    Points start..start+n-1 of the 2-D Sobol sequence (Gray-code order) as
+    uint32 grid values: each point is the previous one XOR a single direction
+    number, so the whole run is one cumulative XOR.
+    """
+    gray = start ^ (start >> 1)
+    first = np.zeros(2, dtype=np.uint64)
+    for bit in range(_SOBOL_BITS):
+        if (gray >> bit) & 1:
+            first ^= _SOBOL_DIRECTIONS[:, bit]
+    indices = np.arange(start + 1, start + n, dtype=np.uint64)
+    # Position of the lowest set bit of each index picks its direction number
+    lowest = np.log2((indices & (~indices + np.uint64(1))).astype(float)).astype(np.int64)
+    return np.bitwise_xor.accumulate(np.vstack([first, _SOBOL_DIRECTIONS.T[lowest]]), axis=0)
+
+def unit_sampler(sampling, rng):
+    """
+    draw(start, n) -> (n, 2) points in the unit square for one zone. start is
+    the running index, so target-precision batches continue the same sequence.
+    Low-discrepancy sequences are randomized once per zone (random shift for
+    Halton, digital shift for Sobol), which keeps every point uniform and the
+    estimate unbiased.
+    """
+    if sampling == 'halton':
+        shift = rng.random(2)
+
+        def draw(start, n):
+            indices = np.arange(start + 1, start + n + 1)
+            return (np.column_stack([_radical_inverse(indices, 2), _radical_inverse(indices, 3)]) + shift) % 1.0
+    elif sampling in ('sobol', 'triangulated'):
+        shift = rng.integers(0, 2 ** _SOBOL_BITS, 2, dtype=np.uint64)
+
+        def draw(start, n):
+            return (_sobol(start, n) ^ shift).astype(float) / 2.0 ** _SOBOL_BITS
+    elif sampling == 'stratified':
+        def draw(start, n):
+            # Jittered g x g grid; a random subset of cells when n is not a square
+            g = int(math.ceil(math.sqrt(n)))
+            cells = rng.permutation(g * g)[:n]
+            return (np.column_stack([cells % g, cells // g]) + rng.random((n, 2))) / g
+    else:
+        def draw(start, n):
+            return rng.random((n, 2))
+    return draw
+
+def _triangle_points(triangles, unit):
+    """
+    Map unit-square points onto triangles uniformly by area: the first
+    coordinate picks the triangle (inverse CDF) and is reused inside it, so
+    low-discrepancy structure carries over.
+    """
+    a = triangles[:, 0]
+    ab = triangles[:, 1] - a
+    ac = triangles[:, 2] - a
+    areas = 0.5 * np.abs(ab[:, 0] * ac[:, 1] - ab[:, 1] * ac[:, 0])
+    cdf = np.cumsum(areas)
+    u = unit[:, 0] * cdf[-1]
+    t = np.minimum(np.searchsorted(cdf, u, side='right'), len(triangles) - 1)
+    u = np.clip((u - (cdf[t] - areas[t])) / np.where(areas[t] > 0, areas[t], 1.0), 0.0, 1.0)
+    s = np.sqrt(u)[:, None]
+    v = unit[:, 1][:, None]
+    return a[t] + s * (1 - v) * ab[t] + s * v * ac[t]
+
+def _zone_sample(store, i, sampler, sampling, start, n):
+    """
+    n sample points for zone i and the mask of those inside the section.
+    Bbox strategies need the section test; triangulated points already lie in
+    the section unless it has holes.
+    """
+    unit = sampler(start, n)
+    if sampling == 'triangulated':
+        triangles, exact = store.triangles(i)
+        if len(triangles):
+            pts = _triangle_points(triangles, unit)
+            xs, ys = pts[:, 0], pts[:, 1]
+            if exact:
+                return xs, ys, np.ones(n, dtype=bool)
+            return xs, ys, points_in_polygon(xs, ys, store.polygon(i))
+    s_min_lon, s_min_lat, s_max_lon, s_max_lat = store.bbox[i]
+    xs = s_min_lon + unit[:, 0] * (s_max_lon - s_min_lon)
+    ys = s_min_lat + unit[:, 1] * (s_max_lat - s_min_lat)
+    return xs, ys, points_in_polygon(xs, ys, store.polygon(i))
+
+# 4. Calcular población en intersección
+CONFIDENCE_Z = 1.96  # 95% intervals
+MAX_TARGET_POINTS = 200_000  # per-zone cap in target-precision mode
+# Default Monte Carlo points per zone: (up to this many intersecting zones, points), then MIN_POINTS
+MONTE_CARLO_TIERS = ((10, 10000), (50, 5000))
+MONTE_CARLO_MIN_POINTS = 1000
+MIN_ZONE_RATIO = 0.10  # zones covered less than this add no population
+
+def _as_generator(rng):
+    """numpy Generator from a Generator, a seed (int or SeedSequence) or None (fresh entropy)"""
+    if isinstance(rng, np.random.Generator):
+        return rng
+    return np.random.default_rng(rng)
+
+def _root_seed(rng):
+    """
+    Integer root seed for one estimate. Every zone draws from its own stream
+    derived from (root, pass, zone), so results do not depend on zone order,
+    chunking or the number of pool workers.
+    """
+    if isinstance(rng, (int, np.integer)):
+        return int(rng)
+    return int(_as_generator(rng).integers(2 ** 63))
+
+def _zone_rng(root_seed, stage, zone):
+    return np.random.default_rng([root_seed, stage, int(zone)])
+
+def ratio_interval(hits, n):
+    """
+    Standard error and 95% Wilson interval of the fraction hits / n.
+    The standard error uses the (hits + 1) / (n + 2) estimate so a zone
+    entirely inside or outside is not reported as exact.
+    """
+    if n <= 0:
+        return 0.0, 0.0, 1.0
+    smoothed = (hits + 1) / (n + 2)
+    std_error = math.sqrt(smoothed * (1 - smoothed) / n)
+    p = hits / n
+    z2 = CONFIDENCE_Z ** 2
+    center = (p + z2 / (2 * n)) / (1 + z2 / n)
+    half = CONFIDENCE_Z * math.sqrt(p * (1 - p) / n + z2 / (4 * n * n)) / (1 + z2 / n)
+    return std_error, max(0.0, center - half), min(1.0, center + half)
+
+ZONE_INSIDE, ZONE_OUTSIDE, ZONE_BOUNDARY = 'inside', 'outside', 'boundary'
+
+def _polygon_edges(poly):
+    """(starts, ends) of every non-degenerate edge of a ring array or Rings"""
+    rings = [np.asarray(ring, dtype=float) for ring in _as_rings(poly).rings]
+    starts = np.concatenate(rings)
+    ends = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+    keep = np.any(starts != ends, axis=1)
+    return starts[keep], ends[keep]
+
+def _edges_touch(a1, a2, b1, b2):
+    """True if any edge a1 -> a2 crosses or touches any edge b1 -> b2 (collinear overlaps count)"""
+    def orient(p, q, r):
+        return (q[..., 0] - p[..., 0]) * (r[..., 1] - p[..., 1]) - (q[..., 1] - p[..., 1]) * (r[..., 0] - p[..., 0])
+
+    a_min = np.minimum(a1, a2)
+    a_max = np.maximum(a1, a2)
+    block = max(1, _PIP_BLOCK_ELEMENTS // max(len(a1), 1))
+    for start in range(0, len(b1), block):
+        p, q = b1[start:start + block][None], b2[start:start + block][None]
+        r, t = a1[:, None], a2[:, None]
+        touch = (
+            (orient(r, t, p) * orient(r, t, q) <= 0) & (orient(p, q, r) * orient(p, q, t) <= 0) &
+            # Bbox overlap rules out collinear segments that do not meet
+            (a_max[:, None, 0] >= np.minimum(p[..., 0], q[..., 0])) & (a_min[:, None, 0] <= np.maximum(p[..., 0], q[..., 0])) &
+            (a_max[:, None, 1] >= np.minimum(p[..., 1], q[..., 1])) & (a_min[:, None, 1] <= np.maximum(p[..., 1], q[..., 1]))
+        )
+        if touch.any():
+            return True
+    return False
+
+def classify_zone(kml_poly, store, i, kml_edges=None):
+    """
+    ZONE_INSIDE if zone i lies entirely inside the KML polygon, ZONE_OUTSIDE if
+    they do not overlap, else ZONE_BOUNDARY. Without any edge contact each
+    boundary lies wholly inside or outside the other polygon, so testing the
+    vertices of both decides; touching or shared edges count as boundary.
+    """
+    if kml_edges is None:
+        kml_edges = _polygon_edges(kml_poly)
+    k1, k2 = kml_edges
+    s_min_lon, s_min_lat, s_max_lon, s_max_lat = store.bbox[i]
+    zone_poly = store.polygon(i)
+
+    # Only KML edges whose bbox reaches the zone can touch it
+    near = (
+        (np.maximum(k1[:, 0], k2[:, 0]) >= s_min_lon) & (np.minimum(k1[:, 0], k2[:, 0]) <= s_max_lon) &
+        (np.maximum(k1[:, 1], k2[:, 1]) >= s_min_lat) & (np.minimum(k1[:, 1], k2[:, 1]) <= s_max_lat)
+    )
+    if near.any() and _edges_touch(*_polygon_edges(zone_poly), k1[near], k2[near]):
+        return ZONE_BOUNDARY
+
+    vertices = store.coords[store.offsets[i]:store.offsets[i + 1]]
+    in_kml = points_in_polygon(vertices[:, 0], vertices[:, 1], kml_poly)
+    if in_kml.any() and not in_kml.all():
+        # Parts of a multi-part zone on both sides
+        return ZONE_BOUNDARY
+    # A KML ring (a hole or another part) inside the zone
+    if near.any() and points_in_polygon(k1[near, 0], k1[near, 1], zone_poly).any():
+        return ZONE_BOUNDARY
+    return ZONE_INSIDE if in_kml.all() else ZONE_OUTSIDE
+
+def _screen_zones(kml_poly, store, zones, method='montecarlo', root_seed=0):
+    """
+    Pass 1 over the given candidate zones: keep every zone that touches the
+    KML, whatever its population or share. Zones entirely inside count in
+    full ({'inside': True}, nothing to sample) and zones entirely outside are
+    dropped. Boundary zones get their exact ratio, or a 100-point Monte Carlo
+    estimate that only sets the sampling tier (see _n_contributing).
+    Returns [{'zone': i, 'ratio': r}] in order.
+    """
+    min_lon, min_lat, max_lon, max_lat = polygon_bounds(kml_poly)
+    kml_edges = _polygon_edges(kml_poly)
+
+    screened = []
+    for i in zones:
+        position = classify_zone(kml_poly, store, i, kml_edges)
+        if position == ZONE_OUTSIDE:
             continue
-        
-        seccion_key_val = row[city_config['join_key_geo']]
-        pop_row = pad_df[pad_df[city_config['join_key_pop']] == seccion_key_val]
-        if pop_row.empty:
+        if position == ZONE_INSIDE:
+            screened.append({'zone': int(i), 'ratio': 1.0, 'inside': True})
             continue
         
-        poblacion = pop_row['Valor'].values[0]
+        secc_poly = store.polygon(i)
+        s_min_lon, s_min_lat, s_max_lon, s_max_lat = store.bbox[i]
         
-        # Quick check with Monte Carlo to see if they actually intersect
-        calc_n_points = n_points if n_points is not None else 10000
-        n_quick = min(calc_n_points // 10, 1000)  # Use 10% of points or max 1000
-        x_rand = np.random.uniform(max(s_min_lon, min_lon), min(s_max_lon, max_lon), n_quick)
-        y_rand = np.random.uniform(max(s_min_lat, min_lat), min(s_max_lat, max_lat), n_quick)
+        if method == 'exact':
+            ratio = intersection_ratio(secc_poly, kml_poly)
+            # Zones that only share an edge or a vertex
+            if ratio <= 0:
+                continue
+        else:
+            # Quick check if truly intersects (using 100 points for reliability)
+            n_quick = 100
+            rng = _zone_rng(root_seed, 0, i)
+            x_rand = rng.uniform(max(s_min_lon, min_lon), min(s_max_lon, max_lon), n_quick)
+            y_rand = rng.uniform(max(s_min_lat, min_lat), min(s_max_lat, max_lat), n_quick)
+            
+            # Check if any point is in both polygons
+            in_seccion = points_in_polygon(x_rand, y_rand, secc_poly)
+            
+            # Calculate intersection ratio for the quick check (refinement decides the final one)
+            n_in_secc = np.count_nonzero(in_seccion)
+            in_kml_count = np.count_nonzero(points_in_polygon(x_rand[in_seccion], y_rand[in_seccion], kml_poly))
+            ratio = in_kml_count / n_in_secc if n_in_secc else 0.0
         
-        in_seccion = np.array([
-            point_in_polygon(x, y, secc_poly) for x, y in zip(x_rand, y_rand)
-        ])
-        n_in_seccion = np.sum(in_seccion)
-        if n_in_seccion == 0:
+        screened.append({'zone': int(i), 'ratio': ratio})
+    return screened
+
+def _n_contributing(store, screened, min_ratio=MIN_ZONE_RATIO):
+    """
+    Screened zones expected to add population (populated, quick ratio at
+    least min_ratio). Their number picks the Monte Carlo tier, so zones the
+    KML barely touches do not lower the points spent on the others.
+    """
+    return sum(1 for data in screened if store.has_population[data['zone']] and data['ratio'] >= min_ratio)
+
+def _target_n_points(num_zones, n_points=None, tiers=MONTE_CARLO_TIERS, min_points=MONTE_CARLO_MIN_POINTS):
+    """Monte Carlo points per zone: explicit n_points, or fewer the more zones intersect"""
+    if n_points is not None:
+        return n_points
+    for max_zones, points in tiers:
+        if num_zones <= max_zones:
+            return points
+    return min_points
+
+def _ratio_se_target(store, screened, target_error):
+    """
+    Per-zone standard error of the ratio that keeps the total's 95% half-width
+    within target_error (people): zone errors add in quadrature, so
+    se_i <= target / (z * ||population||) for every zone is sufficient.
+    """
+    if target_error is None or not screened:
+        return None
+    # Zones inside the KML are exact and take none of the budget
+    norm = math.sqrt(sum(float(store.population[data['zone']]) ** 2 for data in screened if not data.get('inside')))
+    return target_error / (CONFIDENCE_Z * norm) if norm > 0 else None
+
+def _refine_zones(kml_poly, store, screened, target_n_points, root_seed=0, ratio_se_target=None, sampling='uniform'):
+    """
+    Pass 2: precise Monte Carlo ratio for every screened zone, with points
+    drawn by the given sampling strategy. Ratios are kept raw, down to zero
+    hits; the population estimate applies the cut-off. With ratio_se_target, each zone keeps
+    drawing batches of target_n_points until its standard error is within the
+    target (or MAX_TARGET_POINTS is reached), so sampling concentrates on the
+    zones the KML boundary actually cuts.
+    """
+    results = []
+    for data in screened:
+        i = data['zone']
+        if data.get('inside'):
+            results.append(data)
             continue
+        rng = _zone_rng(root_seed, 1, i)
+        sampler = unit_sampler(sampling, rng)
         
-        # Check if any of those points are in the KML polygon
-        in_kml = np.array([
-            point_in_polygon(x, y, kml_poly) for x, y in zip(x_rand[in_seccion], y_rand[in_seccion])
-        ])
-        n_in_interseccion = np.sum(in_kml)
+        n_in_seccion = 0
+        in_kml_count = 0
+        drawn = 0
+        while True:
+            # Sample points for the section and count those inside it
+            x_rand, y_rand, in_seccion_mask = _zone_sample(store, i, sampler, sampling, drawn, target_n_points)
+            drawn += target_n_points
+            n_in_seccion += np.count_nonzero(in_seccion_mask)
+            
+            # Count points from those that are also in KML polygon
+            in_kml_count += np.count_nonzero(points_in_polygon(x_rand[in_seccion_mask], y_rand[in_seccion_mask], kml_poly))
+            
+            if ratio_se_target is None or drawn >= MAX_TARGET_POINTS:
+                break
+            if n_in_seccion and ratio_interval(in_kml_count, n_in_seccion)[0] <= ratio_se_target:
+                break
         
-        ratio = n_in_interseccion / n_in_seccion if n_in_seccion > 0 else 0
+        if n_in_seccion == 0:
+            continue
         
-        # Use 10% threshold (0.10) to filter out zones that barely touch the KML
-        if ratio >= 0.10:
-            dist_code = row.get(city_config['col_district_code'], 0)
-            sect_code = row.get(city_config['col_section_code'], 0)
-            
-            try:
-                dist_code_int = int(dist_code) if not pd.isna(dist_code) else 0
-            except (ValueError, TypeError):
-                dist_code_int = 0
-                
-            try:
-                sect_code_int = int(sect_code) if not pd.isna(sect_code) else 0
-            except (ValueError, TypeError):
-                sect_code_int = 0
-
-            intersecting_zones.append({
-                'district': str(row.get(city_config['col_district'], '')),
-                'neighborhood': str(row.get(city_config['col_neighborhood'], '')),
-                'district_code': dist_code_int,
-                'section_code': sect_code_int,
-                'population': int(poblacion),
-                'join_key': str(seccion_key_val)
-            })
+        ratio = in_kml_count / n_in_seccion
+        results.append({'zone': i, 'ratio': ratio, 'hits': int(in_kml_count), 'n': int(n_in_seccion)})
+    return results
+
+def _candidate_zones(kml_poly, store):
+    """Zones whose bbox overlaps the KML polygon's bbox"""
+    min_lon, min_lat, max_lon, max_lat = polygon_bounds(kml_poly)
+    return store.bbox_candidates(min_lon, min_lat, max_lon, max_lat)
+
+def _check_method(method):
+    if method not in INTERSECTION_METHODS:
+        raise ValueError(f"Unknown intersection method '{method}'. Use one of {INTERSECTION_METHODS}")
+
+def _intersect_zones(kml_poly, store, n_points=None, method='montecarlo', rng=None, target_error=None, sampling='uniform'):
+    """
+    Core single pass over the candidate zones of a store.
+    Returns a list of {'zone': index, 'ratio': fraction inside the KML} for every
+    zone the KML touches, in row order, with or without population; the
+    estimators apply the 10% cut-off (_counted_zones). Monte Carlo entries also
+    carry the sample counts ('hits', 'n') behind the ratio.
+    """
+    _check_method(method)
+    _check_sampling(sampling)
+    root_seed = _root_seed(rng)
+
+    with stage('candidates'):
+        candidates = _candidate_zones(kml_poly, store)
+    with stage('screen'):
+        screened = _screen_zones(kml_poly, store, candidates, method, root_seed)
     
-    # Calculate total population using the full calculation
-    total_pop = calcular_poblacion_interseccion(
-        kml_poly, pad_df, secc_df, n_points=n_points, 
-        join_key_geo=city_config
-    )
+    # Exact ratios are final: no second pass needed
+    if not screened or method == 'exact':
+        return screened
     
-    return {
-        'total_population': total_pop,
+    target_n_points = _target_n_points(_n_contributing(store, screened), n_points)
+    with stage('montecarlo'):
+        return _refine_zones(
+            kml_poly, store, screened, target_n_points, root_seed,
+            _ratio_se_target(store, screened, target_error), sampling
+        )
+
+def _counted_zones(zone_results, store, min_ratio=MIN_ZONE_RATIO):
+    """Zone results that add population: populated zones covered at least min_ratio"""
+    return [data for data in zone_results if store.has_population[data['zone']] and data['ratio'] >= min_ratio]
+
+def _cutoff_bound(zone_results, store, min_ratio=MIN_ZONE_RATIO):
+    """
+    Most population (95% upper bound of each ratio) the populated zones under
+    the min_ratio cut-off could hold inside the KML. The estimate leaves them
+    out, so the total's interval is widened upwards by this much.
+    """
+    bound = 0.0
+    for data in zone_results:
+        i = data['zone']
+        if not store.has_population[i] or data['ratio'] >= min_ratio:
+            continue
+        high = ratio_interval(data['hits'], data['n'])[2] if 'n' in data else data['ratio']
+        bound += float(store.population[i]) * high
+    return bound
+
+def _zone_breakdown(zone_results, store, min_ratio=MIN_ZONE_RATIO):
+    """Turn [{'zone', 'ratio'}] results into the total plus per-zone statistics"""
+    intersecting_zones = []
+    total_pop = 0.0
+    total_variance = 0.0
+    for data in _counted_zones(zone_results, store, min_ratio):
+        i = data['zone']
+        poblacion = store.population[i]
+        estimated = poblacion * data['ratio']
+        total_pop += estimated
+
+        # Exact ratios carry no sampling error
+        if 'n' in data:
+            std_error, low, high = ratio_interval(data['hits'], data['n'])
+        else:
+            std_error, low, high = 0.0, data['ratio'], data['ratio']
+        total_variance += (poblacion * std_error) ** 2
+
+        intersecting_zones.append({
+            **store.zone_properties(i),
+            'population': int(poblacion),
+            'join_key': str(store.keys[i]),
+            'ratio': round(float(data['ratio']), 4),
+            'estimated_population': round(float(estimated), 1),
+            'std_error': round(float(poblacion * std_error), 1),
+            'ci_95': [round(float(poblacion * low), 1), round(float(poblacion * high), 1)]
+        })
+
+    return _with_total_error({
+        'total_population': round(total_pop),
         'intersecting_zones': intersecting_zones,
         'num_zones': len(intersecting_zones)
+    }, total_variance, _cutoff_bound(zone_results, store, min_ratio))
+
+def _with_total_error(stats, variance, cutoff_bound=0.0):
+    """
+    Add the total's standard error and 95% interval: normal, as zone errors
+    are independent, with the upper end raised by cutoff_bound (population
+    the zones under the 10% cut-off may add; reported as cutoff_bound).
+    """
+    std_error = math.sqrt(variance)
+    stats['std_error'] = round(std_error, 1)
+    stats['cutoff_bound'] = round(cutoff_bound, 1)
+    stats['ci_95'] = [
+        round(max(0.0, stats['total_population'] - CONFIDENCE_Z * std_error), 1),
+        round(stats['total_population'] + CONFIDENCE_Z * std_error + cutoff_bound, 1)
+    ]
+    return stats
+
+def estimate_intersection(kml_poly, secc_df, pad_df, n_points=None, city_config=None, method='montecarlo', store=None,
+                          rng=None, target_error=None, sampling='uniform', cube=None, demographics=None):
+    """
+    Single-pass engine: candidate search, intersection test and population
+    estimate for one city. Returns the total together with the per-zone
+    breakdown, each zone carrying its ratio, estimated population, standard
+    error and 95% interval. rng (Generator or seed) makes the estimate
+    reproducible; target_error (people) keeps sampling the uncertain zones
+    until the total's 95% half-width is within it. sampling picks how points
+    are drawn (one of SAMPLING_STRATEGIES). With a PopulationCube and a
+    demographics filter dict the result also carries the filtered breakdown.
+    """
+    # Default Barcelona config if none provided
+    if city_config is None:
+        city_config = DEFAULT_CITY_CONFIG
+
+    if store is None:
+        store = build_geometry_store(secc_df, pad_df, city_config)
+
+    zone_results = _intersect_zones(
+        kml_poly, store, n_points=n_points, method=method, rng=rng, target_error=target_error, sampling=sampling
+    )
+    stats = _zone_breakdown(zone_results, store)
+    if cube is not None and demographics is not None:
+        stats['demographics'] = _cube_breakdown(cube, store, zone_results, demographics)
+    return stats
+
+def _cube_breakdown(cube, store, zone_results, demographics):
+    counted = _counted_zones(zone_results, store)
+    return population_cube_query(
+        cube, [data['zone'] for data in counted], [data['ratio'] for data in counted], **demographics
+    )
+
+def calcular_poblacion_interseccion(kml_poly, pad_df, secc_df, n_points=None, join_key_geo='seccion_key', join_key_pop='Seccio_Censal', method='montecarlo', store=None,
+                                    rng=None, target_error=None, sampling='uniform'):
+    """
+    Calculate population in the intersection of KML polygon with census zones
+    using dynamic Monte Carlo sampling based on the number of affected zones.
+    With method='exact' each zone's share comes from the clipped polygon area
+    instead, which is deterministic and needs no sampling.
+    Pass the city's prebuilt GeometryStore as store to skip WKT parsing.
+    Pass rng (a numpy Generator or a seed) for a reproducible result and
+    target_error to sample until the 95% half-width is within that many people.
+    sampling selects the point strategy: 'uniform' (default), 'stratified',
+    'halton', 'sobol' or 'triangulated' (points only inside the section).
+    Note: join_key_geo can be a dict (the full city_config) for better flexibility.
+    """
+    if store is None:
+        if isinstance(join_key_geo, dict): # Check if config was passed instead
+            config = join_key_geo
+        else:
+            config = dict(DEFAULT_CITY_CONFIG, join_key_geo=join_key_geo, join_key_pop=join_key_pop)
+        store = build_geometry_store(secc_df, pad_df, config)
+
+    zones = _intersect_zones(
+        kml_poly, store, n_points=n_points, method=method, rng=rng, target_error=target_error, sampling=sampling
+    )
+    return round(sum(store.population[data['zone']] * data['ratio'] for data in _counted_zones(zones, store)))
+
+# 5. Convert census zones to GeoJSON for map display
+def zone_feature_properties(store, i):
+    """Properties of zone i as shown on the map: names, codes, population, area and density"""
+    # Area in square kilometers, precomputed in the store
+    area_km2 = float(store.area_km2[i])
+    
+    # Get population
+    seccion_key_val = store.keys[i]
+    population = int(store.population[i])
+    
+    # Calculate density (people per square kilometer)
+    density = float(population / area_km2 if area_km2 > 0 else 0)
+    
+    return {
+        **store.zone_properties(i),
+        'population': population,
+        'area_km2': round(area_km2, 4),
+        'density': round(density, 2),
+        'join_key': str(seccion_key_val)
     }
 
+def get_census_zones_geojson(secc_df, pad_df, sample_size=None, city_config=None, store=None):
+    """Convert census zones to GeoJSON format for map visualization"""
+    features = []
+    
+    # Default Barcelona config if none provided
+    if city_config is None:
+        city_config = DEFAULT_CITY_CONFIG
+    
+    if store is None:
+        store = build_geometry_store(secc_df, pad_df, city_config)
+
+    # Sample if specified, otherwise use all zones
+    if sample_size and sample_size < store.n_rows:
+        zones = store.sample_zones(sample_size, random_state=42)
+    else:
+        zones = range(len(store))
+    
+    for i in zones:
+        try:
+            features.append({
+                'type': 'Feature',
+                'geometry': polygon_to_geojson_geometry(store.polygon(i)),
+                'properties': zone_feature_properties(store, i)
+            })
+        except Exception as e:
+            # Skip problematic rows but continue processing
+            print(f"Warning: Skipping row {store.rows[i]}: {e}")
+            continue
+    
+    return {
+        'type': 'FeatureCollection',
+        'features': features
+    }
+
+# 6. Get zone statistics
+def get_zone_statistics(kml_poly, secc_df, pad_df, n_points=None, city_config=None, method='montecarlo', store=None,
+                        rng=None, target_error=None, sampling='uniform'):
+    """
+    Get detailed statistics for a zone - only includes zones that actually intersect.
+    Kept for compatibility; the work is a single estimate_intersection pass.
+    """
+    return estimate_intersection(
+        kml_poly, secc_df, pad_df, n_points=n_points,
+        city_config=city_config, method=method, store=store,
+        rng=rng, target_error=target_error, sampling=sampling
+    )
+
+# 7. Ejecución en paralelo: pool de procesos con la geometría precargada en cada worker
+PARALLEL_WORKERS_ENV = 'CENSO_PARALLEL_WORKERS'
+_MIN_ZONES_PER_TASK = 8
+
+_PROCESS_POOL = None
+_PROCESS_POOL_WORKERS = 0
+_WORKER_LOADER = None
+
+def parallel_workers_from_env():
+    """Number of pool workers requested via CENSO_PARALLEL_WORKERS (0 = serial)"""
+    try:
+        return max(0, int(os.environ.get(PARALLEL_WORKERS_ENV, '0')))
+    except ValueError:
+        return 0
+
+def _init_worker(loader):
+    """Pool initializer: keep the city loader (random streams come seeded with each task)"""
+    global _WORKER_LOADER
+    _WORKER_LOADER = loader
+
+def _screen_task(city, kml_poly, zones, method, root_seed):
+    return _screen_zones(kml_poly, _WORKER_LOADER(city)['store'], zones, method, root_seed)
+
+def _refine_task(city, kml_poly, screened, target_n_points, root_seed, ratio_se_target, sampling):
+    return _refine_zones(kml_poly, _WORKER_LOADER(city)['store'], screened, target_n_points, root_seed, ratio_se_target, sampling)
+
+def get_process_pool(loader, max_workers=None):
+    """
+    Shared, warm ProcessPoolExecutor. loader must be a module-level function
+    returning the data of one city (loader(city)) and caching it; each worker
+    loads a city the first time a task needs it, so tasks only carry city
+    names, zone indices and the KML polygon.
+    """
+    global _PROCESS_POOL, _PROCESS_POOL_WORKERS
+    if _PROCESS_POOL is None:
+        # Same default as ProcessPoolExecutor, kept here to size the task chunks
+        _PROCESS_POOL_WORKERS = max_workers or os.cpu_count() or 1
+        _PROCESS_POOL = concurrent.futures.ProcessPoolExecutor(
+            max_workers=_PROCESS_POOL_WORKERS, initializer=_init_worker, initargs=(loader,)
+        )
+    return _PROCESS_POOL
+
+def shutdown_process_pool():
+    global _PROCESS_POOL, _PROCESS_POOL_WORKERS
+    if _PROCESS_POOL is not None:
+        _PROCESS_POOL.shutdown()
+        _PROCESS_POOL = None
+        _PROCESS_POOL_WORKERS = 0
+
+def _split(items, n_chunks):
+    """Split a sequence into at most n_chunks contiguous, non-empty chunks"""
+    n_chunks = max(1, min(n_chunks, -(-len(items) // _MIN_ZONES_PER_TASK)))
+    size = -(-len(items) // n_chunks)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def _city_rng_and_target(rng, city_data, target_error):
+    """
+    One root seed per city (so each city matches its serial estimate) and the
+    error budget per city: splitting target_error by sqrt(#cities) keeps the
+    combined total within it.
+    """
+    root = _root_seed(rng)
+    seeds = {city: _root_seed(np.random.SeedSequence([root, n])) for n, city in enumerate(sorted(city_data))}
+    if target_error is not None and city_data:
+        target_error = target_error / math.sqrt(len(city_data))
+    return seeds, target_error
+
+def estimate_cities_parallel(kml_poly, city_data, loader, n_points=None, method='montecarlo', max_workers=None,
+                             rng=None, target_error=None, sampling='uniform', demographics=None):
+    """
+    estimate_intersection for every city at once, fanned out to the process pool.
+    Candidate zones of all cities are split into chunks; pass 1 and pass 2 each
+    run as one wave of pool tasks. Returns the aggregated totals, the combined
+    zone list and a per-city breakdown. Every zone draws from its own seeded
+    stream, so a given rng seed gives the same result as the serial path.
+    """
+    _check_method(method)
+    _check_sampling(sampling)
+    seeds, city_target = _city_rng_and_target(rng, city_data, target_error)
+    results = _parallel_zone_results(
+        kml_poly, city_data, loader, n_points, method, max_workers, seeds, city_target, sampling
+    )
+
+    total_pop_sum = 0
+    total_variance = 0.0
+    total_cutoff = 0.0
+    all_intersecting_zones = []
+    cities = {}
+    for city, zone_results in results.items():
+        data = city_data[city]
+        stats = _zone_breakdown(zone_results, data['store'])
+        if data.get('cube') is not None and demographics is not None:
+            stats['demographics'] = _cube_breakdown(data['cube'], data['store'], zone_results, demographics)
+        cities[city] = stats
+        total_pop_sum += stats['total_population']
+        total_variance += stats['std_error'] ** 2
+        total_cutoff += stats['cutoff_bound']
+        all_intersecting_zones.extend(stats['intersecting_zones'])
+
+    return _with_total_error({
+        'total_population': total_pop_sum,
+        'intersecting_zones': all_intersecting_zones,
+        'num_zones': len(all_intersecting_zones),
+        'cities': cities
+    }, total_variance, total_cutoff)
+
+def _parallel_zone_results(kml_poly, city_data, loader, n_points, method, max_workers, seeds, city_target, sampling):
+    """Screening and refinement waves over the pool; returns {city: zone results}"""
+    pool = get_process_pool(loader, max_workers)
+    n_chunks = _PROCESS_POOL_WORKERS
+
+    # Wave 1: screening (stages are timed here; workers have no request to report to)
+    # Cities without candidates get an empty result, so only failed cities are missing
+    screen_futures, screened = {}, {}
+    for city, data in city_data.items():
+        with stage('candidates', city):
+            candidates = _candidate_zones(kml_poly, data['store'])
+        if len(candidates) == 0:
+            screened[city] = []
+            continue
+        screen_futures[city] = [
+            pool.submit(_screen_task, city, kml_poly, chunk, method, seeds[city])
+            for chunk in _split(candidates, n_chunks)
+        ]
+
+    with stage('screen'):
+        for city, futures in screen_futures.items():
+            try:
+                screened[city] = [zone for f in futures for zone in f.result()]
+            except Exception as e:
+                print(f"Error processing city {city} in parallel screening: {e}")
+
+    # Wave 2: Monte Carlo refinement (exact ratios are already final)
+    results = {}
+    if method == 'exact':
+        results = screened
+    else:
+        refine_futures = {}
+        for city, zones in screened.items():
+            if not zones:
+                results[city] = []
+                continue
+            target_n_points = _target_n_points(_n_contributing(city_data[city]['store'], zones), n_points)
+            ratio_se_target = _ratio_se_target(city_data[city]['store'], zones, city_target)
+            refine_futures[city] = [
+                pool.submit(_refine_task, city, kml_poly, chunk, target_n_points, seeds[city], ratio_se_target, sampling)
+                for chunk in _split(zones, n_chunks)
+            ]
+        with stage('montecarlo'):
+            for city, futures in refine_futures.items():
+                try:
+                    results[city] = [zone for f in futures for zone in f.result()]
+                except Exception as e:
+                    print(f"Error processing city {city} in parallel refinement: {e}")
+    return results
+
+# 8. Evaluación por lotes: muchos polígonos contra los índices ya construidos de cada ciudad
+def estimate_cities(kml_poly, city_data, n_points=None, method='montecarlo', loader=None, max_workers=None, cache=None,
+                    rng=None, target_error=None, sampling='uniform', demographics=None):
+    """
+    Population of kml_poly summed over every city in city_data, serially or
+    through the process pool (loader and max_workers). With a ResultCache,
+    repeated queries for the same polygon, datasets and parameters skip the
+    calculation; the per-city intersection weights are cached too, so the same
+    polygon with other demographics filters skips the geometry. rng,
+    target_error and sampling work as in estimate_intersection.
+    Returns total_population, its std_error and ci_95, intersecting_zones
+    and num_zones. With a demographics filter dict (year, age_min, age_max,
+    sex, age_band) it adds demographics: {city: breakdown} for every city
+    with a population cube.
+    """
+    _check_method(method)
+    _check_sampling(sampling)
+    if demographics is not None:
+        check_demographic_filters(demographics, [data['cube'] for data in city_data.values() if data.get('cube') is not None])
+    key = None
+    if cache is not None and _cacheable_rng(rng):
+        versions = {city: data.get('version') for city, data in city_data.items()}
+        seed = int(rng) if rng is not None else None
+        key = polygon_cache_key(
+            kml_poly, versions, n_points=n_points, method=method, seed=seed, target_error=target_error, sampling=sampling,
+            demographics=demographics
+        )
+        with stage('cache'):
+            cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    # Geometry runs once per polygon and city; cached weights serve any later query
+    weights = city_intersection_weights(
+        kml_poly, city_data, n_points=n_points, method=method, loader=loader, max_workers=max_workers,
+        cache=cache, rng=rng, target_error=target_error, sampling=sampling
+    )
+
+    total_pop_sum = 0
+    total_variance = 0.0
+    total_cutoff = 0.0
+    all_intersecting_zones = []
+    breakdowns = {}
+    for city_name, city_weights in weights.items():
+        data = city_data[city_name]
+        with stage('lookup', city_name):
+            zone_results = city_weights.zone_results()
+            stats = _zone_breakdown(zone_results, data['store'])
+            if data.get('cube') is not None and demographics is not None:
+                breakdowns[city_name] = _cube_breakdown(data['cube'], data['store'], zone_results, demographics)
+        total_pop_sum += stats['total_population']
+        total_variance += stats['std_error'] ** 2
+        total_cutoff += stats['cutoff_bound']
+        all_intersecting_zones.extend(stats['intersecting_zones'])
+
+    result = _with_total_error({
+        'total_population': round(total_pop_sum),
+        'intersecting_zones': all_intersecting_zones,
+        'num_zones': len(all_intersecting_zones)
+    }, total_variance, total_cutoff)
+    if demographics is not None:
+        result['demographics'] = breakdowns
+    # A city that failed is missing from the total; do not serve that result again
+    if key is not None and len(weights) == len(city_data):
+        cache.set(key, result)
+    return result
+
+def estimate_batch(polygons, city_data, n_points=None, method='montecarlo', loader=None, max_workers=None, cache=None,
+                   rng=None, sampling='uniform'):
+    """
+    Evaluate many (name, coords) polygons against every city.
+    City stores and spatial indexes are built once at load time, so each
+    polygon only pays for its own intersection work. Pass loader and
+    max_workers to run each polygon through the process pool.
+    A seed as rng makes the whole batch reproducible (each polygon gets its
+    own derived stream). Returns one result per polygon, in input order.
+    """
+    _check_method(method)
+    _check_sampling(sampling)
+    results = []
+    seeds = np.random.SeedSequence(_root_seed(rng)).generate_state(max(len(polygons), 1), np.uint64)
+    for n, (name, kml_poly) in enumerate(polygons):
+        try:
+            stats = estimate_cities(
+                kml_poly, city_data, n_points=n_points, method=method,
+                loader=loader, max_workers=max_workers, cache=cache,
+                rng=int(seeds[n]) if rng is not None else None, sampling=sampling
+            )
+            results.append({
+                'name': name,
+                'population': stats['total_population'],
+                'statistics': stats,
+                'geojson': {
+                    'type': 'Feature',
+                    'geometry': polygon_to_geojson_geometry(kml_poly),
+                    'properties': {
+                        'name': name
+                    }
+                }
+            })
+        except Exception as e:
+            print(f"Error processing polygon {name}: {e}")
+            results.append({'name': name, 'error': str(e)})
+    return results
+
+# 9. Caché de resultados: clave = hash del polígono normalizado + versión de datos + parámetros
+RESULT_CACHE_SIZE_ENV = 'CENSO_RESULT_CACHE_SIZE'
+RESULT_CACHE_DB_ENV = 'CENSO_RESULT_CACHE_DB'
+CACHE_KEY_PRECISION = 6  # decimal degrees, ~0.1 m
+
+_RESULT_CACHE = None
+_RESULT_CACHE_LOCK = threading.Lock()
+
+def _normalize_ring(ring, precision, clockwise):
+    """Rounded integer ring with no closing/duplicate vertices, fixed orientation and start vertex"""
+    pts = np.round(np.asarray(ring, dtype=float) * 10 ** precision).astype(np.int64)
+    if len(pts) > 1 and (pts[0] == pts[-1]).all():
+        pts = pts[:-1]
+    if len(pts) > 1:
+        keep = np.any(pts != np.roll(pts, 1, axis=0), axis=1)
+        pts = pts[keep] if keep.any() else pts[:1]
+    if len(pts) > 2 and (_signed_area(pts.astype(float)) < 0) != clockwise:
+        pts = pts[::-1]
+    if len(pts):
+        start = np.lexsort((pts[:, 1], pts[:, 0]))[0]
+        pts = np.roll(pts, -start, axis=0)
+    return np.ascontiguousarray(pts)
+
+def normalize_polygon(poly, precision=CACHE_KEY_PRECISION):
+    """
+    Canonical form of a ring array or Rings: list of parts, each a list of
+    rounded integer rings (outer counter-clockwise, holes clockwise), with
+    parts and holes sorted so equivalent polygons normalize identically.
+    """
+    parts = []
+    for outer, holes in _as_rings(poly).parts():
+        holes = sorted((_normalize_ring(h, precision, True) for h in holes), key=lambda r: r.tobytes())
+        parts.append([_normalize_ring(outer, precision, False)] + holes)
+    parts.sort(key=lambda part: part[0].tobytes())
+    return parts
+
+def _cacheable_rng(rng):
+    """
+    Only unseeded (None) and integer-seeded queries are cached: a Generator or
+    SeedSequence carries state the key cannot capture, and keying it as
+    unseeded would serve another query's draw.
+    """
+    return rng is None or isinstance(rng, (int, np.integer))
+
+def polygon_cache_key(poly, versions, n_points=None, method='montecarlo', precision=CACHE_KEY_PRECISION,
+                      seed=None, target_error=None, sampling='uniform', demographics=None):
+    """sha256 of the normalized polygon, the dataset version of each city and the sampling parameters"""
+    digest = hashlib.sha256()
+    for part in normalize_polygon(poly, precision):
+        digest.update(b'P')
+        for ring in part:
+            digest.update(b'R%d:' % len(ring))
+            digest.update(ring.tobytes())
+    params = {'versions': sorted((str(c), str(v)) for c, v in versions.items()),
+              'n_points': n_points, 'method': method, 'precision': precision,
+              'seed': seed, 'target_error': target_error, 'sampling': sampling,
+              'demographics': sorted(demographics.items()) if demographics else None}
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+class ResultCache:
+    """
+    Thread-safe LRU of JSON-serializable results, bounded by entry count and
+    by the total size of the serialized values. Entries are kept serialized,
+    so every get returns a fresh copy and callers cannot alter a cached
+    result. With db_path, entries are also written to a SQLite file and read
+    back on a memory miss, so they survive restarts and are shared between
+    processes.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024, db_path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()  # key -> serialized value
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.disk_hits = 0
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=5)
+            self._db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, created REAL)')
+            self._db.commit()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            serialized = self._entries.get(key)
+            if serialized is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(serialized)
+
+            if self._db is not None:
+                row = self._db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self._remember(key, row[0])
+                    self.disk_hits += 1
+                    return json.loads(row[0])
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        serialized = json.dumps(value)
+        with self._lock:
+            self._remember(key, serialized)
+            if self._db is not None:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO results (key, value, created) VALUES (?, ?, ?)',
+                    (key, serialized, time.time())
+                )
+                self._db.commit()
+
+    def _remember(self, key, serialized):
+        if len(serialized) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._entries[key] = serialized
+        self._bytes += len(serialized)
+        # Evict least recently used entries until both limits hold
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self._db is not None:
+                self._db.execute('DELETE FROM results')
+                self._db.commit()
+
+    def stats(self):
+        return {
+            'entries': len(self._entries), 'bytes': self._bytes,
+            'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses
+        }
+
+def get_result_cache():
+    """
+    Process-wide ResultCache configured from the environment:
+    CENSO_RESULT_CACHE_SIZE entries (default 256, 0 disables the cache) and
+    CENSO_RESULT_CACHE_DB, an optional SQLite file for the disk tier.
+    """
+    global _RESULT_CACHE
+    try:
+        max_entries = int(os.environ.get(RESULT_CACHE_SIZE_ENV, '256'))
+    except ValueError:
+        max_entries = 256
+    if max_entries <= 0:
+        return None
+    with _RESULT_CACHE_LOCK:
+        if _RESULT_CACHE is None:
+            _RESULT_CACHE = ResultCache(max_entries=max_entries, db_path=os.environ.get(RESULT_CACHE_DB_ENV) or None)
+        return _RESULT_CACHE
+
+# 10. Respuestas precomputadas: GeoJSON de zonas serializado y comprimido una vez por versión de datos
+ZONES_PAYLOAD_CACHE_SIZE = 16
+
+_ZONES_PAYLOADS = collections.OrderedDict()
+_ZONES_PAYLOADS_LOCK = threading.Lock()
+
+class EncodedPayload:
+    """A JSON body with its gzip and brotli encodings and a strong ETag per encoding"""
+
+    def __init__(self, obj):
+        with stage('json_encode'):
+            self.bodies = {'identity': json.dumps(obj).encode()}
+        with stage('compress'):
+            self.bodies['gzip'] = gzip.compress(self.bodies['identity'], compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.bodies['br'] = brotli.compress(self.bodies['identity'], quality=9)
+        self.digest = hashlib.sha256(self.bodies['identity']).hexdigest()[:32]
+
+    def etag(self, encoding='identity'):
+        # Byte-different encodings need distinct strong validators
+        return f'"{self.digest}"' if encoding == 'identity' else f'"{self.digest}-{encoding}"'
+
+    def negotiate(self, accept_encoding):
+        """(encoding, body) for an Accept-Encoding header: br, then gzip, then identity"""
+        accepted = {}
+        for item in (accept_encoding or '').split(','):
+            token, _, params = item.strip().partition(';')
+            q = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            if token:
+                accepted[token.strip().lower()] = q
+        for encoding in ('br', 'gzip'):
+            q = accepted.get(encoding, accepted.get('*', 0.0))
+            if encoding in self.bodies and q > 0:
+                return encoding, self.bodies[encoding]
+        return 'identity', self.bodies['identity']
+
+    def not_modified(self, if_none_match):
+        """True if If-None-Match names this representation in any of its encodings"""
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == f'"{self.digest}"' or (tag.startswith(f'"{self.digest}-') and tag.endswith('"')):
+                return True
+        return False
+
+    def headers(self, encoding):
+        """Response headers for the chosen encoding"""
+        headers = {
+            'Content-Type': 'application/json',
+            'ETag': self.etag(encoding),
+            'Vary': 'Accept-Encoding',
+            'Cache-Control': 'public, max-age=0, must-revalidate'
+        }
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return headers
+
+def get_census_zones_payload(city, data, sample_size=None):
+    """
+    EncodedPayload of get_census_zones_geojson for a loaded city, built once
+    per (city, dataset version, sample size) and kept in a small LRU.
+    """
+    store = data['store']
+    if not sample_size or sample_size >= store.n_rows:
+        sample_size = None
+    key = (city, data.get('version'), sample_size)
+
+    with _ZONES_PAYLOADS_LOCK:
+        payload = _ZONES_PAYLOADS.get(key)
+        if payload is not None:
+            _ZONES_PAYLOADS.move_to_end(key)
+            return payload
+
+    with stage('geojson', city):
+        geojson = get_census_zones_geojson(
+            data['geo_df'], data['pop_df'], sample_size=sample_size,
+            city_config=data['config'], store=store
+        )
+        payload = EncodedPayload(geojson)
+
+    with _ZONES_PAYLOADS_LOCK:
+        _ZONES_PAYLOADS[key] = payload
+        while len(_ZONES_PAYLOADS) > ZONES_PAYLOAD_CACHE_SIZE:
+            _ZONES_PAYLOADS.popitem(last=False)
+    return payload
+
+# 11. Cubo de población: zona × año × edad × sexo, consultado con los ratios de intersección
+CUBE_SEXES = ('female', 'male')
+CUBE_AGE_BAND = 5
+
+class PopulationCube:
+    """
+    Dense population counts values[zone, year, age, sex] aligned with the
+    zones of a GeometryStore (ages 0..max in steps of one year, sexes in
+    CUBE_SEXES order). Built once per city from the detailed padrón.
+    """
+
+    ARRAY_FIELDS = ('values', 'years', 'ages')
+
+    def __init__(self, values, years, ages):
+        self.values = values
+        self.years = years
+        self.ages = ages
+
+    def to_arrays(self):
+        return {name: np.asarray(getattr(self, name)) for name in self.ARRAY_FIELDS}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['values'], arrays['years'], arrays['ages'])
+
+    def year_index(self, year):
+        """Position of year on the year axis (latest year when None)"""
+        if year is None:
+            return len(self.years) - 1
+        matches = np.nonzero(self.years == int(year))[0]
+        if len(matches) == 0:
+            raise ValueError(f"Año {year} no disponible. Años con datos: {int(self.years[0])}-{int(self.years[-1])}")
+        return int(matches[0])
+
+def build_population_cube(detail_df, store, city_config):
+    """
+    PopulationCube from the per-year, per-age padrón rows of a city.
+    city_config['cube'] names the year, age and per-sex count columns; rows
+    are matched to zones through join_key_pop like the population index.
+    """
+    cube_config = city_config['cube']
+    years = np.unique(detail_df[cube_config['col_year']].to_numpy()).astype(np.int64)
+    ages_col = detail_df[cube_config['col_age']].to_numpy().astype(np.int64)
+    ages = np.arange(int(ages_col.max()) + 1 if len(ages_col) else 0, dtype=np.int64)
+
+    # Position of each row's key on the key axis; keys without geometry are dropped
+    key_position = {key: n for n, key in enumerate(dict.fromkeys(store.keys.tolist()))}
+    row_keys = [key_position.get(key, -1) for key in detail_df[city_config['join_key_pop']].tolist()]
+    row_keys = np.array(row_keys, dtype=np.int64)
+    rows = row_keys >= 0
+
+    by_key = np.zeros((len(key_position), len(years), len(ages), len(CUBE_SEXES)), dtype=np.int32)
+    year_pos = np.searchsorted(years, detail_df[cube_config['col_year']].to_numpy().astype(np.int64))
+    for s, sex in enumerate(CUBE_SEXES):
+        counts = detail_df[cube_config['col_sexes'][sex]].to_numpy()
+        np.add.at(by_key, (row_keys[rows], year_pos[rows], ages_col[rows], s), counts[rows])
+
+    # Zones sharing a key share its counts, as with store.population
+    zone_keys = np.array([key_position[key] for key in store.keys.tolist()], dtype=np.int64)
+    return PopulationCube(by_key[zone_keys], years, ages)
+
+def parse_demographic_filters(get):
+    """
+    Demographic filters from a form getter (request.form.get, FieldStorage.getfirst):
+    year, age_min, age_max, sex and age_band. Returns None when none is given.
+    """
+    names = ('year', 'age_min', 'age_max', 'sex', 'age_band')
+    raw = {name: get(name) for name in names}
+    if all(value in (None, '') for value in raw.values()):
+        return None
+    filters = {}
+    try:
+        for name in ('year', 'age_min', 'age_max', 'age_band'):
+            if raw[name] not in (None, ''):
+                filters[name] = int(raw[name])
+    except ValueError:
+        raise ValueError("Los filtros year, age_min, age_max y age_band deben ser enteros")
+    if raw['sex'] not in (None, ''):
+        filters['sex'] = raw['sex']
+    check_demographic_filters(filters)
+    return filters
+
+def parse_estimate_options(get):
+    """
+    seed and target_error from a form getter (request.form.get,
+    FieldStorage.getfirst). Missing values are None; a non-integer seed or a
+    target_error that is not a finite number above zero raises ValueError.
+    """
+    seed, target_error = get('seed'), get('target_error')
+    try:
+        seed = int(seed) if seed not in (None, '') else None
+    except ValueError:
+        raise ValueError("seed debe ser un entero")
+    if target_error in (None, ''):
+        return seed, None
+    try:
+        target_error = float(target_error)
+    except ValueError:
+        raise ValueError("target_error debe ser un número")
+    if not math.isfinite(target_error) or target_error <= 0:
+        raise ValueError("target_error debe ser un número finito mayor que 0")
+    return seed, target_error
+
+def check_demographic_filters(filters, cubes=()):
+    """Validate a demographic filter dict (and its year against every cube)"""
+    sex = filters.get('sex')
+    if sex is not None and sex not in CUBE_SEXES:
+        raise ValueError(f"Sexo desconocido: {sex}. Usa uno de {CUBE_SEXES}")
+    age_min, age_max = filters.get('age_min'), filters.get('age_max')
+    if age_min is not None and age_max is not None and age_min > age_max:
+        raise ValueError("age_min no puede ser mayor que age_max")
+    if filters.get('age_band', CUBE_AGE_BAND) < 1:
+        raise ValueError("age_band debe ser al menos 1")
+    for cube in cubes:
+        cube.year_index(filters.get('year'))
+
+def population_cube_query(cube, zones, ratios, year=None, age_min=None, age_max=None, sex=None, age_band=CUBE_AGE_BAND):
+    """
+    Population of a polygon broken down by the cube: zones and ratios are the
+    intersecting zones and their fraction inside. The cube is contracted with
+    the ratios once (year × age × sex); the filtered total, the age pyramid of
+    the selected year and the time series over every year all come from that
+    small array.
+    """
+    check_demographic_filters({'sex': sex, 'age_min': age_min, 'age_max': age_max, 'age_band': age_band})
+    y = cube.year_index(year)
+    zones = np.asarray(zones, dtype=np.int64)
+    weighted = np.tensordot(np.asarray(ratios, dtype=float), cube.values[zones], axes=1) if len(zones) else \
+        np.zeros(cube.values.shape[1:])
+
+    age_mask = np.ones(len(cube.ages), dtype=bool)
+    if age_min is not None:
+        age_mask &= cube.ages >= age_min
+    if age_max is not None:
+        age_mask &= cube.ages <= age_max
+    sex_mask = np.array([sex is None or s == sex for s in CUBE_SEXES])
+
+    selected = weighted[:, age_mask][:, :, sex_mask]
+    series = selected.sum(axis=(1, 2))
+
+    # Age pyramid of the selected year over the filtered ages, in bands
+    pyramid = []
+    by_age = weighted[y] * sex_mask
+    ages = cube.ages[age_mask]
+    if len(ages):
+        for lo in range(int(ages[0]), int(ages[-1]) + 1, age_band):
+            hi = min(lo + age_band - 1, int(ages[-1]))
+            band = by_age[(cube.ages >= lo) & (cube.ages <= hi)].sum(axis=0)
+            entry = {'age': f'{lo}-{hi}' if hi > lo else str(lo)}
+            entry.update({s: round(float(v), 1) for s, v in zip(CUBE_SEXES, band)})
+            pyramid.append(entry)
+
+    return {
+        'year': int(cube.years[y]),
+        'filters': {'age_min': age_min, 'age_max': age_max, 'sex': sex},
+        'total_population': round(float(series[y])),
+        'by_sex': {s: round(float(v), 1) for s, v in zip(CUBE_SEXES, weighted[y][age_mask].sum(axis=0) * sex_mask)},
+        'pyramid': pyramid,
+        'series': [{'year': int(yr), 'population': round(float(v), 1)} for yr, v in zip(cube.years, series)]
+    }
+
+# 12. Pesos de intersección dispersos: la geometría se paga una vez por polígono y ciudad
+class IntersectionWeights:
+    """
+    Sparse weight vector of one polygon over the zones of one city: zones[k]
+    is a zone index and fractions[k] the fraction of that zone inside the
+    polygon, for every zone the polygon touches. Fractions are raw: zones
+    without population or under MIN_ZONE_RATIO are kept, and only the
+    population estimate leaves them out. hits and samples keep the Monte
+    Carlo counts behind each fraction (0 samples when it is exact).
+    """
+
+    def __init__(self, zones, fractions, n_zones, hits=None, samples=None):
+        self.zones = np.asarray(zones, dtype=np.int64)
+        self.fractions = np.asarray(fractions, dtype=float)
+        self.n_zones = int(n_zones)
+        self.hits = np.zeros(len(self.zones), dtype=np.int64) if hits is None else np.asarray(hits, dtype=np.int64)
+        self.samples = np.zeros(len(self.zones), dtype=np.int64) if samples is None else np.asarray(samples, dtype=np.int64)
+
+    @classmethod
+    def from_zone_results(cls, zone_results, n_zones):
+        """From the [{'zone', 'ratio'(, 'hits', 'n')}] list of _intersect_zones"""
+        return cls(
+            [data['zone'] for data in zone_results], [data['ratio'] for data in zone_results], n_zones,
+            [data.get('hits', 0) for data in zone_results], [data.get('n', 0) for data in zone_results]
+        )
+
+    def zone_results(self):
+        """Back to the [{'zone', 'ratio'(, 'hits', 'n')}] form used for the breakdown"""
+        results = []
+        for zone, fraction, hits, samples in zip(self.zones.tolist(), self.fractions.tolist(),
+                                                 self.hits.tolist(), self.samples.tolist()):
+            data = {'zone': zone, 'ratio': fraction}
+            if samples:
+                data.update({'hits': hits, 'n': samples})
+            results.append(data)
+        return results
+
+    def to_dict(self):
+        """JSON-serializable form for the result cache"""
+        return {
+            'zones': self.zones.tolist(), 'fractions': self.fractions.tolist(), 'n_zones': self.n_zones,
+            'hits': self.hits.tolist(), 'samples': self.samples.tolist()
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['zones'], data['fractions'], data['n_zones'], data['hits'], data['samples'])
+
+    def to_dense(self):
+        """Dense (n_zones,) weight vector"""
+        dense = np.zeros(self.n_zones)
+        dense[self.zones] = self.fractions
+        return dense
+
+    def apply(self, values):
+        return apply_weights(self, values)
+
+    def __len__(self):
+        return len(self.zones)
+
+def apply_weights(weights, values):
+    """
+    Weighted sum of per-zone values, aligned with the city's zones: values is
+    (n_zones,) for one indicator or (n_zones, k, ...) for several. With one
+    IntersectionWeights the result has shape values.shape[1:]; with a sequence
+    of them (e.g. one per polygon of a batch) the stacked weights form a sparse
+    (polygons × zones) matrix and the result is (len(weights),) + values.shape[1:],
+    computed in one pass. No geometry is involved.
+    """
+    values = np.asarray(values)
+    single = isinstance(weights, IntersectionWeights)
+    weights = [weights] if single else list(weights)
+    for w in weights:
+        if w.n_zones != values.shape[0]:
+            raise ValueError(f"Los valores deben tener una fila por zona ({w.n_zones}), no {values.shape[0]}")
+
+    counts = np.array([len(w) for w in weights], dtype=np.int64)
+    out = np.zeros((len(weights),) + values.shape[1:])
+    if counts.sum() > 0:
+        zones = np.concatenate([w.zones for w in weights])
+        fractions = np.concatenate([w.fractions for w in weights])
+        contributions = fractions.reshape((-1,) + (1,) * (values.ndim - 1)) * values[zones]
+        # Row segments of the stacked weights; empty rows stay zero
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        nonempty = counts > 0
+        out[nonempty] = np.add.reduceat(contributions, offsets[nonempty], axis=0)
+    return out[0] if single else out
+
+def intersection_weights(kml_poly, store, n_points=None, method='montecarlo', rng=None, target_error=None, sampling='uniform'):
+    """IntersectionWeights of kml_poly over one city's GeometryStore (same parameters as estimate_intersection)"""
+    zone_results = _intersect_zones(
+        kml_poly, store, n_points=n_points, method=method, rng=rng, target_error=target_error, sampling=sampling
+    )
+    return IntersectionWeights.from_zone_results(zone_results, len(store))
+
+def city_intersection_weights(kml_poly, city_data, n_points=None, method='montecarlo', loader=None, max_workers=None,
+                              cache=None, rng=None, target_error=None, sampling='uniform'):
+    """
+    {city: IntersectionWeights} of kml_poly for every city in city_data,
+    serially or through the process pool. With a ResultCache each city's
+    weights are cached under the polygon, that city's dataset version and
+    the sampling parameters, so only cities missing from the cache are
+    computed. Seeds match estimate_cities, so a seeded query gives the same
+    weights either way.
+    """
+    _check_method(method)
+    _check_sampling(sampling)
+    seeds, city_target = _city_rng_and_target(rng, city_data, target_error)
+    if not _cacheable_rng(rng):
+        cache = None
+
+    weights, keys = {}, {}
+    if cache is not None:
+        for city, data in city_data.items():
+            # v2: raw fractions of every touching zone (v1 entries had the population cut-off applied)
+            keys[city] = 'weights:v2:' + polygon_cache_key(
+                kml_poly, {city: data.get('version')}, n_points=n_points, method=method,
+                seed=seeds[city] if rng is not None else None, target_error=city_target, sampling=sampling
+            )
+            with stage('cache', city):
+                cached = cache.get(keys[city])
+            if cached is not None:
+                weights[city] = IntersectionWeights.from_dict(cached)
+
+    missing = {city: data for city, data in city_data.items() if city not in weights}
+    if missing:
+        if loader is not None and max_workers:
+            results = _parallel_zone_results(
+                kml_poly, missing, loader, n_points, method, max_workers, seeds, city_target, sampling
+            )
+        else:
+            results = {}
+            for city, data in missing.items():
+                try:
+                    # Nested stages (candidates, screen, montecarlo) are labelled with this city
+                    with stage('intersect', city):
+                        results[city] = _intersect_zones(
+                            kml_poly, data['store'], n_points=n_points, method=method,
+                            rng=seeds[city], target_error=city_target, sampling=sampling
+                        )
+                except Exception as e:
+                    print(f"Error processing city {city}: {e}")
+        for city, zone_results in results.items():
+            weights[city] = IntersectionWeights.from_zone_results(zone_results, len(city_data[city]['store']))
+            if cache is not None:
+                cache.set(keys[city], weights[city].to_dict())
+
+    return {city: weights[city] for city in city_data if city in weights}
+
+# 13. Tiempos por etapa: cabecera Server-Timing y métricas en formato Prometheus
+METRICS_ENV = 'CENSO_METRICS'
+METRICS_WINDOW = 2048  # recent durations kept per stage and city for the quantiles
+METRICS_QUANTILES = (0.5, 0.95, 0.99)
+
+_METRICS_ENABLED = os.environ.get(METRICS_ENV, '').strip().lower() in ('1', 'true', 'yes', 'on')
+_REQUEST = threading.local()
+_NULL_STAGE = contextlib.nullcontext()
+
+def metrics_enabled():
+    return _METRICS_ENABLED
+
+def set_metrics_enabled(enabled):
+    """Turn stage timing on or off at runtime (CENSO_METRICS=1 enables it at startup)"""
+    global _METRICS_ENABLED
+    _METRICS_ENABLED = bool(enabled)
+
+class StageMetrics:
+    """Thread-safe count, sum and a window of recent durations per (stage, city)"""
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, city, seconds):
+        key = (stage, city or '')
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0, 0.0, collections.deque(maxlen=self.window)]
+            series[0] += 1
+            series[1] += seconds
+            series[2].append(seconds)
+
+    def summary(self):
+        """{(stage, city): {'count', 'sum', 0.5, 0.95, 0.99}} with quantiles over the recent window"""
+        with self._lock:
+            series = {key: (count, total, list(recent)) for key, (count, total, recent) in self._series.items()}
+        out = {}
+        for key, (count, total, recent) in sorted(series.items()):
+            quantiles = np.quantile(recent, METRICS_QUANTILES) if recent else [0.0] * len(METRICS_QUANTILES)
+            out[key] = {'count': count, 'sum': total, **dict(zip(METRICS_QUANTILES, map(float, quantiles)))}
+        return out
+
+    def render_prometheus(self):
+        """Prometheus text exposition (0.0.4): one summary series per stage and city"""
+        name = 'censo_stage_duration_seconds'
+        lines = [
+            f'# HELP {name} Duration of each request stage, by city (quantiles over the last {self.window} samples).',
+            f'# TYPE {name} summary'
+        ]
+        for (stage, city), data in self.summary().items():
+            labels = f'stage="{stage}",city="{city}"'
+            for q in METRICS_QUANTILES:
+                lines.append(f'{name}{{{labels},quantile="{q}"}} {data[q]:.6f}')
+            lines.append(f'{name}_sum{{{labels}}} {data["sum"]:.6f}')
+            lines.append(f'{name}_count{{{labels}}} {data["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+_STAGE_METRICS = StageMetrics()
+
+def get_stage_metrics():
+    return _STAGE_METRICS
+
+class _Stage:
+    """Times its block into the metrics and the current request; nested stages inherit the city"""
+    __slots__ = ('name', 'city', 'outer_city', 'start')
+
+    def __init__(self, name, city):
+        self.name = name
+        self.city = city
+
+    def __enter__(self):
+        self.outer_city = getattr(_REQUEST, 'city', None)
+        if self.city is None:
+            self.city = self.outer_city
+        _REQUEST.city = self.city
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_stage(self.name, time.perf_counter() - self.start, self.city)
+        _REQUEST.city = self.outer_city
+        return False
+
+def stage(name, city=None):
+    """Context manager timing one stage; a shared no-op when metrics are disabled"""
+    if not _METRICS_ENABLED:
+        return _NULL_STAGE
+    return _Stage(name, city)
+
+def record_stage(name, seconds, city=None):
+    _STAGE_METRICS.observe(name, city, seconds)
+    timings = getattr(_REQUEST, 'timings', None)
+    if timings is not None:
+        timings.append((name, city, seconds))
+
+def begin_request():
+    """Start collecting this thread's stage timings for the Server-Timing header"""
+    if _METRICS_ENABLED:
+        _REQUEST.timings = []
+        _REQUEST.city = None
+        _REQUEST.start = time.perf_counter()
+
+def finish_request(route):
+    """
+    Record the whole request under route and return the Server-Timing header
+    value for it (stages summed per name and city, plus total), or None when
+    metrics are disabled or begin_request was not called on this thread.
+    """
+    timings = getattr(_REQUEST, 'timings', None)
+    if not _METRICS_ENABLED or timings is None:
+        return None
+    _REQUEST.timings = None
+    elapsed = time.perf_counter() - _REQUEST.start
+    _STAGE_METRICS.observe(route, None, elapsed)
 
+    totals = {}
+    for name, city, seconds in timings:
+        totals[name, city] = totals.get((name, city), 0.0) + seconds
+    parts = [
+        name + (f';desc="{city}"' if city else '') + f';dur={seconds * 1000:.1f}'
+        for (name, city), seconds in totals.items()
+    ]
+    parts.append(f'total;dur={elapsed * 1000:.1f}')
+    return ', '.join(parts)
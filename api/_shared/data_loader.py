@@ -1,9 +1,18 @@
 import os
-import pandas as pd
+import json
+import hashlib
+import threading
+import numpy as np
 
-# Module-level cache for warm invocations
+from .census_calculator import (
+    GeometryStore, PopulationCube, build_geometry_store, build_population_cube, build_population_index, polygon_bounds,
+    stage
+)
+
+# Module-level cache for warm invocations; each city loads on first use
 _CITY_DATA = {}
-_DATA_LOADED = False
+_CITY_LOCKS = {}
+_LOCKS_GUARD = threading.Lock()
 
 # Config for each city
 CITY_CONFIGS = {
@@ -17,7 +26,9 @@ CITY_CONFIGS = {
         'col_neighborhood': 'nom_barri',
         'col_district_code': 'codi_districte',
         'col_section_code': 'codi_seccio_censal',
-        'col_geometry': 'geometria_wgs84'
+        'col_geometry': 'geometria_wgs84',
+        # (min_lon, min_lat, max_lon, max_lat) covering every zone, checked without loading the city
+        'extent': (2.052, 41.317, 2.229, 41.469)
     },
     'l_hospitalet': {
         'pop_file': "data/L'Hospitalet/06ff0a2d-f6f8-4bf5-9ac1-ed09fda42a8b.csv",
@@ -29,7 +40,10 @@ CITY_CONFIGS = {
         'col_neighborhood': 'NomElement',
         'col_district_code': 'CodiDivisio',
         'col_section_code': 'CodiElement',
-        'col_geometry': 'Geometria_WGS84_LonLat'
+        'col_geometry': 'Geometria_WGS84_LonLat',
+        'extent': (2.086, 41.336, 2.138, 41.381),
+        # Detailed padrón (every year, by age and sex) kept as a zone × year × age × sex cube
+        'cube': {'col_year': 'AnyPadro', 'col_age': 'Edat', 'col_sexes': {'female': 'Dones', 'male': 'Homes'}}
     }
 }
 
@@ -49,47 +63,260 @@ def _get_project_root():
     return os.path.dirname(os.path.dirname(module_dir))
 
 
-def get_city_data():
-    """Load and cache city data. Returns the CITY_DATA dict."""
-    global _CITY_DATA, _DATA_LOADED
+# Columnar snapshots: data/snapshots/<city>/<array>.npy plus meta.json
+SNAPSHOT_DIR = 'data/snapshots'
+SNAPSHOT_FORMAT = 2
+
+
+def source_version(city, root=None):
+    """
+    Hash of the city's source CSVs, used as the dataset version. Reading both
+    files is slow, so only scripts/build_snapshots.py and the CSV fallback
+    compute it; snapshots record it in meta.json.
+    """
+    root = root or _get_project_root()
+    config = CITY_CONFIGS[city]
+    digest = hashlib.sha1(f"format-{SNAPSHOT_FORMAT}".encode())
+    for name in ('geo_file', 'pop_file'):
+        with open(os.path.join(root, config[name]), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def source_stats(city, root=None):
+    """{CSV path: {'size', 'mtime'}} of the city's source files that exist"""
+    root = root or _get_project_root()
+    stats = {}
+    for name in ('geo_file', 'pop_file'):
+        path = CITY_CONFIGS[city][name]
+        try:
+            st = os.stat(os.path.join(root, path))
+        except OSError:
+            continue
+        stats[path] = {'size': st.st_size, 'mtime': st.st_mtime}
+    return stats
+
+
+def save_snapshot(city, store, pop_index, version, root=None, cube=None):
+    """
+    Write the packed store, population index and population cube of a city as
+    .npy columns. meta.json records the version and the size and mtime of each
+    source CSV.
+    """
+    root = root or _get_project_root()
+    path = os.path.join(root, SNAPSHOT_DIR, city)
+    os.makedirs(path, exist_ok=True)
+
+    arrays = store.to_arrays()
+    arrays['pop_keys'] = np.array(list(pop_index.keys()))
+    arrays['pop_values'] = np.array(list(pop_index.values()))
+    if cube is not None:
+        arrays.update({f'cube_{name}': values for name, values in cube.to_arrays().items()})
+    for name, values in arrays.items():
+        np.save(os.path.join(path, f'{name}.npy'), values, allow_pickle=False)
+
+    with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({
+            'city': city, 'version': version, 'format': SNAPSHOT_FORMAT, 'sources': source_stats(city, root),
+            'arrays': sorted(arrays)
+        }, f, indent=2)
+    return path
+
+
+def load_snapshot(city, root=None, version=None):
+    """
+    Load a city snapshot, memory-mapping the large arrays.
+    Returns (store, pop_index, version, cube) or None when missing or stale;
+    cube is None for cities without one. A snapshot is stale when a source
+    CSV present on disk differs in size from the one it was built from, or
+    when version is given and differs. Matching sizes and mtimes skip the
+    hash; if an mtime differs (an edit that kept the size, or a fresh
+    checkout) the CSVs are hashed once and must still match the version.
+    """
+    root = root or _get_project_root()
+    path = os.path.join(root, SNAPSHOT_DIR, city)
+    try:
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('format') != SNAPSHOT_FORMAT or (version is not None and meta.get('version') != version):
+        return None
+    sources = meta.get('sources') or {}
+    stats = source_stats(city, root)
+    if any(not isinstance(sources.get(path), dict) or sources[path].get('size') != st['size']
+           for path, st in stats.items()):
+        return None
+    # The hash needs both CSVs; without them the CSV fallback could not run either
+    touched = any(sources[path].get('mtime') != st['mtime'] for path, st in stats.items())
+    if touched and len(stats) == 2 and source_version(city, root) != meta.get('version'):
+        return None
+
+    arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r', allow_pickle=False) for name in meta['arrays']}
+    pop_index = dict(zip(arrays.pop('pop_keys').tolist(), arrays.pop('pop_values').tolist()))
+    cube_arrays = {name[len('cube_'):]: arrays.pop(name) for name in list(arrays) if name.startswith('cube_')}
+    cube = PopulationCube.from_arrays(cube_arrays) if cube_arrays else None
+    return GeometryStore.from_arrays(arrays), pop_index, meta['version'], cube
+
+
+def load_city_csv(city, config, root):
+    """
+    Read and post-process the source CSVs of a city.
+    Returns (geo_df, pop_df, detail_df); detail_df keeps the unaggregated
+    padrón rows for cities with a population cube, else None.
+    """
+    # Imported here: snapshot cold starts never need pandas
+    try:
+        import pandas as pd
+    except ImportError:  # pragma: no cover
+        raise ImportError(f"pandas is required to load {city} without a snapshot (run scripts/build_snapshots.py)")
+
+    geo_path = os.path.join(root, config['geo_file'])
+    pop_path = os.path.join(root, config['pop_file'])
+    
+    encoding = 'latin1' if config['geo_sep'] == '|' else 'utf-8'
+    geo_df = pd.read_csv(geo_path, sep=config['geo_sep'], encoding=encoding)
+    pop_df = pd.read_csv(pop_path)
+    detail_df = pop_df if 'cube' in config else None
+    
+    # Post-processing
+    if city == 'barcelona':
+        if 'seccion_key' not in geo_df.columns:
+            geo_df['seccion_key'] = geo_df.apply(
+                lambda r: int(f"{int(r['codi_districte']):02d}{int(r['codi_seccio_censal']):03d}"),
+                axis=1
+            )
+    elif city == 'l_hospitalet':
+        # Map Granvia Sud (geometry 16 -> population 13)
+        geo_df.loc[geo_df['CodiElement'] == 16, 'CodiElement'] = 13
+        # LH population needs aggregation for 2025
+        pop_df = pop_df[pop_df['AnyPadro'] == 2025]
+        pop_df = pop_df.groupby('CodiBarri')['Total'].sum().reset_index()
+        pop_df.rename(columns={'Total': 'Valor'}, inplace=True)
     
-    if _DATA_LOADED:
-        return _CITY_DATA
+    return geo_df, pop_df, detail_df
+
+
+def _load_city(city, config, root, use_snapshot=True):
+    """Fresh snapshot if available, otherwise parse the CSVs (geo_df/pop_df are None from a snapshot)"""
+    snapshot = load_snapshot(city, root) if use_snapshot else None
+    if snapshot is not None:
+        store, pop_index, version, cube = snapshot
+        geo_df = pop_df = None
+    else:
+        geo_df, pop_df, detail_df = load_city_csv(city, config, root)
+        version = source_version(city, root)
+        
+        # Key -> population hash index, shared by the store and zone lookups
+        pop_index = build_population_index(pop_df, config['join_key_pop'])
+        
+        # WKT is parsed once here; calculator functions reuse the packed store
+        store = build_geometry_store(geo_df, pop_df, config, pop_index=pop_index)
+        cube = build_population_cube(detail_df, store, config) if detail_df is not None else None
     
-    root = _get_project_root()
+    store.build_index()
+    return {
+        'geo_df': geo_df,
+        'pop_df': pop_df,
+        'config': config,
+        'pop_index': pop_index,
+        'store': store,
+        'cube': cube,
+        'version': version,
+        'from_snapshot': snapshot is not None
+    }
+
+
+def _city_lock(city):
+    with _LOCKS_GUARD:
+        return _CITY_LOCKS.setdefault(city, threading.Lock())
+
+
+def get_city(city):
+    """
+    Data for one city, loaded on first use. Concurrent first calls share a
+    single load (single-flight); returns None for unknown cities or if loading failed.
+    """
+    data = _CITY_DATA.get(city)
+    if data is not None or city not in CITY_CONFIGS:
+        return data
     
-    for city, config in CITY_CONFIGS.items():
+    with _city_lock(city):
+        # Another thread may have finished the load while we waited
+        if city in _CITY_DATA:
+            return _CITY_DATA[city]
         try:
-            geo_path = os.path.join(root, config['geo_file'])
-            pop_path = os.path.join(root, config['pop_file'])
-            
-            encoding = 'latin1' if config['geo_sep'] == '|' else 'utf-8'
-            geo_df = pd.read_csv(geo_path, sep=config['geo_sep'], encoding=encoding)
-            pop_df = pd.read_csv(pop_path)
-            
-            # Post-processing
-            if city == 'barcelona':
-                if 'seccion_key' not in geo_df.columns:
-                    geo_df['seccion_key'] = geo_df.apply(
-                        lambda r: int(f"{int(r['codi_districte']):02d}{int(r['codi_seccio_censal']):03d}"),
-                        axis=1
-                    )
-            elif city == 'l_hospitalet':
-                # Map Granvia Sud (geometry 16 -> population 13)
-                geo_df.loc[geo_df['CodiElement'] == 16, 'CodiElement'] = 13
-                # LH population needs aggregation for 2025
-                pop_df = pop_df[pop_df['AnyPadro'] == 2025]
-                pop_df = pop_df.groupby('CodiBarri')['Total'].sum().reset_index()
-                pop_df.rename(columns={'Total': 'Valor'}, inplace=True)
-            
-            _CITY_DATA[city] = {
-                'geo_df': geo_df,
-                'pop_df': pop_df,
-                'config': config
-            }
-            print(f"Loaded data for {city}")
+            with stage('data_load', city):
+                data = _load_city(city, CITY_CONFIGS[city], _get_project_root())
         except Exception as e:
             print(f"Error loading data for {city}: {e}")
-    
-    _DATA_LOADED = True
+            return None
+        
+        # Widen the configured extent if the data ever outgrows it
+        extent = _store_extent(data['store']) if len(data['store']) else CITY_CONFIGS[city]['extent']
+        if not _extent_contains(CITY_CONFIGS[city]['extent'], extent):
+            print(f"Warning: {city} data exceeds its configured extent {CITY_CONFIGS[city]['extent']}")
+            CITY_CONFIGS[city]['extent'] = _union_bounds([CITY_CONFIGS[city]['extent'], extent])
+        
+        _CITY_DATA[city] = data
+        source = 'snapshot' if data['from_snapshot'] else 'CSV'
+        print(f"Loaded data for {city} ({source})")
+        return data
+
+
+def _store_extent(store):
+    return (
+        float(store.bbox[:, 0].min()), float(store.bbox[:, 1].min()),
+        float(store.bbox[:, 2].max()), float(store.bbox[:, 3].max())
+    )
+
+
+def _extent_contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+
+def _union_bounds(bounds):
+    bounds = list(bounds)
+    return (
+        min(b[0] for b in bounds), min(b[1] for b in bounds),
+        max(b[2] for b in bounds), max(b[3] for b in bounds)
+    )
+
+
+def cities_overlapping(bounds):
+    """Names of the cities whose configured extent overlaps (min_lon, min_lat, max_lon, max_lat)"""
+    min_lon, min_lat, max_lon, max_lat = bounds
+    return [
+        city for city, config in CITY_CONFIGS.items()
+        if config['extent'][2] >= min_lon and config['extent'][0] <= max_lon
+        and config['extent'][3] >= min_lat and config['extent'][1] <= max_lat
+    ]
+
+
+def get_cities_for_polygons(polygons):
+    """
+    City data dict restricted to the cities the polygons can touch.
+    Cities whose extent misses the polygons' combined bbox are never loaded.
+    """
+    polygons = list(polygons)
+    if not polygons:
+        return {}
+    bounds = _union_bounds(polygon_bounds(poly) for poly in polygons)
+    city_data = {}
+    for city in cities_overlapping(bounds):
+        data = get_city(city)
+        if data is not None:
+            city_data[city] = data
+    return city_data
+
+
+def get_cities_for_polygon(kml_poly):
+    """get_cities_for_polygons for a single polygon"""
+    return get_cities_for_polygons([kml_poly])
+
+
+def get_city_data():
+    """Load every city (e.g. to regenerate static files). Returns the CITY_DATA dict."""
+    for city in CITY_CONFIGS:
+        get_city(city)
     return _CITY_DATA
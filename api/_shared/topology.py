@@ -0,0 +1,318 @@
+import math
+import numpy as np
+
+from .census_calculator import GeometryStore, zone_feature_properties
+
+# 1. Arcos compartidos: cada tramo de frontera entre zonas vecinas se guarda una sola vez
+def _ring_points(ring):
+    """Vertices of a ring as (lon, lat) tuples, without the closing vertex"""
+    pts = [tuple(p) for p in np.asarray(ring, dtype=float).tolist()]
+    if len(pts) > 1 and pts[0] == pts[-1]:
+        pts = pts[:-1]
+    return pts
+
+def store_geometries(store):
+    """Zones of a GeometryStore as lists of parts, each a list of rings (outer first)"""
+    geometries = []
+    for i in range(len(store)):
+        parts = []
+        for j in range(store.geom_offsets[i], store.geom_offsets[i + 1]):
+            parts.append([
+                store.coords[store.ring_offsets[k]:store.ring_offsets[k + 1]]
+                for k in range(store.part_offsets[j], store.part_offsets[j + 1])
+            ])
+        geometries.append(parts)
+    return geometries
+
+def build_topology(geometries):
+    """
+    Split every ring into arcs at junctions and deduplicate them.
+    A junction is a vertex whose set of neighbouring vertices (over all
+    rings) is not exactly two, i.e. where the set of zones sharing the
+    boundary changes. Returns (arcs, shapes): arcs is a list of (k, 2)
+    arrays, both endpoints included; shapes mirrors geometries with each ring
+    replaced by a list of arc references (i, or ~i for arc i reversed).
+    """
+    rings = [_ring_points(ring) for parts in geometries for part in parts for ring in part]
+
+    neighbours = {}
+    for pts in rings:
+        n = len(pts)
+        for i, p in enumerate(pts):
+            adjacent = neighbours.setdefault(p, set())
+            adjacent.add(pts[i - 1])
+            adjacent.add(pts[(i + 1) % n])
+
+    arcs, arc_index = [], {}
+
+    def add_arc(pts):
+        key = tuple(pts)
+        if key in arc_index:
+            return arc_index[key]
+        reverse_key = key[::-1]
+        if reverse_key in arc_index:
+            return ~arc_index[reverse_key]
+        arc_index[key] = len(arcs)
+        arcs.append(np.array(pts, dtype=float))
+        return arc_index[key]
+
+    ring_refs = []
+    for pts in rings:
+        junctions = [i for i, p in enumerate(pts) if len(neighbours[p]) != 2]
+        if not junctions:
+            # Closed arc (island or enclave): canonical start so an identical hole is shared
+            start = min(range(len(pts)), key=pts.__getitem__)
+            forward = pts[start:] + pts[:start]
+            ring_refs.append([add_arc(forward + forward[:1])])
+            continue
+
+        start = junctions[0]
+        rotated = pts[start:] + pts[:start]
+        cuts = [i - start for i in junctions] + [len(pts)]
+        rotated.append(rotated[0])
+        ring_refs.append([add_arc(rotated[a:b + 1]) for a, b in zip(cuts[:-1], cuts[1:])])
+
+    shapes, k = [], 0
+    for parts in geometries:
+        shape = []
+        for part in parts:
+            shape.append(ring_refs[k:k + len(part)])
+            k += len(part)
+        shapes.append(shape)
+    return arcs, shapes
+
+def arcs_to_ring(arcs, refs):
+    """Closed ring (n, 2) from a list of arc references"""
+    pieces = []
+    for n, ref in enumerate(refs):
+        arc = arcs[~ref][::-1] if ref < 0 else arcs[ref]
+        pieces.append(arc if n == 0 else arc[1:])
+    return np.concatenate(pieces)
+
+# 2. Simplificación (Douglas-Peucker por arco) y cuantización
+def _segment_distances(pts, a, b):
+    """Distance of each point to the segment a-b"""
+    ab = b - a
+    length2 = float(ab @ ab)
+    if length2 == 0:
+        return np.hypot(pts[:, 0] - a[0], pts[:, 1] - a[1])
+    t = np.clip(((pts - a) @ ab) / length2, 0.0, 1.0)
+    proj = a + t[:, None] * ab
+    return np.hypot(pts[:, 0] - proj[:, 0], pts[:, 1] - proj[:, 1])
+
+def douglas_peucker(pts, tolerance, keep_interior=False):
+    """
+    Indices of the vertices kept by Douglas-Peucker (endpoints always kept).
+    keep_interior keeps at least the farthest interior vertex, so a ring made
+    of one or two arcs cannot collapse.
+    """
+    n = len(pts)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j <= i + 1:
+            continue
+        d = _segment_distances(pts[i + 1:j], pts[i], pts[j])
+        k = int(np.argmax(d))
+        if d[k] > tolerance or (keep_interior and i == 0 and j == n - 1):
+            m = i + 1 + k
+            keep[m] = True
+            stack.append((i, m))
+            stack.append((m, j))
+    return np.flatnonzero(keep)
+
+def _closed_arc_indices(pts, tolerance):
+    """Douglas-Peucker for a closed arc: split at the vertex farthest from the start, keep a triangle"""
+    far = int(np.argmax(np.hypot(pts[:, 0] - pts[0, 0], pts[:, 1] - pts[0, 1])))
+    first = douglas_peucker(pts[:far + 1], tolerance, keep_interior=True)
+    second = douglas_peucker(pts[far:], tolerance, keep_interior=True) + far
+    return np.concatenate([first, second[1:]])
+
+def _projection(arcs):
+    """Scale factors (m per degree of lon, m per degree of lat) around the data's mean latitude"""
+    lat0 = float(np.mean([arc[:, 1].mean() for arc in arcs])) if arcs else 0.0
+    return np.array([111320.0 * math.cos(math.radians(lat0)), 110574.0])
+
+def simplify_arcs(arcs, shapes, tolerance_m, decimals=None):
+    """
+    Simplify every shared arc once (so neighbours stay gap-free) with a
+    tolerance in metres, then optionally round to `decimals` decimal degrees.
+    Returns (new_arcs, max_error_m): the largest distance from any original
+    vertex to the simplified, quantized boundary.
+    """
+    scale = _projection(arcs)
+
+    # Arcs of rings with fewer than three arcs must keep an interior vertex
+    fragile = set()
+    for shape in shapes:
+        for part in shape:
+            for refs in part:
+                if len(refs) < 3:
+                    fragile.update(ref if ref >= 0 else ~ref for ref in refs)
+
+    new_arcs, max_error = [], 0.0
+    for n, arc in enumerate(arcs):
+        projected = arc * scale
+        if len(arc) > 3 and (arc[0] == arc[-1]).all():
+            kept = _closed_arc_indices(projected, tolerance_m)
+        else:
+            kept = douglas_peucker(projected, tolerance_m, keep_interior=n in fragile)
+
+        simplified = arc[kept]
+        if decimals is not None:
+            simplified = np.round(simplified, decimals)
+
+        # Error of the original vertices against the final segments
+        final = simplified * scale
+        for s in range(len(kept) - 1):
+            segment = projected[kept[s]:kept[s + 1] + 1]
+            max_error = max(max_error, float(_segment_distances(segment, final[s], final[s + 1]).max()))
+
+        # Quantization can merge consecutive vertices
+        if len(simplified) > 2:
+            distinct = np.any(simplified[1:] != simplified[:-1], axis=1)
+            simplified = np.concatenate([simplified[:1], simplified[1:][distinct]])
+        new_arcs.append(simplified)
+    return new_arcs, max_error
+
+def quantize_arcs(arcs, decimals):
+    """Round arcs to `decimals` decimal degrees (0.1 m at 6, 1.1 m at 5)"""
+    return [np.round(arc, decimals) for arc in arcs]
+
+# 3. Variantes por nivel de zoom
+WEB_MERCATOR_M_PER_PX = 156543.03392
+
+def zoom_tolerance(zoom, lat, pixels=0.5):
+    """Ground distance in metres of `pixels` screen pixels at a zoom level and latitude"""
+    return pixels * WEB_MERCATOR_M_PER_PX * math.cos(math.radians(lat)) / 2 ** zoom
+
+def zoom_decimals(tolerance_m):
+    """Decimal degrees whose rounding step stays within the simplification tolerance"""
+    return max(0, math.ceil(-math.log10(tolerance_m / 111320.0)))
+
+def store_from_shapes(store, arcs, shapes):
+    """GeometryStore with the same zones and attributes as store but geometry rebuilt from arcs"""
+    rings = [arcs_to_ring(arcs, refs) for shape in shapes for part in shape for refs in part]
+    ring_offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+    np.cumsum([len(r) for r in rings], out=ring_offsets[1:])
+    return GeometryStore(
+        np.concatenate(rings) if rings else np.empty((0, 2)), ring_offsets,
+        np.asarray(store.part_offsets), np.asarray(store.geom_offsets),
+        np.asarray(store.rows), store.keys, np.asarray(store.population), np.asarray(store.has_population),
+        attributes={
+            'district': store.district, 'neighborhood': store.neighborhood,
+            'district_code': store.district_code, 'section_code': store.section_code
+        },
+        n_rows=store.n_rows
+    )
+
+def simplify_store(store, tolerance_m, decimals=None, topology=None):
+    """
+    Topology-preserving simplified copy of a store plus an error report.
+    Zone areas (and so densities) keep the original values; the report
+    gives the largest vertex error in metres and the largest and total
+    relative change in zone area caused by the simplification.
+    """
+    arcs, shapes = topology or build_topology(store_geometries(store))
+    new_arcs, max_error = simplify_arcs(arcs, shapes, tolerance_m, decimals)
+    simplified = store_from_shapes(store, new_arcs, shapes)
+
+    original_area = np.asarray(store.area_km2)
+    valid = original_area > 0
+    relative = np.abs(simplified.area_km2[valid] - original_area[valid]) / original_area[valid]
+    report = {
+        'tolerance_m': tolerance_m,
+        'decimals': decimals,
+        'vertices': int(len(simplified.coords)),
+        'original_vertices': int(len(store.coords)),
+        'max_error_m': round(max_error, 2),
+        'max_area_error_pct': round(float(relative.max()) * 100, 3) if len(relative) else 0.0,
+        'total_area_error_pct': round(
+            float(abs(simplified.area_km2.sum() - original_area.sum()) / original_area.sum()) * 100, 4
+        ) if original_area.sum() > 0 else 0.0
+    }
+
+    # Properties report the census area, not the display geometry's
+    simplified.area_km2 = original_area
+    return simplified, report
+
+# 4. TopoJSON: arcos compartidos con coordenadas enteras codificadas en delta
+TOPOJSON_QUANTIZATION = 1_000_000
+
+def _quantize_arc(arc, translate, scale):
+    """Integer grid coordinates of an arc, consecutive duplicates removed (at least two points kept)"""
+    q = np.round((np.asarray(arc) - translate) / scale).astype(np.int64)
+    if len(q) > 2:
+        distinct = np.any(q[1:] != q[:-1], axis=1)
+        q = np.concatenate([q[:1], q[1:][distinct]])
+        if len(q) == 1:
+            q = np.concatenate([q, q])
+    return q
+
+def encode_topojson(store, quantization=TOPOJSON_QUANTIZATION, topology=None, object_name='zones'):
+    """
+    TopoJSON Topology for every zone of a store. Boundaries shared by
+    neighbouring zones are stored once as arcs; arc coordinates are
+    quantized to a quantization x quantization grid over the bbox and
+    delta-encoded. Feature properties match get_census_zones_geojson.
+    """
+    arcs, shapes = topology or build_topology(store_geometries(store))
+    coords = np.concatenate(arcs) if arcs else np.zeros((1, 2))
+    translate = coords.min(axis=0)
+    extent = coords.max(axis=0) - translate
+    scale = np.where(extent > 0, extent / max(quantization - 1, 1), 1.0)
+
+    encoded_arcs = []
+    for arc in arcs:
+        q = _quantize_arc(arc, translate, scale)
+        deltas = np.concatenate([q[:1], np.diff(q, axis=0)])
+        encoded_arcs.append(deltas.tolist())
+
+    geometries = []
+    for i, shape in enumerate(shapes):
+        refs = [[[int(ref) for ref in ring] for ring in part] for part in shape]
+        geometry = {'type': 'Polygon', 'arcs': refs[0]} if len(refs) == 1 else {'type': 'MultiPolygon', 'arcs': refs}
+        geometry['properties'] = zone_feature_properties(store, i)
+        geometries.append(geometry)
+
+    return {
+        'type': 'Topology',
+        'bbox': [float(v) for v in (*translate, *(translate + extent))],
+        'transform': {'scale': [float(v) for v in scale], 'translate': [float(v) for v in translate]},
+        'objects': {object_name: {'type': 'GeometryCollection', 'geometries': geometries}},
+        'arcs': encoded_arcs
+    }
+
+def decode_topojson(topology, object_name='zones'):
+    """
+    GeoJSON FeatureCollection from a Topology written by encode_topojson
+    (or any quantized TopoJSON of polygons). Coordinates come back within
+    half a grid step (transform.scale / 2) of the originals.
+    """
+    transform = topology.get('transform')
+    arcs = []
+    for arc in topology['arcs']:
+        pts = np.asarray(arc, dtype=float)
+        if transform:
+            pts = np.cumsum(pts, axis=0) * transform['scale'] + transform['translate']
+        arcs.append(pts)
+
+    def ring(refs):
+        return arcs_to_ring(arcs, refs).tolist()
+
+    features = []
+    for geometry in topology['objects'][object_name]['geometries']:
+        if geometry['type'] == 'Polygon':
+            coordinates = [ring(refs) for refs in geometry['arcs']]
+        elif geometry['type'] == 'MultiPolygon':
+            coordinates = [[ring(refs) for refs in part] for part in geometry['arcs']]
+        else:
+            continue
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': geometry['type'], 'coordinates': coordinates},
+            'properties': geometry.get('properties', {})
+        })
+    return {'type': 'FeatureCollection', 'features': features}
@@ -0,0 +1,257 @@
+import collections
+import math
+import struct
+import threading
+import numpy as np
+
+from .census_calculator import clip_polygon_convex, zone_feature_properties, _as_rings, _signed_area
+from .topology import build_topology, store_geometries, simplify_store, zoom_tolerance
+
+TILE_EXTENT = 4096
+MAX_ZOOM = 22  # deepest zoom served; bounds 2 ** z and the tile-cache keys
+TILE_BUFFER = 64  # tile units kept around the tile so strokes do not show seams
+LAYER_NAME = 'census_zones'
+MIN_SIMPLIFY_M = 0.5  # below this tolerance the original geometry is used
+TILE_CACHE_BYTES = 64 * 1024 * 1024
+
+# 1. Coordenadas de tesela (Web Mercator, esquema XYZ)
+def tile_bounds(z, x, y):
+    """(min_lon, min_lat, max_lon, max_lat) of tile z/x/y"""
+    n = 2 ** z
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)
+
+def tile_range(bounds, z):
+    """(min_x, min_y, max_x, max_y) of the tiles covering a lon/lat bbox at zoom z"""
+    min_lon, min_lat, max_lon, max_lat = bounds
+    n = 2 ** z
+
+    def column(lon):
+        return min(n - 1, max(0, int((lon + 180.0) / 360.0 * n)))
+
+    def row(lat):
+        lat = math.radians(max(min(lat, 85.0511), -85.0511))
+        return min(n - 1, max(0, int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n)))
+
+    return column(min_lon), row(max_lat), column(max_lon), row(min_lat)
+
+def _to_tile_units(coords, z, x, y, extent):
+    """Project (lon, lat) vertices to the tile's local grid (y grows downwards)"""
+    n = 2 ** z
+    lon = np.asarray(coords)[:, 0]
+    lat = np.radians(np.asarray(coords)[:, 1])
+    px = ((lon + 180.0) / 360.0 * n - x) * extent
+    py = ((1 - np.arcsinh(np.tan(lat)) / np.pi) / 2 * n - y) * extent
+    return np.column_stack([px, py])
+
+# 2. Codificación protobuf de Mapbox Vector Tile 2.1
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def _field(number, wire_type, payload):
+    """Key plus payload; length-delimited payloads get their length prefix"""
+    if wire_type == 2:
+        payload = _varint(len(payload)) + payload
+    return _varint((number << 3) | wire_type) + payload
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def _encode_value(value):
+    """Layer value message: string, double or integer"""
+    if isinstance(value, str):
+        return _field(1, 2, value.encode('utf-8'))
+    if isinstance(value, float):
+        return _field(3, 1, struct.pack('<d', value))
+    if value >= 0:
+        return _field(5, 0, _varint(int(value)))
+    return _field(6, 0, _varint(_zigzag(int(value))))
+
+def _encode_rings(rings):
+    """Command stream for polygon rings (integer tile units, no closing vertex)"""
+    commands, cx, cy = [], 0, 0
+    for ring in rings:
+        commands.append(1 | (1 << 3))  # MoveTo, one point
+        for k, (px, py) in enumerate(ring.tolist()):
+            if k == 1:
+                commands.append(2 | ((len(ring) - 1) << 3))  # LineTo, remaining points
+            commands.append(_zigzag(px - cx))
+            commands.append(_zigzag(py - cy))
+            cx, cy = px, py
+        commands.append(7 | (1 << 3))  # ClosePath
+    return commands
+
+def encode_layer(features, name=LAYER_NAME, extent=TILE_EXTENT):
+    """Layer message from (rings, properties) features"""
+    keys, key_index, values, value_index = [], {}, [], {}
+    body = [_field(15, 0, _varint(2)), _field(1, 2, name.encode('utf-8'))]
+    for rings, properties in features:
+        tags = []
+        for key, value in properties.items():
+            if key not in key_index:
+                key_index[key] = len(keys)
+                keys.append(key)
+            value_key = (type(value).__name__, value)
+            if value_key not in value_index:
+                value_index[value_key] = len(values)
+                values.append(value)
+            tags += [key_index[key], value_index[value_key]]
+        geometry = _encode_rings(rings)
+        feature = (
+            _field(2, 2, b''.join(_varint(t) for t in tags)) +
+            _field(3, 0, _varint(3)) +  # POLYGON
+            _field(4, 2, b''.join(_varint(c) for c in geometry))
+        )
+        body.append(_field(2, 2, feature))
+    body += [_field(3, 2, key.encode('utf-8')) for key in keys]
+    body += [_field(4, 2, _encode_value(value)) for value in values]
+    body.append(_field(5, 0, _varint(extent)))
+    return _field(3, 2, b''.join(body))
+
+# 3. Generación de teselas: recorte, simplificación por zoom y atributos
+_SIMPLIFIED = {}
+_SIMPLIFIED_LOCKS = {}
+_LOCKS_GUARD = threading.Lock()
+
+def _clip_ring(ring, z, x, y, extent, buffer):
+    """Ring clipped to the buffered tile, rounded to integer units, or None if degenerate"""
+    pts = _to_tile_units(ring, z, x, y, extent)
+    if len(pts) > 1 and (pts[0] == pts[-1]).all():
+        pts = pts[:-1]
+    lo, hi = -buffer, extent + buffer
+    if pts[:, 0].min() < lo or pts[:, 1].min() < lo or pts[:, 0].max() > hi or pts[:, 1].max() > hi:
+        box = np.array([[lo, lo], [hi, lo], [hi, hi], [lo, hi]], dtype=float)
+        pts = clip_polygon_convex(pts, box)
+    if len(pts) < 3:
+        return None
+    pts = np.round(pts).astype(np.int64)
+    distinct = np.any(pts != np.roll(pts, 1, axis=0), axis=1)
+    pts = pts[distinct]
+    if len(pts) < 3 or _signed_area(pts.astype(float)) == 0:
+        return None
+    return pts
+
+def zoom_store(city, data, z):
+    """Store simplified for zoom z (half a screen pixel), cached per city and dataset version"""
+    store = data['store']
+    if len(store) == 0:
+        return store
+    lat = float(np.mean(store.bbox[:, [1, 3]]))
+    tolerance = zoom_tolerance(z, lat)
+    if tolerance < MIN_SIMPLIFY_M:
+        return store
+
+    version = data.get('version')
+
+    def simplify():
+        # Zooms simplify in parallel; the shared topology is built once for all of them
+        topology = _single_flight((city, version, 'topology'), lambda: build_topology(store_geometries(store)))
+        return simplify_store(store, tolerance, topology=topology)[0]
+
+    return _single_flight((city, version, z), simplify)
+
+def _single_flight(key, build):
+    """
+    _SIMPLIFIED[key], built on first use. Concurrent first calls for the same
+    key share one build; other keys are not blocked.
+    """
+    value = _SIMPLIFIED.get(key)
+    if value is not None:
+        return value
+    with _LOCKS_GUARD:
+        lock = _SIMPLIFIED_LOCKS.setdefault(key, threading.Lock())
+    with lock:
+        # Another thread may have finished the build while we waited
+        if key not in _SIMPLIFIED:
+            _SIMPLIFIED[key] = build()
+        return _SIMPLIFIED[key]
+
+def render_tile(z, x, y, city_data, extent=TILE_EXTENT, buffer=TILE_BUFFER):
+    """
+    Mapbox Vector Tile (bytes) with one census_zones layer for tile z/x/y.
+    Every zone of every city in city_data touching the tile is clipped,
+    simplified for the zoom and tagged with its city, names, population,
+    area and density. Returns b'' for an empty tile.
+    """
+    min_lon, min_lat, max_lon, max_lat = tile_bounds(z, x, y)
+    # Buffer in degrees matching the buffer in tile units
+    pad_lon = (max_lon - min_lon) * buffer / extent
+    pad_lat = (max_lat - min_lat) * buffer / extent
+
+    features = []
+    for city, data in city_data.items():
+        store = data['store']
+        candidates = store.bbox_candidates(min_lon - pad_lon, min_lat - pad_lat, max_lon + pad_lon, max_lat + pad_lat)
+        if len(candidates) == 0:
+            continue
+        simplified = zoom_store(city, data, z)
+        for i in candidates:
+            rings = []
+            for outer, holes in _as_rings(simplified.polygon(i)).parts():
+                clipped = _clip_ring(outer, z, x, y, extent, buffer)
+                if clipped is None:
+                    continue
+                # MVT winding: exterior rings positive, holes negative (y down)
+                rings.append(clipped if _signed_area(clipped.astype(float)) > 0 else clipped[::-1])
+                for hole in holes:
+                    clipped = _clip_ring(hole, z, x, y, extent, buffer)
+                    if clipped is not None:
+                        rings.append(clipped if _signed_area(clipped.astype(float)) < 0 else clipped[::-1])
+            if rings:
+                features.append((rings, {'city': city, **zone_feature_properties(store, i)}))
+
+    if not features:
+        return b''
+    return encode_layer(features, extent=extent)
+
+# 4. Caché de teselas en memoria
+class TileCache:
+    """Thread-safe LRU of encoded tiles bounded by total size in bytes"""
+
+    def __init__(self, max_bytes=TILE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._tiles = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+            return tile
+
+    def set(self, key, tile):
+        with self._lock:
+            old = self._tiles.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._tiles[key] = tile
+            self._bytes += len(tile)
+            while self._bytes > self.max_bytes and len(self._tiles) > 1:
+                _, evicted = self._tiles.popitem(last=False)
+                self._bytes -= len(evicted)
+
+_TILE_CACHE = TileCache()
+
+def get_tile(z, x, y, city_data, cache=_TILE_CACHE):
+    """render_tile behind the in-memory cache (keyed by tile and dataset versions)"""
+    versions = tuple(sorted((city, str(data.get('version'))) for city, data in city_data.items()))
+    key = (z, x, y, versions)
+    tile = cache.get(key) if cache is not None else None
+    if tile is None:
+        tile = render_tile(z, x, y, city_data)
+        if cache is not None:
+            cache.set(key, tile)
+    return tile
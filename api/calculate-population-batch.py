@@ -0,0 +1,103 @@
+from http.server import BaseHTTPRequestHandler
+import json
+import sys
+import os
+import traceback
+import cgi
+
+# Add api/ directory to path for _shared imports
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _shared.data_loader import get_city, get_cities_for_polygons
+from _shared.census_calculator import (
+    parse_kml_batch,
+    estimate_batch,
+    get_result_cache,
+    parallel_workers_from_env,
+    parse_estimate_options,
+    stage,
+    begin_request,
+    finish_request
+)
+
+
+class handler(BaseHTTPRequestHandler):
+    def end_headers(self):
+        # Stage timings of this request (CENSO_METRICS=1)
+        timing = finish_request('calculate_population_batch')
+        if timing:
+            self.send_header('Server-Timing', timing)
+        super().end_headers()
+
+    def _send_json(self, status, payload):
+        with stage('json_encode'):
+            body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        begin_request()
+        try:
+            content_type = self.headers.get('Content-Type', '')
+            
+            if 'multipart/form-data' not in content_type:
+                self._send_json(400, {'error': 'Expected multipart/form-data'})
+                return
+            
+            content_length = int(self.headers.get('Content-Length', 0))
+            environ = {
+                'REQUEST_METHOD': 'POST',
+                'CONTENT_TYPE': content_type,
+                'CONTENT_LENGTH': str(content_length),
+            }
+            
+            form = cgi.FieldStorage(
+                fp=self.rfile,
+                headers=self.headers,
+                environ=environ
+            )
+            
+            if 'kml_file' not in form:
+                self._send_json(400, {'error': 'No KML file provided'})
+                return
+            
+            file_item = form['kml_file']
+            if not file_item.filename:
+                self._send_json(400, {'error': 'No file selected'})
+                return
+            
+            # Stream the KML, KMZ or ZIP upload
+            polygons = parse_kml_batch(file_item.file, file_item.filename)
+            
+            seed, _ = parse_estimate_options(form.getfirst)
+            workers = parallel_workers_from_env()
+            results = estimate_batch(
+                polygons, get_cities_for_polygons(poly for _, poly in polygons),
+                loader=get_city if workers else None, max_workers=workers,
+                cache=get_result_cache(), rng=seed
+            )
+            
+            self._send_json(200, {
+                'results': results,
+                'num_polygons': len(results),
+                'total_population': sum(r.get('population', 0) for r in results)
+            })
+            
+        except ValueError as e:
+            # Invalid upload or parameters
+            self._send_json(400, {'error': str(e)})
+        except Exception as e:
+            error_trace = traceback.format_exc()
+            print(f"Error in calculate-population-batch: {error_trace}")
+            self._send_json(500, {'error': str(e)})
+    
+    def do_OPTIONS(self):
+        """Handle CORS preflight requests."""
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.end_headers()
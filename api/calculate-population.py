@@ -8,16 +8,31 @@ import cgi
 # Add api/ directory to path for _shared imports
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from _shared.data_loader import get_city_data
+from _shared.data_loader import get_city, get_cities_for_polygon
 from _shared.census_calculator import (
     parse_kml_polygon,
-    calcular_poblacion_interseccion,
-    get_zone_statistics
+    polygon_to_geojson_geometry,
+    estimate_cities,
+    get_result_cache,
+    parallel_workers_from_env,
+    parse_demographic_filters,
+    parse_estimate_options,
+    stage,
+    begin_request,
+    finish_request
 )
 
 
 class handler(BaseHTTPRequestHandler):
+    def end_headers(self):
+        # Stage timings of this request (CENSO_METRICS=1)
+        timing = finish_request('calculate_population')
+        if timing:
+            self.send_header('Server-Timing', timing)
+        super().end_headers()
+
     def do_POST(self):
+        begin_request()
         try:
             # Parse multipart form data
             content_type = self.headers.get('Content-Type', '')
@@ -60,63 +75,62 @@ class handler(BaseHTTPRequestHandler):
                 self.wfile.write(json.dumps({'error': 'No file selected'}).encode())
                 return
             
-            # Read KML content entirely in memory - NEVER stored to disk
-            kml_content = file_item.file.read().decode('utf-8')
+            # Stream the KML/KMZ upload: every polygon, holes included
             filename = file_item.filename
-            kml_poly = parse_kml_polygon(kml_content)
+            kml_poly = parse_kml_polygon(file_item.file, filename)
             
-            city_data = get_city_data()
+            # Only cities whose extent overlaps the KML are loaded
+            city_data = get_cities_for_polygon(kml_poly)
             
-            total_pop_sum = 0
-            all_intersecting_zones = []
+            # Optional reproducibility (seed) and precision target (95% half-width, in people)
+            seed, target_error = parse_estimate_options(form.getfirst)
+            sampling = form.getfirst('sampling') or 'uniform'
+            # Optional year / age / sex breakdown for cities with a population cube
+            demographics = parse_demographic_filters(form.getfirst)
             
-            # Aggregate data from all loaded cities
-            for city_name, data in city_data.items():
-                try:
-                    total_pop = calcular_poblacion_interseccion(
-                        kml_poly, data['pop_df'], data['geo_df'],
-                        join_key_geo=data['config']
-                    )
-                    total_pop_sum += total_pop
-                    
-                    stats = get_zone_statistics(
-                        kml_poly, data['geo_df'], data['pop_df'],
-                        city_config=data['config']
-                    )
-                    all_intersecting_zones.extend(stats.get('intersecting_zones', []))
-                except Exception as e:
-                    print(f"Error processing city {city_name}: {e}")
-                    continue
+            # Aggregate all overlapping cities (process pool if configured);
+            # repeated uploads are served from the result cache
+            workers = parallel_workers_from_env()
+            stats = estimate_cities(
+                kml_poly, city_data,
+                loader=get_city if workers else None, max_workers=workers,
+                cache=get_result_cache(),
+                rng=seed,
+                target_error=target_error,
+                sampling=sampling,
+                demographics=demographics
+            )
             
             # Convert polygon to GeoJSON for map display
-            coords = [[float(coord[0]), float(coord[1])] for coord in kml_poly]
             geojson = {
                 'type': 'Feature',
-                'geometry': {
-                    'type': 'Polygon',
-                    'coordinates': [coords]
-                },
+                'geometry': polygon_to_geojson_geometry(kml_poly),
                 'properties': {
                     'name': filename
                 }
             }
             
             result = {
-                'population': round(total_pop_sum),
-                'statistics': {
-                    'total_population': round(total_pop_sum),
-                    'intersecting_zones': all_intersecting_zones,
-                    'num_zones': len(all_intersecting_zones)
-                },
+                'population': stats['total_population'],
+                'statistics': stats,
                 'geojson': geojson
             }
             
+            with stage('json_encode'):
+                body = json.dumps(result).encode()
+            
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
-            self.wfile.write(json.dumps(result).encode())
+            self.wfile.write(body)
             
+        except ValueError as e:
+            # Invalid KML or parameters (seed, target_error, sampling, demographics)
+            self.send_response(400)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps({'error': str(e)}).encode())
         except Exception as e:
             error_trace = traceback.format_exc()
             print(f"Error in calculate-population: {error_trace}")
@@ -7,12 +7,20 @@ import traceback
 # Add api/ directory to path for _shared imports
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from _shared.data_loader import get_city_data
-from _shared.census_calculator import get_census_zones_geojson
+from _shared.data_loader import get_city
+from _shared.census_calculator import get_census_zones_payload, begin_request, finish_request
 
 
 class handler(BaseHTTPRequestHandler):
+    def end_headers(self):
+        # Stage timings of this request (CENSO_METRICS=1)
+        timing = finish_request('get_census_zones')
+        if timing:
+            self.send_header('Server-Timing', timing)
+        super().end_headers()
+
     def do_GET(self):
+        begin_request()
         try:
             # Parse query parameters
             from urllib.parse import urlparse, parse_qs
@@ -23,27 +31,35 @@ class handler(BaseHTTPRequestHandler):
             sample_str = params.get('sample', [None])[0]
             sample_size = int(sample_str) if sample_str else None
             
-            city_data = get_city_data()
+            data = get_city(city)
             
-            if city not in city_data:
+            if data is None:
                 self.send_response(404)
                 self.send_header('Content-Type', 'application/json')
                 self.end_headers()
                 self.wfile.write(json.dumps({'error': f'City {city} not found'}).encode())
                 return
             
-            data = city_data[city]
-            geojson = get_census_zones_geojson(
-                data['geo_df'], data['pop_df'],
-                sample_size=sample_size,
-                city_config=data['config']
-            )
+            # Serialized and compressed once per dataset version (warm invocations reuse it)
+            payload = get_census_zones_payload(city, data, sample_size=sample_size)
+            
+            encoding, body = payload.negotiate(self.headers.get('Accept-Encoding'))
+            
+            if payload.not_modified(self.headers.get('If-None-Match')):
+                self.send_response(304)
+                self.send_header('ETag', payload.etag(encoding))
+                self.send_header('Vary', 'Accept-Encoding')
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.end_headers()
+                return
             
             self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
+            for name, value in payload.headers(encoding).items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
             self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
-            self.wfile.write(json.dumps(geojson).encode())
+            self.wfile.write(body)
             
         except Exception as e:
             error_trace = traceback.format_exc()
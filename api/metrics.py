@@ -0,0 +1,20 @@
+from http.server import BaseHTTPRequestHandler
+import sys
+import os
+
+# Add api/ directory to path for _shared imports
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _shared.census_calculator import get_stage_metrics
+
+
+class handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        # Stage durations of this instance only: each serverless instance keeps its own
+        body = get_stage_metrics().render_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
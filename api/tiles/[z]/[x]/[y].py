@@ -0,0 +1,76 @@
+from http.server import BaseHTTPRequestHandler
+import json
+import sys
+import os
+import traceback
+
+# Add api/ directory to path for _shared imports
+_api_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+sys.path.insert(0, _api_dir)
+
+import numpy as np
+
+from _shared.data_loader import get_cities_for_polygon
+from _shared.vector_tiles import MAX_ZOOM, get_tile, tile_bounds
+from _shared.census_calculator import stage, begin_request, finish_request
+
+
+class handler(BaseHTTPRequestHandler):
+    def end_headers(self):
+        # Stage timings of this request (CENSO_METRICS=1)
+        timing = finish_request('get_vector_tile')
+        if timing:
+            self.send_header('Server-Timing', timing)
+        super().end_headers()
+
+    def _send_error(self, status, message):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps({'error': message}).encode())
+
+    def do_GET(self):
+        begin_request()
+        try:
+            # Extract tile from path: /api/tiles/[z]/[x]/[y](.pbf)
+            parts = self.path.split('?')[0].strip('/').split('/')
+            # Expected: api / tiles / <z> / <x> / <y>
+            if len(parts) < 5:
+                self._send_error(400, 'Invalid path')
+                return
+            
+            try:
+                z, x = int(parts[2]), int(parts[3])
+                y = int(parts[4].split('.')[0])
+            except ValueError:
+                self._send_error(400, 'Invalid tile')
+                return
+            
+            if z < 0 or z > MAX_ZOOM:
+                self._send_error(400, f'Zoom must be between 0 and {MAX_ZOOM}')
+                return
+            if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+                self._send_error(400, 'Invalid tile')
+                return
+            
+            # Only cities whose extent overlaps the tile are loaded
+            min_lon, min_lat, max_lon, max_lat = tile_bounds(z, x, y)
+            tile_ring = np.array([
+                [min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]
+            ])
+            city_data = get_cities_for_polygon(tile_ring)
+            with stage('tile_render'):
+                tile = get_tile(z, x, y, city_data)
+            
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/vnd.mapbox-vector-tile')
+            self.send_header('Content-Length', str(len(tile)))
+            self.send_header('Cache-Control', 'public, max-age=3600')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(tile)
+            
+        except Exception as e:
+            error_trace = traceback.format_exc()
+            print(f"Error in tiles: {error_trace}")
+            self._send_error(500, str(e))
@@ -8,13 +8,20 @@ import traceback
 _api_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.insert(0, _api_dir)
 
-from _shared.data_loader import get_city_data
-from _shared.census_calculator import parse_wkt_polygon
-import pandas as pd
+from _shared.data_loader import get_city
+from _shared.census_calculator import polygon_to_geojson_geometry, stage, begin_request, finish_request
 
 
 class handler(BaseHTTPRequestHandler):
+    def end_headers(self):
+        # Stage timings of this request (CENSO_METRICS=1)
+        timing = finish_request('get_zone_detail')
+        if timing:
+            self.send_header('Server-Timing', timing)
+        super().end_headers()
+
     def do_GET(self):
+        begin_request()
         try:
             # Extract city and key from path: /api/zone-stats/[city]/[key]
             parts = self.path.strip('/').split('/')
@@ -29,17 +36,15 @@ class handler(BaseHTTPRequestHandler):
             city = parts[2]
             key = parts[3].split('?')[0]  # Remove query params if any
             
-            city_data = get_city_data()
+            data = get_city(city)
             
-            if city not in city_data:
+            if data is None:
                 self.send_response(404)
                 self.send_header('Content-Type', 'application/json')
                 self.end_headers()
                 self.wfile.write(json.dumps({'error': f'City {city} not found'}).encode())
                 return
             
-            data = city_data[city]
-            config = data['config']
             
             # Try to match key type
             try:
@@ -47,51 +52,47 @@ class handler(BaseHTTPRequestHandler):
             except ValueError:
                 key_val = key
             
-            pop_row = data['pop_df'][data['pop_df'][config['join_key_pop']] == key_val]
+            with stage('lookup', city):
+                population = data['pop_index'].get(key_val)
+                # Get geometry
+                store = data['store']
+                zone = store.zone_by_key.get(key_val)
             
-            if pop_row.empty:
+            if population is None:
                 self.send_response(404)
                 self.send_header('Content-Type', 'application/json')
                 self.end_headers()
                 self.wfile.write(json.dumps({'error': 'Zone not found in population data'}).encode())
                 return
             
-            p_row = pop_row.iloc[0]
-            
-            # Get geometry
-            secc_row = data['geo_df'][data['geo_df'][config['join_key_geo']] == key_val]
-            
-            if secc_row.empty:
+            if zone is None:
                 self.send_response(404)
                 self.send_header('Content-Type', 'application/json')
                 self.end_headers()
                 self.wfile.write(json.dumps({'error': 'Zone geometry not found'}).encode())
                 return
             
-            s_row = secc_row.iloc[0]
-            wkt = s_row[config['col_geometry']]
-            poly = parse_wkt_polygon(wkt)
-            coords = [[float(coord[0]), float(coord[1])] for coord in poly]
+            names = store.zone_properties(zone)
             
             result = {
-                'population': int(p_row['Valor']),
-                'district': str(s_row.get(config['col_district'], '')),
-                'neighborhood': str(s_row.get(config['col_neighborhood'], '')),
+                'population': int(population),
+                'district': names['district'],
+                'neighborhood': names['neighborhood'],
                 'geo_key': str(key_val),
                 'geojson': {
                     'type': 'Feature',
-                    'geometry': {
-                        'type': 'Polygon',
-                        'coordinates': [coords]
-                    }
+                    'geometry': polygon_to_geojson_geometry(store.polygon(zone))
                 }
             }
             
+            with stage('json_encode'):
+                body = json.dumps(result).encode()
+            
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
             self.end_headers()
-            self.wfile.write(json.dumps(result).encode())
+            self.wfile.write(body)
             
         except Exception as e:
             error_trace = traceback.format_exc()
@@ -1,83 +1,39 @@
-from flask import Flask, render_template, request, jsonify
-import pandas as pd
+from flask import Flask, Response, render_template, request, jsonify
 import numpy as np
 import traceback
-from census_calculator import (
-    point_in_polygon,
+from api._shared.census_calculator import (
     parse_kml_polygon,
-    parse_wkt_polygon,
-    calcular_poblacion_interseccion,
-    get_census_zones_geojson,
-    get_zone_statistics
+    get_census_zones_payload,
+    estimate_cities,
+    estimate_batch,
+    get_result_cache,
+    parse_kml_batch,
+    polygon_to_geojson_geometry,
+    parallel_workers_from_env,
+    parse_demographic_filters,
+    parse_estimate_options,
+    stage,
+    begin_request,
+    finish_request,
+    get_stage_metrics
 )
+from api._shared.data_loader import get_city, get_cities_for_polygons
+from api._shared.vector_tiles import MAX_ZOOM, get_tile, tile_bounds
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
-# Config and Data for cities
-CITY_CONFIGS = {
-    'barcelona': {
-        'pop_file': '2025_pad_mdbas.csv',
-        'geo_file': 'BarcelonaCiutat_SeccionsCensals.csv',
-        'geo_sep': ',',
-        'join_key_geo': 'seccion_key',
-        'join_key_pop': 'Seccio_Censal',
-        'col_district': 'nom_districte',
-        'col_neighborhood': 'nom_barri',
-        'col_district_code': 'codi_districte',
-        'col_section_code': 'codi_seccio_censal',
-        'col_geometry': 'geometria_wgs84'
-    },
-    'l_hospitalet': {
-        'pop_file': "L'Hospitalet/06ff0a2d-f6f8-4bf5-9ac1-ed09fda42a8b.csv",
-        'geo_file': "L'Hospitalet/TERRITORI_DIVISIONS_BAR.csv",
-        'geo_sep': '|',
-        'join_key_geo': 'CodiElement',
-        'join_key_pop': 'CodiBarri',
-        'col_district': 'NomDivisio',
-        'col_neighborhood': 'NomElement',
-        'col_district_code': 'CodiDivisio',
-        'col_section_code': 'CodiElement',
-        'col_geometry': 'Geometria_WGS84_LonLat'
-    }
-}
+# Per-stage timing (enabled with CENSO_METRICS=1): Server-Timing header on each response, aggregates at /api/metrics
+@app.before_request
+def start_stage_timing():
+    begin_request()
 
-CITY_DATA = {}
-
-def load_data():
-    """Load data for all cities at startup"""
-    for city, config in CITY_CONFIGS.items():
-        try:
-            geo_df = pd.read_csv(config['geo_file'], sep=config['geo_sep'], encoding='latin1' if config['geo_sep'] == '|' else 'utf-8')
-            pop_df = pd.read_csv(config['pop_file'])
-            
-            # Post-processing
-            if city == 'barcelona':
-                if 'seccion_key' not in geo_df.columns:
-                    geo_df['seccion_key'] = geo_df.apply(lambda r: int(f"{int(r['codi_districte']):02d}{int(r['codi_seccio_censal']):03d}"), axis=1)
-            
-            elif city == 'l_hospitalet':
-                # Map Granvia Sud (geometry 16 -> population 13)
-                geo_df.loc[geo_df['CodiElement'] == 16, 'CodiElement'] = 13
-                # LH population needs aggregation for 2025
-                pop_df = pop_df[pop_df['AnyPadro'] == 2025]
-                pop_df = pop_df.groupby('CodiBarri')['Total'].sum().reset_index()
-                pop_df.rename(columns={'Total': 'Valor'}, inplace=True)
-            
-            CITY_DATA[city] = {
-                'geo_df': geo_df,
-                'pop_df': pop_df,
-                'config': config
-            }
-            print(f"Loaded data for {city}")
-        except Exception as e:
-            print(f"Error loading data for {city}: {e}")
-
-try:
-    load_data()
-except Exception as e:
-    print(f"Error in data initialization: {e}")
-    raise
+@app.after_request
+def add_server_timing(response):
+    timing = finish_request(request.endpoint or 'not_found')
+    if timing:
+        response.headers['Server-Timing'] = timing
+    return response
 
 @app.route('/')
 def index():
@@ -89,13 +45,17 @@ def get_census_zones():
     """Get all census zones as GeoJSON for map display"""
     try:
         city = request.args.get('city', 'barcelona')
-        if city not in CITY_DATA:
+        data = get_city(city)
+        if data is None:
             return jsonify({'error': f'City {city} not found'}), 404
             
-        data = CITY_DATA[city]
         sample_size = request.args.get('sample', type=int)
-        geojson = get_census_zones_geojson(data['geo_df'], data['pop_df'], sample_size=sample_size, city_config=data['config'])
-        return jsonify(geojson)
+        # Serialized and compressed once per dataset version; revalidations get a 304
+        payload = get_census_zones_payload(city, data, sample_size=sample_size)
+        encoding, body = payload.negotiate(request.headers.get('Accept-Encoding'))
+        if payload.not_modified(request.headers.get('If-None-Match')):
+            return Response(status=304, headers={'ETag': payload.etag(encoding), 'Vary': 'Accept-Encoding'})
+        return Response(body, headers=payload.headers(encoding))
     except Exception as e:
         error_trace = traceback.format_exc()
         print(f"Error in get_census_zones: {error_trace}")
@@ -112,67 +72,115 @@ def calculate_population():
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
         
-        # Read KML content once
-        kml_content = file.read().decode('utf-8')
-        kml_poly = parse_kml_polygon(kml_content)
-        
-        total_pop_sum = 0
-        all_intersecting_zones = []
-        
-        # Aggregate data from all loaded cities
-        for city_name, data in CITY_DATA.items():
-            try:
-                # Calculate population for this city
-                total_pop = calcular_poblacion_interseccion(
-                    kml_poly, data['pop_df'], data['geo_df'], 
-                    join_key_geo=data['config']
-                )
-                total_pop_sum += total_pop
-                
-                # Get statistics for this city
-                stats = get_zone_statistics(kml_poly, data['geo_df'], data['pop_df'], city_config=data['config'])
-                all_intersecting_zones.extend(stats.get('intersecting_zones', []))
-            except Exception as e:
-                print(f"Error processing city {city_name} in calculation: {e}")
-                continue
+        # Stream the KML/KMZ upload: every polygon, holes included
+        kml_poly = parse_kml_polygon(file.stream, file.filename)
+        
+        # Only cities whose extent overlaps the KML are loaded
+        city_data = get_cities_for_polygons([kml_poly])
+        
+        # Optional reproducibility (seed) and precision target (95% half-width, in people)
+        seed, target_error = parse_estimate_options(request.form.get)
+        sampling = request.form.get('sampling', 'uniform')
+        # Optional year / age / sex breakdown for cities with a population cube
+        demographics = parse_demographic_filters(request.form.get)
+        
+        # Aggregate all overlapping cities (process pool if configured); repeated uploads hit the result cache
+        workers = parallel_workers_from_env()
+        stats = estimate_cities(
+            kml_poly, city_data, loader=get_city if workers else None, max_workers=workers, cache=get_result_cache(),
+            rng=seed, target_error=target_error, sampling=sampling, demographics=demographics
+        )
         
         # Convert polygon to GeoJSON for map display
-        coords = [[float(coord[0]), float(coord[1])] for coord in kml_poly]
         geojson = {
             'type': 'Feature',
-            'geometry': {
-                'type': 'Polygon',
-                'coordinates': [coords]
-            },
+            'geometry': polygon_to_geojson_geometry(kml_poly),
             'properties': {
                 'name': file.filename
             }
         }
         
-        return jsonify({
-            'population': round(total_pop_sum),
-            'statistics': {
-                'total_population': round(total_pop_sum),
-                'intersecting_zones': all_intersecting_zones,
-                'num_zones': len(all_intersecting_zones)
-            },
-            'geojson': geojson
-        })
+        with stage('json_encode'):
+            return jsonify({
+                'population': stats['total_population'],
+                'statistics': stats,
+                'geojson': geojson
+            })
     
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         error_trace = traceback.format_exc()
         print(f"Error in calculate_population: {error_trace}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/calculate-population-batch', methods=['POST'])
+def calculate_population_batch():
+    """Calculate population for every polygon of a multi-Placemark KML or a ZIP of KMLs"""
+    try:
+        if 'kml_file' not in request.files:
+            return jsonify({'error': 'No KML file provided'}), 400
+        
+        file = request.files['kml_file']
+        if file.filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+        
+        polygons = parse_kml_batch(file.stream, file.filename)
+        
+        seed, _ = parse_estimate_options(request.form.get)
+        workers = parallel_workers_from_env()
+        results = estimate_batch(
+            polygons, get_cities_for_polygons(poly for _, poly in polygons),
+            loader=get_city if workers else None, max_workers=workers,
+            cache=get_result_cache(), rng=seed
+        )
+        
+        with stage('json_encode'):
+            return jsonify({
+                'results': results,
+                'num_polygons': len(results),
+                'total_population': sum(r.get('population', 0) for r in results)
+            })
+    
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        error_trace = traceback.format_exc()
+        print(f"Error in calculate_population_batch: {error_trace}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/tiles/<int:z>/<int:x>/<int:y>.pbf', methods=['GET'])
+def get_vector_tile(z, x, y):
+    """Mapbox Vector Tile of the census zones of every city touching tile z/x/y"""
+    try:
+        if z < 0 or z > MAX_ZOOM:
+            return jsonify({'error': f'Zoom must be between 0 and {MAX_ZOOM}'}), 400
+        if not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            return jsonify({'error': 'Invalid tile'}), 400
+        
+        # Only cities whose extent overlaps the tile are loaded
+        min_lon, min_lat, max_lon, max_lat = tile_bounds(z, x, y)
+        tile_ring = np.array([[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]])
+        city_data = get_cities_for_polygons([tile_ring])
+        with stage('tile_render'):
+            tile = get_tile(z, x, y, city_data)
+        
+        return Response(tile, headers={
+            'Content-Type': 'application/vnd.mapbox-vector-tile',
+            'Cache-Control': 'public, max-age=3600'
+        })
+    except Exception as e:
+        error_trace = traceback.format_exc()
+        print(f"Error in get_vector_tile: {error_trace}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/zone-stats/<city>/<key>', methods=['GET'])
 def get_zone_detail(city, key):
     """Get detailed statistics for a specific census zone"""
     try:
-        if city not in CITY_DATA:
+        data = get_city(city)
+        if data is None:
             return jsonify({'error': f'City {city} not found'}), 404
-            
-        data = CITY_DATA[city]
-        config = data['config']
         
         # Try to match key type (numeric if possible)
         try:
@@ -180,41 +188,43 @@ def get_zone_detail(city, key):
         except ValueError:
             key_val = key
 
-        pop_row = data['pop_df'][data['pop_df'][config['join_key_pop']] == key_val]
+        with stage('lookup', city):
+            population = data['pop_index'].get(key_val)
+            # Get geometry
+            store = data['store']
+            zone = store.zone_by_key.get(key_val)
         
-        if pop_row.empty:
+        if population is None:
             return jsonify({'error': 'Zone not found in population data'}), 404
         
-        p_row = pop_row.iloc[0]
-        
-        # Get geometry
-        secc_row = data['geo_df'][data['geo_df'][config['join_key_geo']] == key_val]
-        
-        if secc_row.empty:
+        if zone is None:
             return jsonify({'error': 'Zone geometry not found'}), 404
         
-        s_row = secc_row.iloc[0]
-        wkt = s_row[config['col_geometry']]
-        poly = parse_wkt_polygon(wkt)
-        coords = [[float(coord[0]), float(coord[1])] for coord in poly]
-        
-        return jsonify({
-            'population': int(p_row['Valor']),
-            'district': str(s_row.get(config['col_district'], '')),
-            'neighborhood': str(s_row.get(config['col_neighborhood'], '')),
-            'geo_key': str(key_val),
-            'geojson': {
-                'type': 'Feature',
-                'geometry': {
-                    'type': 'Polygon',
-                    'coordinates': [coords]
+        names = store.zone_properties(zone)
+        
+        with stage('json_encode'):
+            return jsonify({
+                'population': int(population),
+                'district': names['district'],
+                'neighborhood': names['neighborhood'],
+                'geo_key': str(key_val),
+                'geojson': {
+                    'type': 'Feature',
+                    'geometry': polygon_to_geojson_geometry(store.polygon(zone))
                 }
-            }
-        })
+            })
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Stage durations per city in Prometheus text format (empty unless CENSO_METRICS=1)"""
+    return Response(get_stage_metrics().render_prometheus(), headers={
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+        'Cache-Control': 'no-store'
+    })
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
 
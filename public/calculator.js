@@ -20,6 +20,20 @@ function pointInPolygon(x, y, polygon) {
     return inside;
 }
 
+// Every ring of a Polygon / MultiPolygon geometry (outer rings and holes)
+function geometryRings(geometry) {
+    return geometry.type === 'MultiPolygon' ? geometry.coordinates.flat() : geometry.coordinates;
+}
+
+// Even-odd rule over all rings, so holes and extra parts are respected
+function pointInRings(x, y, rings) {
+    let inside = false;
+    for (const ring of rings) {
+        if (pointInPolygon(x, y, ring)) inside = !inside;
+    }
+    return inside;
+}
+
 // Parse <coordinates> from KML text → [[lon, lat], ...]
 function parseKMLPolygon(kmlText) {
     const match = kmlText.match(/<coordinates>([\s\S]*?)<\/coordinates>/i);
@@ -45,11 +59,12 @@ function calculatePopulationFromKML(kmlCoords, features) {
     // Pass 1 — bbox + quick 100-point check
     const candidates = [];
     for (const feature of features) {
-        const poly = feature.geometry.coordinates[0];
-        const zMinX = Math.min(...poly.map(c => c[0]));
-        const zMaxX = Math.max(...poly.map(c => c[0]));
-        const zMinY = Math.min(...poly.map(c => c[1]));
-        const zMaxY = Math.max(...poly.map(c => c[1]));
+        const poly = geometryRings(feature.geometry);
+        const vertices = poly.flat();
+        const zMinX = Math.min(...vertices.map(c => c[0]));
+        const zMaxX = Math.max(...vertices.map(c => c[0]));
+        const zMinY = Math.min(...vertices.map(c => c[1]));
+        const zMaxY = Math.max(...vertices.map(c => c[1]));
 
         if (zMaxX < kmlMinX || zMinX > kmlMaxX || zMaxY < kmlMinY || zMinY > kmlMaxY) continue;
 
@@ -59,7 +74,7 @@ function calculatePopulationFromKML(kmlCoords, features) {
         for (let i = 0; i < 100; i++) {
             const x = oMinX + Math.random() * (oMaxX - oMinX);
             const y = oMinY + Math.random() * (oMaxY - oMinY);
-            if (pointInPolygon(x, y, poly)) {
+            if (pointInRings(x, y, poly)) {
                 inZone++;
                 if (pointInPolygon(x, y, kmlCoords)) inBoth++;
             }
@@ -84,7 +99,7 @@ function calculatePopulationFromKML(kmlCoords, features) {
         for (let i = 0; i < nPts; i++) {
             const x = zMinX + Math.random() * (zMaxX - zMinX);
             const y = zMinY + Math.random() * (zMaxY - zMinY);
-            if (pointInPolygon(x, y, poly)) {
+            if (pointInRings(x, y, poly)) {
                 inZone++;
                 if (pointInPolygon(x, y, kmlCoords)) inBoth++;
             }
@@ -0,0 +1,352 @@
+"""
+Latency, throughput and memory benchmarks of the calculator and the API.
+
+Every case runs a few warm-up calls followed by --repeat timed calls and
+reports the mean and p50/p95/p99 latency, throughput (calls per second) and
+the peak Python/numpy allocation of one extra call (tracemalloc). Results are
+written as JSON tagged with the git commit, so runs can be compared across
+commits with --compare.
+
+Cases:
+    load/...        get_city cold (snapshot), CSV load without snapshot, warm lookups,
+                    get_city_data, and a cold process start (import + load)
+    parse/...       KML parsing of each fixture
+    calc/...        calcular_poblacion_interseccion, get_zone_statistics and
+                    get_census_zones_geojson with each city's prebuilt store
+    flask/...       app.py routes through Flask's test client
+    serverless/...  api/*.py handlers driven with an in-memory socket
+
+Fixtures are KML documents of increasing size and vertex count for both
+cities: synthetic circles (250 m / 16 vertices up to 2.5 km / 4096 vertices)
+and real boundaries (the city's most detailed census section, as is and
+scaled x4 around its centre). The result cache is disabled unless --cache is
+given, so repeated calls measure the estimate itself.
+
+Usage:
+    cd /path/to/Censo-Territorio
+    python scripts/benchmark.py
+    python scripts/benchmark.py --repeat 20 --filter calc/ flask/
+    python scripts/benchmark.py --output before.json
+    python scripts/benchmark.py --compare before.json
+"""
+import sys
+import os
+import io
+import gc
+import json
+import math
+import time
+import platform
+import argparse
+import contextlib
+import subprocess
+import tracemalloc
+import importlib.util
+import numpy as np
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+parser = argparse.ArgumentParser(description='Latency, throughput and memory benchmarks of the calculator and the API')
+parser.add_argument('--repeat', type=int, default=10, help='timed calls per case (default 10)')
+parser.add_argument('--warmup', type=int, default=1, help='untimed calls before timing (default 1)')
+parser.add_argument('--filter', nargs='*', default=[], help='only run cases whose name contains one of these strings')
+parser.add_argument('--cities', nargs='*', default=None, help='cities to benchmark (default: all)')
+parser.add_argument('--output', default=None,
+                    help='JSON results file (default benchmark-results/<commit>.json)')
+parser.add_argument('--compare', default=None, help='earlier results file to compare p50 latencies against')
+parser.add_argument('--cache', action='store_true', help='keep the result cache enabled')
+parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run of each case')
+args = parser.parse_args()
+
+# Must be set before the calculator creates its process-wide cache
+if not args.cache:
+    os.environ['CENSO_RESULT_CACHE_SIZE'] = '0'
+
+sys.path.insert(0, PROJECT_ROOT)
+
+from api._shared import data_loader
+from api._shared.census_calculator import (
+    parse_kml_polygon, calcular_poblacion_interseccion, get_zone_statistics, get_census_zones_geojson
+)
+
+# 1. Fixtures KML
+CIRCLES = [(250, 16), (1000, 256), (2500, 4096)]  # (radius in m, vertices)
+
+def kml_document(name, ring):
+    """KML with a single Placemark for a closed (lon, lat) ring"""
+    coords = ' '.join(f"{lon:.7f},{lat:.7f},0" for lon, lat in ring)
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<kml xmlns="http://www.opengis.net/kml/2.2"><Document><Placemark>'
+        f'<name>{name}</name><Polygon><outerBoundaryIs><LinearRing>'
+        f'<coordinates>{coords}</coordinates>'
+        '</LinearRing></outerBoundaryIs></Polygon></Placemark></Document></kml>'
+    ).encode('utf-8')
+
+def circle(lon, lat, radius_m, n_vertices):
+    angles = np.linspace(0, 2 * math.pi, n_vertices, endpoint=False)
+    d_lat = radius_m / 111_320.0
+    d_lon = d_lat / math.cos(math.radians(lat))
+    ring = np.column_stack([lon + d_lon * np.cos(angles), lat + d_lat * np.sin(angles)])
+    return np.vstack([ring, ring[:1]])
+
+def outer_ring(poly):
+    """Exterior ring of a store polygon (plain array or Rings)"""
+    return poly.parts()[0][0] if hasattr(poly, 'parts') else np.asarray(poly)
+
+def city_fixtures(city, data):
+    """(name, kml bytes) of increasing size and vertex count for one city"""
+    min_lon, min_lat, max_lon, max_lat = data['config']['extent']
+    lon, lat = (min_lon + max_lon) / 2, (min_lat + max_lat) / 2
+    fixtures = []
+    for radius, vertices in CIRCLES:
+        name = f'{city}/circle-{radius}m-{vertices}v'
+        fixtures.append((name, kml_document(name, circle(lon, lat, radius, vertices))))
+
+    store = data['store']
+    detailed = max(range(len(store)), key=lambda i: len(outer_ring(store.polygon(i))))
+    ring = outer_ring(store.polygon(detailed))
+    centre = ring[:-1].mean(axis=0)
+    for scale in (1, 4):
+        scaled = centre + (ring - centre) * scale
+        name = f'{city}/section-x{scale}-{len(ring) - 1}v'
+        fixtures.append((name, kml_document(name, scaled)))
+    return fixtures
+
+# 2. Medición
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+def measure(fn, repeat, warmup, setup=None, memory=True):
+    """Time repeat calls of fn (setup runs untimed before each one); peak memory from one traced call"""
+    timings = []
+    # Calculator progress and handler access logs would swamp the report
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        for _ in range(warmup):
+            if setup:
+                setup()
+            fn()
+        for _ in range(repeat):
+            if setup:
+                setup()
+            gc.collect()
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+
+        peak_kb = None
+        if memory:
+            if setup:
+                setup()
+            gc.collect()
+            tracemalloc.start()
+            try:
+                fn()
+                peak_kb = tracemalloc.get_traced_memory()[1] / 1024
+            finally:
+                tracemalloc.stop()
+
+    ms = [t * 1000 for t in timings]
+    return {
+        'runs': len(ms),
+        'mean_ms': round(float(np.mean(ms)), 3),
+        'min_ms': round(min(ms), 3),
+        'p50_ms': round(percentile(ms, 50), 3),
+        'p95_ms': round(percentile(ms, 95), 3),
+        'p99_ms': round(percentile(ms, 99), 3),
+        'throughput_per_s': round(len(ms) / sum(timings), 2) if sum(timings) > 0 else None,
+        'peak_memory_kb': round(peak_kb, 1) if peak_kb is not None else None
+    }
+
+# 3. Ejecución de los handlers serverless sin servidor HTTP
+def load_handler(relative_path):
+    path = os.path.join(PROJECT_ROOT, relative_path)
+    name = 'bench_' + relative_path.replace('/', '_').replace('-', '_').replace('[', '').replace(']', '')[:-3]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.handler
+
+class _Socket:
+    """Just enough of a socket for BaseHTTPRequestHandler: request in, response captured"""
+
+    def __init__(self, request):
+        self.rfile = io.BytesIO(request)
+        self.wfile = io.BytesIO()
+
+    def makefile(self, mode, *args, **kwargs):
+        return self.rfile if 'r' in mode else self.wfile
+
+    def sendall(self, data):
+        self.wfile.write(data)
+
+def call_handler(handler, method, path, body=b'', headers=None):
+    """Run one request through a serverless handler class; returns the status code"""
+    headers = dict(headers or {})
+    if body:
+        headers['Content-Length'] = str(len(body))
+    head = f"{method} {path} HTTP/1.1\r\nHost: localhost\r\n"
+    head += ''.join(f"{k}: {v}\r\n" for k, v in headers.items()) + "\r\n"
+    sock = _Socket(head.encode('latin-1') + body)
+    handler(sock, ('127.0.0.1', 0), None)
+    status_line = sock.wfile.getvalue().split(b'\r\n', 1)[0]
+    return int(status_line.split()[1])
+
+def multipart(filename, content, fields=None):
+    boundary = '----censo-benchmark'
+    parts = [
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode('utf-8')
+        for k, v in (fields or {}).items()
+    ]
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="kml_file"; filename="{filename}"\r\n'
+        'Content-Type: application/vnd.google-earth.kml+xml\r\n\r\n'.encode('utf-8') + content + b'\r\n'
+    )
+    parts.append(f'--{boundary}--\r\n'.encode('utf-8'))
+    return b''.join(parts), {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+
+def expect_ok(status):
+    if status != 200:
+        raise RuntimeError(f"HTTP {status}")
+
+# 4. Casos
+def git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_ROOT,
+                             capture_output=True, text=True, check=True)
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=PROJECT_ROOT,
+                               capture_output=True, text=True).stdout.strip()
+        return out.stdout.strip() + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def selected(name):
+    return not args.filter or any(f in name for f in args.filter)
+
+results = {}
+
+def run_case(name, fn, setup=None, repeat=None):
+    if not selected(name):
+        return
+    try:
+        result = measure(fn, repeat or args.repeat, args.warmup, setup, memory=not args.no_memory)
+    except Exception as e:
+        print(f"{name:<64} failed: {e}")
+        results[name] = {'error': str(e)}
+        return
+    results[name] = result
+    memory = f"{result['peak_memory_kb'] / 1024:>9.1f} MB" if result['peak_memory_kb'] is not None else ''
+    print(f"{name:<64}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+          f"{result['throughput_per_s']:>10.1f}{memory}")
+
+cities = args.cities or list(data_loader.CITY_CONFIGS)
+commit = git_commit()
+print(f"Benchmark at {commit}, {args.repeat} runs per case\n")
+print(f"{'case':<64}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'calls/s':>10}{'peak mem':>12}")
+
+# Cold process: interpreter start, imports and loading every city
+cold_process = (
+    "import sys; sys.path.insert(0, %r); "
+    "from api._shared.data_loader import get_city_data; get_city_data()" % PROJECT_ROOT
+)
+run_case('load/process-cold', lambda: subprocess.run([sys.executable, '-c', cold_process], check=True,
+                                                      capture_output=True),
+         repeat=max(1, min(args.repeat, 3)))
+
+def evict(city):
+    return lambda: data_loader._CITY_DATA.pop(city, None)
+
+for city in cities:
+    run_case(f'load/{city}/cold', lambda c=city: data_loader.get_city(c), setup=evict(city))
+    run_case(f'load/{city}/warm', lambda c=city: data_loader.get_city(c))
+run_case('load/get_city_data/warm', data_loader.get_city_data)
+for city in cities:
+    run_case(f'load/{city}/cold-csv',
+             lambda c=city: data_loader._load_city(c, data_loader.CITY_CONFIGS[c], PROJECT_ROOT, use_snapshot=False),
+             repeat=max(1, min(args.repeat, 3)))
+
+city_data = {city: data_loader.get_city(city) for city in cities}
+
+flask_client = None
+if selected('flask/'):
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            import app as flask_app
+        flask_client = flask_app.app.test_client()
+    except ImportError as e:
+        print(f"Flask app not available ({e}); skipping flask/ cases")
+
+handlers = {}
+if any(selected(p) for p in ('serverless/',)):
+    handlers = {
+        'calculate-population': load_handler('api/calculate-population.py'),
+        'census-zones': load_handler('api/census-zones.py'),
+        'zone-stats': load_handler('api/zone-stats/[city]/[key].py')
+    }
+
+for city, data in city_data.items():
+    store, config = data['store'], data['config']
+    zone_key = next(iter(data['pop_index']))
+
+    run_case(f'calc/{city}/get_census_zones_geojson',
+             lambda s=store, c=config: get_census_zones_geojson(None, None, city_config=c, store=s))
+    run_case(f'calc/{city}/get_census_zones_geojson-sample50',
+             lambda s=store, c=config: get_census_zones_geojson(None, None, 50, city_config=c, store=s))
+    if flask_client is not None:
+        run_case(f'flask/{city}/census-zones',
+                 lambda c=city: expect_ok(flask_client.get(f'/api/census-zones?city={c}').status_code))
+        run_case(f'flask/{city}/zone-stats',
+                 lambda c=city, k=zone_key: expect_ok(flask_client.get(f'/api/zone-stats/{c}/{k}').status_code))
+    if handlers:
+        run_case(f'serverless/{city}/census-zones',
+                 lambda c=city: expect_ok(call_handler(handlers['census-zones'], 'GET', f'/api/census-zones?city={c}')))
+        run_case(f'serverless/{city}/zone-stats',
+                 lambda c=city, k=zone_key: expect_ok(call_handler(handlers['zone-stats'], 'GET', f'/api/zone-stats/{c}/{k}')))
+
+    for name, kml in city_fixtures(city, data):
+        if not any(selected(f'{prefix}/{name}') for prefix in ('parse', 'calc', 'flask', 'serverless')):
+            continue
+        poly = parse_kml_polygon(kml, 'fixture.kml')
+        run_case(f'parse/{name}', lambda k=kml: parse_kml_polygon(k, 'fixture.kml'))
+        run_case(f'calc/{name}/calcular_poblacion_interseccion',
+                 lambda p=poly, s=store, c=config: calcular_poblacion_interseccion(p, None, None, join_key_geo=c, store=s, rng=0))
+        run_case(f'calc/{name}/get_zone_statistics',
+                 lambda p=poly, s=store, c=config: get_zone_statistics(p, None, None, city_config=c, store=s, rng=0))
+        if flask_client is not None:
+            run_case(f'flask/{name}/calculate-population', lambda k=kml: expect_ok(flask_client.post(
+                '/api/calculate-population', content_type='multipart/form-data',
+                data={'kml_file': (io.BytesIO(k), 'fixture.kml'), 'seed': '0'}
+            ).status_code))
+        if handlers:
+            body, headers = multipart('fixture.kml', kml, {'seed': '0'})
+            run_case(f'serverless/{name}/calculate-population', lambda b=body, h=headers: expect_ok(
+                call_handler(handlers['calculate-population'], 'POST', '/api/calculate-population', b, h)))
+
+# 5. Resultados
+report = {
+    'commit': commit,
+    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    'python': platform.python_version(),
+    'numpy': np.__version__,
+    'platform': platform.platform(),
+    'cpus': os.cpu_count(),
+    'repeat': args.repeat,
+    'result_cache': args.cache,
+    'results': results
+}
+output = args.output or os.path.join(PROJECT_ROOT, 'benchmark-results', f'{commit}.json')
+os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+with open(output, 'w', encoding='utf-8') as f:
+    json.dump(report, f, indent=2)
+print(f"\nResults written to {output}")
+
+if args.compare:
+    with open(args.compare, encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\np50 latency vs {baseline.get('commit', args.compare)} (ratio < 1 is faster):")
+    for name, result in results.items():
+        before = baseline.get('results', {}).get(name)
+        if not before or 'p50_ms' not in before or 'p50_ms' not in result:
+            continue
+        ratio = result['p50_ms'] / before['p50_ms'] if before['p50_ms'] else float('nan')
+        print(f"  {name:<64}{before['p50_ms']:>10.2f}{result['p50_ms']:>10.2f}{ratio:>8.2f}x")
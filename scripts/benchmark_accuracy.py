@@ -0,0 +1,185 @@
+"""
+Accuracy versus cost of the calculator's settings. Random star-shaped
+polygons (100 m to ~4 km across, so every zone-count tier is exercised) are
+dropped over each city and compared with a high-precision reference: the
+population-weighted exact area of every zone they overlap (Sutherland–Hodgman,
+no 10% cut-off). Each configuration re-runs the estimate for every polygon
+and seed and reports its relative bias, relative RMSE and CPU time, followed
+by the Pareto frontier (no other configuration is both more accurate and
+cheaper).
+
+Configurations swept:
+    exact           method='exact' (area clipping)
+    tiers A/B P     the default adaptive points: P[0] points per zone up to A
+                    intersecting zones, P[1] up to B, P[2] beyond
+                    (the calculator default is 10/50 10000/5000/1000)
+    fixed N         n_points=N for every polygon
+each with every --sampling strategy and every --min-ratio, the share of a
+zone below which it is dropped (the calculator uses 10%, which biases small
+polygons downwards; 0 isolates the sampling error).
+
+Usage:
+    cd /path/to/Censo-Territorio
+    python scripts/benchmark_accuracy.py
+    python scripts/benchmark_accuracy.py --polygons 30 --repeats 3 --sampling uniform sobol triangulated
+    python scripts/benchmark_accuracy.py --thresholds 10:50 20:100 --tier-points 10000:5000:1000 5000:2500:500
+    python scripts/benchmark_accuracy.py --output accuracy.json
+"""
+import sys
+import os
+import io
+import json
+import math
+import time
+import argparse
+import contextlib
+import numpy as np
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api._shared.data_loader import get_city, CITY_CONFIGS
+from api._shared.census_calculator import (
+    SAMPLING_STRATEGIES, MONTE_CARLO_TIERS, MONTE_CARLO_MIN_POINTS, MIN_ZONE_RATIO, intersection_ratio,
+    _candidate_zones, _counted_zones, _n_contributing, _screen_zones, _refine_zones, _target_n_points
+)
+
+def pair(text, n):
+    values = tuple(int(v) for v in text.split(':'))
+    if len(values) != n:
+        raise argparse.ArgumentTypeError(f"expected {n} integers separated by ':' (got {text!r})")
+    return values
+
+default_thresholds = ':'.join(str(max_zones) for max_zones, _ in MONTE_CARLO_TIERS)
+default_points = ':'.join([str(points) for _, points in MONTE_CARLO_TIERS] + [str(MONTE_CARLO_MIN_POINTS)])
+
+parser = argparse.ArgumentParser(description='Bias, RMSE and CPU time of the estimator settings against an exact reference')
+parser.add_argument('--cities', nargs='*', default=list(CITY_CONFIGS))
+parser.add_argument('--polygons', type=int, default=10, help='random polygons per city (default 10)')
+parser.add_argument('--repeats', type=int, default=2, help='seeds per polygon and configuration (default 2)')
+parser.add_argument('--sampling', nargs='*', default=['uniform', 'sobol'], choices=SAMPLING_STRATEGIES)
+parser.add_argument('--n-points', type=int, nargs='*', default=[250, 1000, 2500, 5000, 10000],
+                    help='fixed points per zone to try')
+parser.add_argument('--thresholds', type=lambda t: pair(t, 2), nargs='*',
+                    default=[pair('5:25', 2), pair(default_thresholds, 2), pair('20:100', 2)],
+                    help='zone-count tier limits A:B to try (default 5:25 10:50 20:100)')
+parser.add_argument('--tier-points', type=lambda t: pair(t, 3), nargs='*',
+                    default=[pair('5000:2500:500', 3), pair(default_points, 3), pair('20000:10000:2000', 3)],
+                    help='points per tier P0:P1:P2 to try')
+parser.add_argument('--min-ratio', type=float, nargs='*', default=[MIN_ZONE_RATIO, 0.0],
+                    help=f'zone cut-offs to try (default {MIN_ZONE_RATIO} 0)')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--output', default=None, help='also write the table as JSON')
+args = parser.parse_args()
+
+def random_polygon(rng, extent):
+    """Star-shaped polygon of 8-24 vertices with a log-uniform size, inside the city extent"""
+    min_lon, min_lat, max_lon, max_lat = extent
+    cx = rng.uniform(min_lon + 0.25 * (max_lon - min_lon), max_lon - 0.25 * (max_lon - min_lon))
+    cy = rng.uniform(min_lat + 0.25 * (max_lat - min_lat), max_lat - 0.25 * (max_lat - min_lat))
+    n = int(rng.integers(8, 25))
+    angles = np.sort(rng.uniform(0, 2 * math.pi, n))
+    radius = math.exp(rng.uniform(math.log(0.001), math.log(0.02))) * rng.uniform(0.5, 1.0, n)
+    ring = np.column_stack([cx + radius * np.cos(angles), cy + radius * np.sin(angles) * 0.75])
+    return np.vstack([ring, ring[:1]])
+
+def reference_population(poly, store):
+    """Population-weighted exact overlap of every zone (no 10% cut-off)"""
+    return sum(
+        float(store.population[i]) * intersection_ratio(store.polygon(i), poly)
+        for i in _candidate_zones(poly, store) if store.has_population[i]
+    )
+
+def configurations():
+    configs = []
+    for min_ratio in args.min_ratio:
+        cut = f"cut {min_ratio * 100:g}%"
+        configs.append({'name': f"exact {cut}", 'method': 'exact', 'min_ratio': min_ratio})
+        for sampling in args.sampling:
+            for thresholds in args.thresholds:
+                for points in args.tier_points:
+                    configs.append({
+                        'name': f"tiers {thresholds[0]}/{thresholds[1]} {points[0]}/{points[1]}/{points[2]} {sampling} {cut}",
+                        'method': 'montecarlo', 'sampling': sampling, 'min_ratio': min_ratio,
+                        'tiers': ((thresholds[0], points[0]), (thresholds[1], points[1])), 'min_points': points[2],
+                        'default': (thresholds == pair(default_thresholds, 2) and points == pair(default_points, 3)
+                                    and sampling == 'uniform' and min_ratio == MIN_ZONE_RATIO)
+                    })
+            for n_points in args.n_points:
+                configs.append({'name': f"fixed {n_points} {sampling} {cut}", 'method': 'montecarlo',
+                                'sampling': sampling, 'min_ratio': min_ratio, 'n_points': n_points})
+    return configs
+
+def estimate(poly, store, config, seed):
+    """Estimated population with one configuration (same two passes as _intersect_zones)"""
+    min_ratio = config['min_ratio']
+    zones = _screen_zones(poly, store, _candidate_zones(poly, store), config['method'], seed)
+    if config['method'] != 'exact':
+        n_points = _target_n_points(_n_contributing(store, zones, min_ratio), config.get('n_points'),
+                                    config.get('tiers', MONTE_CARLO_TIERS), config.get('min_points', MONTE_CARLO_MIN_POINTS))
+        zones = _refine_zones(poly, store, zones, n_points, seed, None, config['sampling'])
+    return sum(float(store.population[z['zone']]) * z['ratio'] for z in _counted_zones(zones, store, min_ratio))
+
+rng = np.random.default_rng(args.seed)
+cases = []
+for city in args.cities:
+    with contextlib.redirect_stdout(io.StringIO()):
+        data = get_city(city)
+    if data is None:
+        print(f"Skipping {city}: data not available")
+        continue
+    store = data['store']
+    made = 0
+    while made < args.polygons:
+        poly = random_polygon(rng, data['config']['extent'])
+        reference = reference_population(poly, store)
+        # Polygons over empty areas (port, parks) have no relative error
+        if reference >= 100:
+            cases.append((city, poly, store, reference, len(_candidate_zones(poly, store))))
+            made += 1
+print(f"{len(cases)} polygons ({', '.join(args.cities)}), {min(c[4] for c in cases)}-{max(c[4] for c in cases)} "
+      f"candidate zones, {args.repeats} seeds each\n")
+
+rows = []
+for config in configurations():
+    errors, cpu = [], 0.0
+    repeats = 1 if config['method'] == 'exact' else args.repeats
+    for repeat in range(repeats):
+        for city, poly, store, reference, _ in cases:
+            start = time.process_time()
+            value = estimate(poly, store, config, args.seed + repeat)
+            cpu += time.process_time() - start
+            errors.append((value - reference) / reference)
+    errors = np.array(errors)
+    rows.append({
+        'config': config['name'],
+        'default': bool(config.get('default')),
+        'bias_pct': round(float(errors.mean()) * 100, 4),
+        'rmse_pct': round(float(np.sqrt(np.mean(errors ** 2))) * 100, 4),
+        'max_abs_pct': round(float(np.abs(errors).max()) * 100, 4),
+        'cpu_ms': round(cpu / (repeats * len(cases)) * 1000, 2)
+    })
+
+# Pareto frontier: nothing else has both lower RMSE and lower CPU time
+for row in rows:
+    row['pareto'] = not any(
+        other['rmse_pct'] <= row['rmse_pct'] and other['cpu_ms'] <= row['cpu_ms'] and
+        (other['rmse_pct'] < row['rmse_pct'] or other['cpu_ms'] < row['cpu_ms'])
+        for other in rows
+    )
+
+print(f"{'configuration':<56}{'bias':>9}{'RMSE':>9}{'max err':>9}{'CPU ms':>10}")
+for row in sorted(rows, key=lambda r: r['cpu_ms']):
+    marks = ('*' if row['pareto'] else ' ') + ('d' if row['default'] else ' ')
+    print(f"{marks} {row['config']:<53}{row['bias_pct']:>8.3f}%{row['rmse_pct']:>8.3f}%"
+          f"{row['max_abs_pct']:>8.2f}%{row['cpu_ms']:>10.1f}")
+print("\n* Pareto frontier, d current default (errors relative to the exact overlap)")
+
+print("\nPareto frontier (cheapest first):")
+for row in sorted((r for r in rows if r['pareto']), key=lambda r: r['cpu_ms']):
+    print(f"  {row['config']:<54} RMSE {row['rmse_pct']:.3f}%  {row['cpu_ms']:.1f} ms")
+
+if args.output:
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'polygons': len(cases), 'repeats': args.repeats, 'seed': args.seed, 'results': rows}, f, indent=2)
+    print(f"\nResults written to {args.output}")
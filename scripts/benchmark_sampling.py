@@ -0,0 +1,107 @@
+"""
+Compare the Monte Carlo sampling strategies of the calculator at equal point
+budgets. Random star-shaped polygons are dropped over Barcelona; for every
+zone the polygon boundary cuts, each strategy estimates the intersection
+ratio and the population-weighted total is compared with the exact area
+(Sutherland–Hodgman). Reports the relative RMSE per strategy and budget, the
+point-in-polygon tests actually spent, and how many points each strategy
+needs to match uniform sampling at the largest budget.
+
+Usage:
+    cd /path/to/Censo-Territorio
+    python scripts/benchmark_sampling.py
+    python scripts/benchmark_sampling.py --polygons 20 --repeats 10 --budgets 250 1000 4000 10000
+"""
+import sys
+import os
+import math
+import time
+import argparse
+import numpy as np
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api._shared.data_loader import get_city
+from api._shared.census_calculator import (
+    SAMPLING_STRATEGIES, intersection_ratio, _candidate_zones, _refine_zones
+)
+
+parser = argparse.ArgumentParser(description='Accuracy of each sampling strategy at equal point budgets')
+parser.add_argument('--city', default='barcelona')
+parser.add_argument('--polygons', type=int, default=12, help='random test polygons (default 12)')
+parser.add_argument('--repeats', type=int, default=8, help='seeds per strategy and budget (default 8)')
+parser.add_argument('--budgets', type=int, nargs='*', default=[250, 500, 1000, 2500, 10000],
+                    help='points per zone to compare')
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+def random_polygon(rng, extent):
+    """Star-shaped polygon of 8-16 vertices, 300 m to 1.5 km across, inside the city extent"""
+    min_lon, min_lat, max_lon, max_lat = extent
+    cx = rng.uniform(min_lon + 0.3 * (max_lon - min_lon), max_lon - 0.3 * (max_lon - min_lon))
+    cy = rng.uniform(min_lat + 0.3 * (max_lat - min_lat), max_lat - 0.3 * (max_lat - min_lat))
+    n = int(rng.integers(8, 17))
+    angles = np.sort(rng.uniform(0, 2 * math.pi, n))
+    radius = rng.uniform(0.003, 0.015) * rng.uniform(0.5, 1.0, n)
+    ring = np.column_stack([cx + radius * np.cos(angles), cy + radius * np.sin(angles) * 0.75])
+    return np.vstack([ring, ring[:1]])
+
+data = get_city(args.city)
+store = data['store']
+extent = data['config']['extent']
+rng = np.random.default_rng(args.seed)
+
+# Zones cut by each polygon's boundary, with their exact ratios
+cases = []
+for _ in range(args.polygons):
+    poly = random_polygon(rng, extent)
+    zones, ratios = [], []
+    for i in _candidate_zones(poly, store):
+        ratio = intersection_ratio(store.polygon(i), poly)
+        # Below 10% the calculator drops the zone; full zones carry no sampling error
+        if store.has_population[i] and 0.15 <= ratio <= 0.95:
+            zones.append(int(i))
+            ratios.append(ratio)
+    if zones:
+        cases.append((poly, zones, np.array(ratios)))
+print(f"{len(cases)} polygons, {sum(len(z) for _, z, _ in cases)} boundary zones in {args.city}\n")
+
+results = {}
+for sampling in SAMPLING_STRATEGIES:
+    for budget in args.budgets:
+        sq_errors, tests, elapsed = [], 0, 0.0
+        for repeat in range(args.repeats):
+            for poly, zones, exact_ratios in cases:
+                start = time.perf_counter()
+                refined = _refine_zones(poly, store, [{'zone': i} for i in zones], budget, args.seed + repeat, None, sampling)
+                elapsed += time.perf_counter() - start
+                estimated = {r['zone']: r['ratio'] for r in refined}
+                population = store.population[zones]
+                truth = float(population @ exact_ratios)
+                estimate = float(sum(store.population[i] * estimated.get(i, 0.0) for i in zones))
+                sq_errors.append(((estimate - truth) / truth) ** 2)
+                # One section test per drawn point (unless the triangulation is exact) plus one KML test per point inside
+                for r in refined:
+                    needs_section_test = sampling != 'triangulated' or not store.triangles(r['zone'])[1]
+                    tests += budget * needs_section_test + r['n']
+        results[sampling, budget] = (math.sqrt(np.mean(sq_errors)), tests / (args.repeats * len(cases)), elapsed)
+
+print(f"{'strategy':<14}{'points':>8}{'rel. RMSE':>12}{'tests/poly':>13}{'time (s)':>10}")
+for sampling in SAMPLING_STRATEGIES:
+    for budget in args.budgets:
+        rmse, tests, elapsed = results[sampling, budget]
+        print(f"{sampling:<14}{budget:>8}{rmse * 100:>11.3f}%{tests:>13.0f}{elapsed:>10.2f}")
+    print()
+
+reference_budget = max(args.budgets)
+reference_rmse, reference_tests, _ = results['uniform', reference_budget]
+print(f"Points to match uniform at {reference_budget} points (rel. RMSE {reference_rmse * 100:.3f}%):")
+for sampling in SAMPLING_STRATEGIES:
+    matching = [b for b in args.budgets if results[sampling, b][0] <= reference_rmse]
+    if matching:
+        budget = min(matching)
+        saving = reference_tests / results[sampling, budget][1]
+        print(f"  {sampling:<14}{budget:>8} points, {saving:.1f}x fewer point tests")
+    else:
+        print(f"  {sampling:<14}  not reached within the budgets tried")
@@ -0,0 +1,46 @@
+"""
+Run this script once locally (and whenever the source CSVs change) to build
+the columnar snapshots read at cold start. Output goes to
+data/snapshots/{city}/ (one .npy per column plus meta.json) and must be
+committed to the repo. Cities whose snapshot is missing or stale fall back
+to parsing the CSVs, which needs pandas.
+
+Usage:
+    cd /path/to/Censo-Territorio
+    python scripts/build_snapshots.py
+"""
+import sys
+import os
+import time
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api._shared.data_loader import (
+    CITY_CONFIGS, _get_project_root, load_city_csv, load_snapshot, save_snapshot, source_version
+)
+from api._shared.census_calculator import build_geometry_store, build_population_cube, build_population_index
+
+root = _get_project_root()
+
+for city, config in CITY_CONFIGS.items():
+    print(f"Building snapshot for {city}...")
+    start = time.perf_counter()
+    geo_df, pop_df, detail_df = load_city_csv(city, config, root)
+    pop_index = build_population_index(pop_df, config['join_key_pop'])
+    store = build_geometry_store(geo_df, pop_df, config, pop_index=pop_index)
+    cube = build_population_cube(detail_df, store, config) if detail_df is not None else None
+    csv_seconds = time.perf_counter() - start
+
+    version = source_version(city, root)
+    path = save_snapshot(city, store, pop_index, version, root, cube=cube)
+
+    start = time.perf_counter()
+    load_snapshot(city, root, version)
+    snapshot_seconds = time.perf_counter() - start
+
+    size_kb = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)) / 1024
+    print(f"  -> {path}: {len(store)} zones, {size_kb:.0f} KB, version {version}")
+    print(f"     load from CSV {csv_seconds * 1000:.0f} ms, from snapshot {snapshot_seconds * 1000:.0f} ms")
+
+print("Done.")
@@ -2,33 +2,162 @@
 Run this script once locally to pre-generate static GeoJSON files for each city.
 Output goes to public/geojson/{city}.json and must be committed to the repo.
 
+With --topojson a TopoJSON file ({city}.topo.json) is written as well:
+boundaries shared by adjacent sections are stored once and coordinates are
+delta-encoded integers (decode with api/_shared/topology.decode_topojson).
+--check reads each written file back through decode_topojson and compares
+it with the source geometry: same zones, rings, vertex counts and
+properties, every vertex within half a grid step.
+
+Optional zoom variants ({city}.z{zoom}.json) are simplified per shared
+boundary arc, so neighbouring sections stay gap-free, and quantized to a
+precision matching the zoom. Each variant reports its size, the largest
+vertex error and the largest change in zone area (what the Monte Carlo
+estimate in the browser would see).
+
 Usage:
     cd /path/to/Censo-Territorio
     python scripts/generate_geojson.py
+    python scripts/generate_geojson.py --precision 6          # quantize the main file
+    python scripts/generate_geojson.py --zooms 11 13 15       # also write zoom variants
+    python scripts/generate_geojson.py --topojson             # also write {city}.topo.json
+    python scripts/generate_geojson.py --topojson --check     # ...and verify its round-trip
 """
 import sys
 import os
 import json
+import math
+import argparse
+import numpy as np
 
 # Add project root to path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from api._shared.data_loader import get_city_data
-from api._shared.census_calculator import get_census_zones_geojson
+from api._shared.census_calculator import get_census_zones_geojson, zone_feature_properties
+from api._shared.topology import (
+    build_topology, store_geometries, simplify_store, zoom_tolerance, zoom_decimals,
+    encode_topojson, decode_topojson, TOPOJSON_QUANTIZATION
+)
+
+parser = argparse.ArgumentParser(description='Pre-generate the census zones GeoJSON of each city')
+parser.add_argument('--precision', type=int, default=None,
+                    help='decimal degrees kept in the main file (default: full precision)')
+parser.add_argument('--zooms', type=int, nargs='*', default=[],
+                    help='zoom levels to write simplified {city}.z{zoom}.json variants for')
+parser.add_argument('--pixels', type=float, default=0.5,
+                    help='simplification tolerance in screen pixels at each zoom (default 0.5)')
+parser.add_argument('--topojson', action='store_true',
+                    help='also write {city}.topo.json with shared, delta-encoded arcs')
+parser.add_argument('--quantization', type=int, default=TOPOJSON_QUANTIZATION,
+                    help=f'TopoJSON grid size per axis (default {TOPOJSON_QUANTIZATION})')
+parser.add_argument('--check', action='store_true',
+                    help='decode each written {city}.topo.json and compare it with the source geometry')
+args = parser.parse_args()
+if args.check and not args.topojson:
+    parser.error('--check verifies the TopoJSON output and needs --topojson')
 
 output_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'public', 'geojson')
 os.makedirs(output_dir, exist_ok=True)
 
+def write_geojson(path, geojson):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(geojson, f, ensure_ascii=False)
+    return os.path.getsize(path) / 1024
+
+def ring_vertices(ring):
+    """Ring as an (n, 2) array without the closing vertex"""
+    pts = np.asarray(ring, dtype=float)
+    return pts[:-1] if len(pts) > 1 and (pts[0] == pts[-1]).all() else pts
+
+def check_topojson(path, store):
+    """
+    Decode a written TopoJSON file and compare it with the store it was
+    encoded from. Returns a list of problems (empty if the round-trip holds)
+    and the largest vertex error in degrees.
+    """
+    with open(path, encoding='utf-8') as f:
+        topo = json.load(f)
+    features = decode_topojson(topo)['features']
+    # Quantized vertices land within half a grid step on each axis
+    tolerance = math.hypot(*topo['transform']['scale']) / 2 * (1 + 1e-9)
+    problems, max_error = [], 0.0
+    if len(features) != len(store):
+        return [f"{len(features)} features for {len(store)} zones"], max_error
+
+    for i, (feature, parts) in enumerate(zip(features, store_geometries(store))):
+        properties = json.loads(json.dumps(zone_feature_properties(store, i)))
+        if feature['properties'] != properties:
+            problems.append(f"zone {i}: properties differ")
+        geometry = feature['geometry']
+        decoded = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+        if [len(part) for part in decoded] != [len(part) for part in parts]:
+            problems.append(f"zone {i}: parts or rings differ")
+            continue
+        for decoded_part, part in zip(decoded, parts):
+            for decoded_ring, ring in zip(decoded_part, part):
+                decoded_ring, ring = ring_vertices(decoded_ring), ring_vertices(ring)
+                if len(decoded_ring) != len(ring):
+                    problems.append(f"zone {i}: {len(decoded_ring)} vertices instead of {len(ring)}")
+                    continue
+                # Rings may start at another arc junction
+                start = int(np.argmin(np.hypot(*(decoded_ring - ring[0]).T)))
+                error = float(np.hypot(*(np.roll(decoded_ring, -start, axis=0) - ring).T).max())
+                max_error = max(max_error, error)
+                if error > tolerance:
+                    problems.append(f"zone {i}: vertex off by {error:.2e} degrees")
+    return problems, max_error
+
+failed = False
+
 print("Loading city data...")
 city_data = get_city_data()
 
 for city, data in city_data.items():
     print(f"Generating GeoJSON for {city}...")
-    geojson = get_census_zones_geojson(data['geo_df'], data['pop_df'], city_config=data['config'])
+    store = data['store']
+    topology = None
+    if args.precision is not None or args.zooms or args.topojson:
+        topology = build_topology(store_geometries(store))
+
+    main_store = store
+    if args.precision is not None:
+        # Zero tolerance only drops exactly collinear vertices
+        main_store, report = simplify_store(store, 0.0, args.precision, topology=topology)
+        print(f"  precision {args.precision}: max error {report['max_error_m']} m")
+    geojson = get_census_zones_geojson(data['geo_df'], data['pop_df'], city_config=data['config'], store=main_store)
     path = os.path.join(output_dir, f'{city}.json')
-    with open(path, 'w', encoding='utf-8') as f:
-        json.dump(geojson, f, ensure_ascii=False)
-    size_kb = os.path.getsize(path) / 1024
+    size_kb = write_geojson(path, geojson)
     print(f"  -> {path}: {len(geojson['features'])} features, {size_kb:.0f} KB")
 
+    if args.topojson:
+        topo = encode_topojson(store, quantization=args.quantization, topology=topology)
+        path = os.path.join(output_dir, f'{city}.topo.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(topo, f, ensure_ascii=False, separators=(',', ':'))
+        topo_kb = os.path.getsize(path) / 1024
+        print(f"  -> {path}: {len(topo['arcs'])} arcs, {topo_kb:.0f} KB ({size_kb / topo_kb:.1f}x smaller)")
+        if args.check:
+            problems, max_error = check_topojson(path, store)
+            for problem in problems[:10]:
+                print(f"     {problem}")
+            failed = failed or bool(problems)
+            print(f"     round-trip {'FAILED' if problems else 'ok'}: {len(problems)} problems, "
+                  f"max vertex error {max_error * 111_320:.3f} m")
+
+    lat = float(store.coords[:, 1].mean()) if len(store.coords) else 0.0
+    for zoom in args.zooms:
+        tolerance = zoom_tolerance(zoom, lat, args.pixels)
+        simplified, report = simplify_store(store, tolerance, zoom_decimals(tolerance), topology=topology)
+        geojson = get_census_zones_geojson(data['geo_df'], data['pop_df'], city_config=data['config'], store=simplified)
+        path = os.path.join(output_dir, f'{city}.z{zoom}.json')
+        size_kb = write_geojson(path, geojson)
+        print(
+            f"  -> {path}: {size_kb:.0f} KB, tolerance {tolerance:.1f} m, {report['decimals']} decimals, "
+            f"{report['vertices']}/{report['original_vertices']} vertices, max error {report['max_error_m']} m, "
+            f"zone area error max {report['max_area_error_pct']}% / total {report['total_area_error_pct']}%"
+        )
+
+if failed:
+    sys.exit("TopoJSON round-trip check failed")
 print("Done.")
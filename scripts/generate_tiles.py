@@ -0,0 +1,55 @@
+"""
+Optionally pre-generate Mapbox Vector Tiles of the census zones for a
+range of zooms, for static hosting. The API also serves the same tiles on
+demand at /api/tiles/{z}/{x}/{y}.pbf. Output goes to
+public/tiles/{z}/{x}/{y}.pbf; empty tiles are skipped.
+
+Usage:
+    cd /path/to/Censo-Territorio
+    python scripts/generate_tiles.py --min-zoom 10 --max-zoom 15
+"""
+import sys
+import os
+import argparse
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api._shared.data_loader import get_city_data, CITY_CONFIGS
+from api._shared.vector_tiles import MAX_ZOOM, render_tile, tile_range
+
+parser = argparse.ArgumentParser(description='Pre-generate census zone vector tiles')
+parser.add_argument('--min-zoom', type=int, default=10)
+parser.add_argument('--max-zoom', type=int, default=15)
+args = parser.parse_args()
+if not 0 <= args.min_zoom <= args.max_zoom <= MAX_ZOOM:
+    parser.error(f'zooms must satisfy 0 <= --min-zoom <= --max-zoom <= {MAX_ZOOM}')
+
+output_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'public', 'tiles')
+
+print("Loading city data...")
+city_data = get_city_data()
+
+extents = [config['extent'] for config in CITY_CONFIGS.values()]
+bounds = (
+    min(e[0] for e in extents), min(e[1] for e in extents),
+    max(e[2] for e in extents), max(e[3] for e in extents)
+)
+
+for z in range(args.min_zoom, args.max_zoom + 1):
+    min_x, min_y, max_x, max_y = tile_range(bounds, z)
+    written, total_kb = 0, 0.0
+    for x in range(min_x, max_x + 1):
+        for y in range(min_y, max_y + 1):
+            tile = render_tile(z, x, y, city_data)
+            if not tile:
+                continue
+            path = os.path.join(output_dir, str(z), str(x), f'{y}.pbf')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(tile)
+            written += 1
+            total_kb += len(tile) / 1024
+    print(f"  z{z}: {written} tiles, {total_kb:.0f} KB")
+
+print("Done.")
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+# Add project root to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api._shared.census_calculator import DEFAULT_CITY_CONFIG, build_geometry_store
+
+
+def _wkt(ring):
+    return 'POLYGON ((' + ', '.join(f'{x!r} {y!r}' for x, y in ring) + '))'
+
+
+@pytest.fixture
+def make_store():
+    """
+    GeometryStore from closed (x, y) rings, one zone each. populations
+    gives each zone's population; None leaves the zone without padrón data.
+    """
+    def make(rings, populations):
+        keys = list(range(1, len(rings) + 1))
+        secc_df = pd.DataFrame({
+            DEFAULT_CITY_CONFIG['join_key_geo']: keys,
+            DEFAULT_CITY_CONFIG['col_geometry']: [_wkt(ring) for ring in rings],
+            DEFAULT_CITY_CONFIG['col_district']: 'Test',
+            DEFAULT_CITY_CONFIG['col_neighborhood']: 'Test',
+            DEFAULT_CITY_CONFIG['col_district_code']: 1,
+            DEFAULT_CITY_CONFIG['col_section_code']: keys,
+        })
+        pop_index = {key: pop for key, pop in zip(keys, populations) if pop is not None}
+        return build_geometry_store(secc_df, None, DEFAULT_CITY_CONFIG, pop_index=pop_index)
+    return make
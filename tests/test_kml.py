@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from api._shared.census_calculator import (
+    merge_overlapping_parts,
+    kml_polygon_shape,
+    points_in_polygon,
+    polygon_area,
+    polygon_intersection_area,
+)
+
+
+def _square(x0, y0, size):
+    return np.array([[x0, y0], [x0 + size, y0], [x0 + size, y0 + size], [x0, y0 + size], [x0, y0]], dtype=float)
+
+
+def _record(outer, holes=(), name='p'):
+    return {'name': name, 'outer': outer, 'holes': list(holes)}
+
+
+def _merged(records):
+    records, overlaps = merge_overlapping_parts(records)
+    return kml_polygon_shape(records, overlaps), records, overlaps
+
+
+@pytest.mark.parametrize('records, area, n_parts', [
+    ([_record(_square(0, 0, 1)), _record(_square(0, 0, 1))], 1.0, 1),
+    ([_record(_square(0, 0, 1)), _record(_square(1, 0, 1))], 2.0, 2),
+    ([_record(_square(0, 0, 1)), _record(_square(0.5, 0, 1))], 1.5, 2),
+    ([_record(_square(0, 0, 2)), _record(_square(0.5, 0.5, 1))], 4.0, 2),
+    ([_record(_square(0, 0, 1)), _record(_square(0.5, 0, 1)), _record(_square(0.25, 0.5, 1))], 2.0, 3),
+    ([_record(_square(0, 0, 3), [_square(1, 1, 1)[::-1]]), _record(_square(1.25, 1.25, 0.5))], 8.25, 2),
+    ([_record(_square(0, 0, 3), [_square(1, 1, 1)[::-1]]), _record(_square(0.5, 0.5, 1))], 8.25, 2),
+], ids=['duplicate', 'shared edge', 'partial', 'contained', 'three', 'island in hole', 'over a hole'])
+def test_overlapping_parts_count_once(records, area, n_parts):
+    shape, distinct, _ = _merged(records)
+    assert len(distinct) == n_parts
+    assert polygon_area(shape) == pytest.approx(area)
+
+
+def test_exact_intersection_matches_the_union():
+    # Concave parts: an L overlapping a square, against a zone crossing both
+    l_shape = np.array([[0, 0], [2, 0], [2, 1], [1, 1], [1, 2], [0, 2], [0, 0]], dtype=float)
+    shape, _, overlaps = _merged([_record(l_shape), _record(_square(0.5, 0.5, 1))])
+    assert overlaps
+
+    zone = _square(0.25, 0.25, 1.5)
+    rng = np.random.default_rng(0)
+    xs, ys = rng.uniform(0.25, 1.75, 400_000), rng.uniform(0.25, 1.75, 400_000)
+    sampled = points_in_polygon(xs, ys, shape).mean() * 1.5 ** 2
+    assert polygon_intersection_area(zone, shape) == pytest.approx(sampled, abs=5e-3)
+    # The union is the L plus the square's top-right quarter
+    assert polygon_area(shape) == pytest.approx(3.25)
+
+
+def test_disjoint_parts_add_no_overlap_terms():
+    records = [_record(_square(x, y, 0.9)) for x in range(10) for y in range(10)]
+    distinct, overlaps = merge_overlapping_parts(records)
+    assert len(distinct) == 100
+    assert overlaps == []
@@ -0,0 +1,161 @@
+import collections
+
+import numpy as np
+import pytest
+
+from api._shared.topology import (
+    build_topology,
+    decode_topojson,
+    encode_topojson,
+    simplify_store,
+    store_geometries,
+)
+
+COLS, ROWS = 3, 2
+
+
+def _grid_rings(origin, step, jitter, points_per_edge=8, seed=0):
+    """
+    Closed rings of a COLS x ROWS grid of cells. Interior edges carry
+    points_per_edge intermediate vertices displaced by up to jitter across
+    the edge, shared by both neighbours; edges on the grid's outline get
+    collinear intermediate vertices. Each ring starts part-way along an
+    edge, as WKT rings do, so a per-ring simplification would not keep the
+    neighbours' borders in step.
+    """
+    rng = np.random.default_rng(seed)
+    x0, y0 = origin
+    edges = {}
+
+    def edge(a, b):
+        """Vertices from lattice point a to b, both included"""
+        if (b, a) in edges:
+            return edges[(b, a)][::-1]
+        if (a, b) not in edges:
+            t = np.linspace(0, 1, points_per_edge + 2)[:, None]
+            pa = np.array([x0 + a[0] * step, y0 + a[1] * step])
+            pb = np.array([x0 + b[0] * step, y0 + b[1] * step])
+            pts = pa + t * (pb - pa)
+            vertical = a[0] == b[0]
+            outline = (a[0] in (0, COLS) and vertical) or (a[1] in (0, ROWS) and not vertical)
+            if not outline:
+                offsets = rng.uniform(-jitter, jitter, points_per_edge)
+                pts[1:-1, 0 if vertical else 1] += offsets
+            edges[(a, b)] = [tuple(p) for p in pts.tolist()]
+        return edges[(a, b)]
+
+    rings = []
+    for row in range(ROWS):
+        for col in range(COLS):
+            corners = [(col, row), (col + 1, row), (col + 1, row + 1), (col, row + 1), (col, row)]
+            ring = []
+            for a, b in zip(corners[:-1], corners[1:]):
+                ring.extend(edge(a, b)[:-1])
+            start = (1 + row * COLS + col) % len(ring)
+            ring = ring[start:] + ring[:start]
+            ring.append(ring[0])
+            rings.append(ring)
+    return rings
+
+
+def _canonical(ring):
+    """Ring without its closing vertex, rotated to start at its smallest vertex"""
+    pts = [tuple(p) for p in np.asarray(ring, dtype=float).tolist()][:-1]
+    start = min(range(len(pts)), key=pts.__getitem__)
+    return pts[start:] + pts[:start]
+
+
+def _zone_rings(store, i):
+    return [ring for part in store_geometries(store)[i] for ring in part]
+
+
+def _decoded_rings(feature):
+    geometry = feature['geometry']
+    parts = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+    return [ring for part in parts for ring in part]
+
+
+@pytest.fixture
+def integer_store(make_store):
+    # Integer vertices on a 60 x 60 bbox: with 61 quantization steps the grid step is exactly 1
+    rings = _grid_rings((0, 0), 10, 3, points_per_edge=4)
+    rings = [[(2 * round(x), 3 * round(y)) for x, y in ring] for ring in rings]
+    return make_store(rings, [100] * len(rings))
+
+
+@pytest.fixture
+def city_store(make_store):
+    # 250 m cells around Barcelona with borders wobbling ~1 m
+    rings = _grid_rings((2.15, 41.39), 0.003, 0.00001)
+    return make_store(rings, [100] * len(rings))
+
+
+def test_shared_borders_are_stored_once(city_store):
+    arcs, shapes = build_topology(store_geometries(city_store))
+    refs = collections.Counter(ref if ref >= 0 else ~ref for shape in shapes for part in shape for ring in part for ref in ring)
+    # Every arc is used by one zone (outline) or two (shared border), never more
+    assert set(refs.values()) <= {1, 2}
+    # 7 interior borders in a 3 x 2 grid
+    assert sum(1 for count in refs.values() if count == 2) == 7
+
+
+def test_topojson_decode_is_exact_on_the_grid(integer_store):
+    topology = encode_topojson(integer_store, quantization=61)
+    decoded = decode_topojson(topology)
+    assert len(decoded['features']) == len(integer_store)
+    for i, feature in enumerate(decoded['features']):
+        original = [_canonical(ring) for ring in _zone_rings(integer_store, i)]
+        assert [_canonical(ring) for ring in _decoded_rings(feature)] == original
+
+
+def test_topojson_decode_within_half_a_grid_step(city_store):
+    topology = encode_topojson(city_store)
+    half_step = np.array(topology['transform']['scale']) / 2
+    decoded = decode_topojson(topology)
+    for i, feature in enumerate(decoded['features']):
+        for ring, original in zip(_decoded_rings(feature), _zone_rings(city_store, i)):
+            ring = np.array(_canonical(ring))
+            original = np.array(_canonical(original))
+            assert ring.shape == original.shape
+            assert (np.abs(ring - original) <= half_step + 1e-12).all()
+    assert decoded['features'][0]['properties']['population'] == 100
+
+
+def _edges(store):
+    """Directed edges of every ring of every zone"""
+    edges = collections.Counter()
+    for i in range(len(store)):
+        for ring in _zone_rings(store, i):
+            pts = [tuple(p) for p in np.asarray(ring).tolist()]
+            edges.update(zip(pts[:-1], pts[1:]))
+    return edges
+
+
+@pytest.mark.parametrize('tolerance_m, decimals', [(0.5, None), (5.0, None), (5.0, 6), (50.0, 4)])
+def test_simplified_borders_stay_shared(city_store, tolerance_m, decimals):
+    simplified, report = simplify_store(city_store, tolerance_m, decimals)
+    assert report['vertices'] < report['original_vertices']
+
+    lon = sorted({p[0] for p in city_store.coords.tolist()})
+    lat = sorted({p[1] for p in city_store.coords.tolist()})
+    outline_lon = {round(lon[0], decimals or 12), round(lon[-1], decimals or 12)}
+    outline_lat = {round(lat[0], decimals or 12), round(lat[-1], decimals or 12)}
+
+    edges = _edges(simplified)
+    for (a, b), count in edges.items():
+        assert count == 1
+        if (b, a) in edges:
+            continue
+        # An edge with no opposite twin must lie on the grid's outline
+        on_lon = a[0] == b[0] and round(a[0], decimals or 12) in outline_lon
+        on_lat = a[1] == b[1] and round(a[1], decimals or 12) in outline_lat
+        assert on_lon or on_lat, (a, b)
+
+
+def test_simplified_topojson_round_trip(city_store):
+    simplified, _ = simplify_store(city_store, 5.0)
+    decoded = decode_topojson(encode_topojson(simplified))
+    step = max(encode_topojson(simplified)['transform']['scale'])
+    for i, feature in enumerate(decoded['features']):
+        for ring, original in zip(_decoded_rings(feature), _zone_rings(simplified, i)):
+            np.testing.assert_allclose(np.array(_canonical(ring)), np.array(_canonical(original)), atol=step)
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from api._shared.census_calculator import (
+    MIN_ZONE_RATIO,
+    ResultCache,
+    apply_weights,
+    city_intersection_weights,
+    estimate_cities,
+)
+
+STEP = 0.01
+ORIGIN = (2.10, 41.36)
+POPULATIONS = [1000, 800, 600, None]  # the fourth zone has no padrón data
+
+# KML covering zone 0 fully, half of zone 1, 5% of zone 2 and 2.5% of zone 3
+KML = np.array([
+    [ORIGIN[0] - 0.001, ORIGIN[1] - 0.001], [ORIGIN[0] + 0.015, ORIGIN[1] - 0.001],
+    [ORIGIN[0] + 0.015, ORIGIN[1] + 0.0105], [ORIGIN[0] - 0.001, ORIGIN[1] + 0.0105],
+    [ORIGIN[0] - 0.001, ORIGIN[1] - 0.001]
+])
+
+
+def _square(col, row):
+    x, y = ORIGIN[0] + col * STEP, ORIGIN[1] + row * STEP
+    return [(x, y), (x + STEP, y), (x + STEP, y + STEP), (x, y + STEP), (x, y)]
+
+
+@pytest.fixture
+def city_data(make_store):
+    # 2 x 2 grid: zones 0 and 1 on the bottom row, 2 and 3 above them
+    store = make_store([_square(0, 0), _square(1, 0), _square(0, 1), _square(1, 1)], POPULATIONS)
+    return {'test': {'store': store, 'version': 'test-v1'}}
+
+
+def _counted_population(weights, store):
+    """Per-zone population masked the way the estimate counts it"""
+    dense = weights.to_dense()
+    return store.population * ((dense >= MIN_ZONE_RATIO) & store.has_population)
+
+
+def test_weights_keep_raw_fraction_of_every_touching_zone(city_data):
+    weights = city_intersection_weights(KML, city_data, method='exact')['test']
+    dense = weights.to_dense()
+    assert len(weights) == 4
+    np.testing.assert_allclose(dense, [1.0, 0.5, 0.05, 0.025], atol=1e-3)
+
+
+def test_exact_total_applies_cutoff_to_the_weights(city_data):
+    store = city_data['test']['store']
+    weights = city_intersection_weights(KML, city_data, method='exact')['test']
+    stats = estimate_cities(KML, city_data, method='exact')
+
+    # Zone 2 sits under the cut-off: the total leaves it out, the raw weights keep it
+    assert stats['total_population'] == round(apply_weights(weights, _counted_population(weights, store)))
+    assert [zone['join_key'] for zone in stats['intersecting_zones']] == ['1', '2']
+    under_cutoff = apply_weights(weights, store.population) - apply_weights(weights, _counted_population(weights, store))
+    assert under_cutoff == pytest.approx(600 * 0.05, rel=1e-2)
+
+    # The interval's upper end is widened by exactly that population
+    assert stats['cutoff_bound'] == pytest.approx(under_cutoff, abs=0.1)
+    assert stats['ci_95'][1] >= stats['total_population'] + under_cutoff - 0.5
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_montecarlo_total_applies_cutoff_to_the_weights(city_data, seed):
+    store = city_data['test']['store']
+    weights = city_intersection_weights(KML, city_data, rng=seed)['test']
+    stats = estimate_cities(KML, city_data, rng=seed)
+
+    assert weights.to_dense()[2] > 0
+    assert stats['total_population'] == round(apply_weights(weights, _counted_population(weights, store)))
+    assert stats['cutoff_bound'] >= apply_weights(weights, store.population) - stats['total_population'] - 0.5
+
+
+def test_cached_weights_are_raw_and_versioned(city_data):
+    cache = ResultCache()
+    first = city_intersection_weights(KML, city_data, method='exact', cache=cache)['test']
+    assert any(key.startswith('weights:v2:') for key in cache._entries)
+
+    cached = city_intersection_weights(KML, city_data, method='exact', cache=cache)['test']
+    assert cache.hits == 1
+    np.testing.assert_array_equal(cached.zones, first.zones)
+    np.testing.assert_allclose(cached.fractions, first.fractions)